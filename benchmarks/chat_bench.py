@@ -0,0 +1,456 @@
+"""
+Chat server benchmark suite
+
+Seeds a scratch SQLite database with --users accounts, one room they all
+belong to and --history messages, then drives login, join, send and history
+fetch and prints a JSON report: count, failures, throughput and p50/p99
+latency per operation, plus memory per connection. Two ways to run it:
+
+    inprocess  Flask and Flask-SocketIO test clients in this process, no
+               network. Cheap and stable, for catching regressions
+    sockets    the real server started on a local port (in its own process,
+               CHAT_ASYNC_MODE as usual) and python-socketio clients over
+               websockets, for sizing hardware
+
+    python benchmarks/chat_bench.py inprocess --clients 500 --messages 200
+    CHAT_ASYNC_MODE=eventlet python benchmarks/chat_bench.py sockets --clients 5000
+
+Rate limits are lifted for the run, they would otherwise be what is
+measured. --baseline report.json compares p99s with an earlier report and
+exits with status 1 when one of them got worse by more than --tolerance.
+
+The sockets mode needs python-socketio[asyncio_client] (aiohttp). Raise the
+open file limit (ulimit -n) for large --clients values.
+"""
+import argparse
+import gc
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+CORE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "core")
+sys.path.insert(0, CORE)
+
+PASSWORD = "bench-password"
+# nothing in the run should be turned away by the limits in limits.py
+UNLIMITED = (1e9, 1e9)
+
+
+def app_config(database_url):
+    return {
+        "SQLALCHEMY_DATABASE_URI": database_url,
+        "WTF_CSRF_ENABLED": False,
+        "CHAT_RATE_CONNECTION": UNLIMITED,
+        "CHAT_RATE_USER": UNLIMITED,
+        "CHAT_RATE_ROOM": UNLIMITED,
+        "CHAT_RATE_HTTP": UNLIMITED,
+        "CHAT_OUTBOUND_MAX": 10 ** 6,
+    }
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def rss_bytes(pid):
+    if not pid:
+        return None
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class Timings:
+    """
+    latencies of one operation and the wall time it ran for
+    """
+
+    def __init__(self):
+        self.samples = []
+        self.failed = 0
+        self.started = None
+        self.finished = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.finished = time.perf_counter()
+
+    def record(self, seconds, ok=True):
+        if ok:
+            self.samples.append(seconds)
+        else:
+            self.failed += 1
+
+    def report(self):
+        wall = (self.finished or time.perf_counter()) - (self.started or time.perf_counter())
+        p50, p99 = percentile(self.samples, 50), percentile(self.samples, 99)
+        return {
+            "count": len(self.samples),
+            "failed": self.failed,
+            "throughput_per_s": round(len(self.samples) / wall, 2) if wall > 0 else None,
+            "p50_ms": round(p50 * 1000, 3) if p50 is not None else None,
+            "p99_ms": round(p99 * 1000, 3) if p99 is not None else None,
+        }
+
+
+def seed(users, history):
+    """
+    bulk inserts the accounts, the room and its history, needs an app
+    context. Every account shares one password hash, so seeding costs a
+    single hash while logins still verify at the configured cost
+    """
+    import uuid
+    import sqlalchemy as s
+    from models import db, User, Room, Message, association_table
+    from hashing import hasher
+
+    db.create_all()
+    pwhash = hasher.hash(PASSWORD)
+    user_ids = [str(uuid.uuid4()) for _ in range(users)]
+    db.session.execute(s.insert(User), [
+        {"id": user_id, "username": f"bench{n}", "password": pwhash, "email": f"bench{n}@example.com"}
+        for n, user_id in enumerate(user_ids)
+    ])
+    room_id = str(uuid.uuid4())
+    db.session.execute(s.insert(Room), [{
+        "room_id": room_id, "room_name": "bench", "joining_url": "/join/bench",
+        "creator_id": user_ids[0], "invite_code": "bench", "member_count": users,
+    }])
+    db.session.execute(association_table.insert(), [
+        {"left_id": user_id, "right_id": room_id} for user_id in user_ids
+    ])
+    start = datetime.now() - timedelta(seconds=history)
+    for offset in range(0, history, 5000):
+        db.session.execute(s.insert(Message), [
+            {"message_body": f"history {n}", "sent_to_room_id": room_id,
+             "sent_id": user_ids[n % users], "date": start + timedelta(seconds=n)}
+            for n in range(offset, min(offset + 5000, history))
+        ])
+    if history:
+        db.session.execute(
+            s.update(Room).where(Room.room_id == room_id)
+            .values(last_message_id=s.select(s.func.max(Message.message_id)).scalar_subquery())
+        )
+    db.session.commit()
+    return room_id
+
+
+def compare(report, baseline, tolerance):
+    """
+    operations whose p99 is more than `tolerance` (a fraction) above the baseline's
+    """
+    regressions = {}
+    for name, current in report["operations"].items():
+        before = baseline.get("operations", {}).get(name, {}).get("p99_ms")
+        if before and current["p99_ms"] is not None and current["p99_ms"] > before * (1 + tolerance):
+            regressions[name] = {"baseline_p99_ms": before, "p99_ms": current["p99_ms"]}
+    return regressions
+
+
+# in-process
+
+def run_inprocess(args):
+    from app import create_app
+    from extensions import socketio
+    from models import db
+    from write_buffer import message_buffer
+
+    tmp = tempfile.TemporaryDirectory()
+    app = create_app(app_config(f"sqlite:///{os.path.join(tmp.name, 'bench.db')}"))
+    with app.app_context():
+        room_id = seed(args.users, args.history)
+    ops = {name: Timings() for name in ("login", "join", "send", "history")}
+
+    http = []
+    with ops["login"] as timings:
+        for n in range(args.users):
+            client = app.test_client()
+            started = time.perf_counter()
+            response = client.post("/login", data={"username": f"bench{n}", "password": PASSWORD})
+            timings.record(time.perf_counter() - started,
+                           response.status_code == 302 and response.location.endswith("/dashboard"))
+            http.append(client)
+
+    gc.collect()
+    rss_before = rss_bytes(os.getpid())
+    sockets = []
+    with ops["join"] as timings:
+        for n in range(args.clients):
+            started = time.perf_counter()
+            client = socketio.test_client(app, namespace="/chat", flask_test_client=http[n % len(http)])
+            ack = client.emit("join", {"room_id": room_id}, namespace="/chat", callback=True) \
+                if client.is_connected("/chat") else None
+            timings.record(time.perf_counter() - started, bool(ack and ack.get("ok")))
+            sockets.append(client)
+    gc.collect()
+    rss_after = rss_bytes(os.getpid())
+
+    with ops["send"] as timings:
+        for n in range(args.messages):
+            client = sockets[n % len(sockets)]
+            started = time.perf_counter()
+            ack = client.emit("send", {"room_id": room_id, "body": f"bench {n}"},
+                              namespace="/chat", callback=True)
+            timings.record(time.perf_counter() - started, bool(ack and ack.get("ok")))
+        # sent means stored, the last batch is still in the write buffer
+        message_buffer.flush()
+    deliveries = sum(
+        1 for client in sockets for packet in client.get_received("/chat") if packet["name"] == "message"
+    )
+
+    with ops["history"] as timings:
+        for client in http:
+            before = None
+            for _ in range(args.pages):
+                started = time.perf_counter()
+                query = {"limit": args.page_size}
+                if before is not None:
+                    query["before"] = before
+                response = client.get(f"/rooms/{room_id}/messages", query_string=query)
+                ok = response.status_code == 200
+                timings.record(time.perf_counter() - started, ok)
+                before = response.get_json()["next_before"] if ok else None
+                if before is None:
+                    break
+
+    for client in sockets:
+        client.disconnect(namespace="/chat")
+    with app.app_context():
+        db.engine.dispose()
+    tmp.cleanup()
+    return {
+        "operations": {name: timings.report() for name, timings in ops.items()},
+        "deliveries_expected": args.messages * len(sockets),
+        "deliveries_received": deliveries,
+        # includes the test client half of every connection
+        "rss_per_connection_bytes": (rss_after - rss_before) // max(1, len(sockets))
+        if rss_before and rss_after else None,
+    }
+
+
+# over local sockets
+
+def serve(args):
+    """
+    the server half of the sockets mode, prints one JSON line once it has
+    seeded and is about to listen
+    """
+    from app import create_app
+    from extensions import socketio
+    import offload
+
+    app = create_app(app_config(args.database_url))
+    with app.app_context():
+        room_id = seed(args.users, args.history)
+    print(json.dumps({"room_id": room_id, "pid": os.getpid()}), flush=True)
+    socketio.run(app, host="127.0.0.1", port=args.port, log_output=False,
+                 allow_unsafe_werkzeug=offload.mode == "threading")
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+async def run_sockets(args):
+    import asyncio
+    import aiohttp
+    import socketio
+
+    tmp = tempfile.TemporaryDirectory()
+    port = free_port()
+    server = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "serve", "--port", str(port),
+         "--users", str(args.users), "--history", str(args.history),
+         "--database-url", f"sqlite:///{os.path.join(tmp.name, 'bench.db')}"],
+        cwd=CORE, stdout=subprocess.PIPE, text=True,
+    )
+    try:
+        line = await asyncio.get_running_loop().run_in_executor(None, server.stdout.readline)
+        if not line:
+            raise SystemExit("server exited before it was ready")
+        ready = json.loads(line)
+        url, room_id = f"http://127.0.0.1:{port}", ready["room_id"]
+        for _ in range(100):
+            try:
+                with socket.create_connection(("127.0.0.1", port), timeout=0.1):
+                    break
+            except OSError:
+                await asyncio.sleep(0.1)
+        return await drive_sockets(args, url, room_id, ready["pid"], aiohttp, socketio)
+    finally:
+        server.terminate()
+        server.wait()
+        tmp.cleanup()
+
+
+async def drive_sockets(args, url, room_id, server_pid, aiohttp, socketio):
+    import asyncio
+
+    ops = {name: Timings() for name in ("login", "join", "send", "deliver", "history")}
+    limit = asyncio.Semaphore(args.concurrency)
+    http = aiohttp.ClientSession(cookie_jar=aiohttp.DummyCookieJar())
+
+    async def login(n):
+        async with limit:
+            started = time.perf_counter()
+            try:
+                async with http.post(f"{url}/login", allow_redirects=False,
+                                     data={"username": f"bench{n}", "password": PASSWORD}) as response:
+                    cookie = response.cookies.get("session")
+                    ok = response.status == 302 and cookie is not None \
+                        and response.headers.get("Location", "").endswith("/dashboard")
+            except aiohttp.ClientError:
+                cookie, ok = None, False
+            ops["login"].record(time.perf_counter() - started, ok)
+            return f"session={cookie.value}" if ok else None
+
+    with ops["login"]:
+        cookies = [cookie for cookie in await asyncio.gather(*(login(n) for n in range(args.users)))
+                   if cookie is not None]
+    if not cookies:
+        await http.close()
+        raise SystemExit("no login succeeded")
+
+    async def connect(n):
+        client = socketio.AsyncClient(reconnection=False)
+
+        @client.on("message", namespace="/chat")
+        async def on_message(payload):
+            body = payload.get("body", "")
+            if body.startswith("bench "):
+                ops["deliver"].record(time.time() - float(body.split()[1]))
+
+        async with limit:
+            started = time.perf_counter()
+            try:
+                await client.connect(url, namespaces=["/chat"], transports=["websocket"],
+                                     headers={"Cookie": cookies[n % len(cookies)]})
+                ack = await client.call("join", {"room_id": room_id}, namespace="/chat", timeout=30)
+                ok = bool(ack and ack.get("ok"))
+            except (socketio.exceptions.SocketIOError, asyncio.TimeoutError):
+                ok = False
+            ops["join"].record(time.perf_counter() - started, ok)
+            return client if ok else None
+
+    rss_before = rss_bytes(server_pid)
+    with ops["join"]:
+        clients = [client for client in await asyncio.gather(*(connect(n) for n in range(args.clients)))
+                   if client is not None]
+    await asyncio.sleep(1)
+    rss_after = rss_bytes(server_pid)
+
+    async def send(n):
+        client = clients[n % len(clients)]
+        started = time.perf_counter()
+        try:
+            ack = await client.call("send", {"room_id": room_id, "body": f"bench {time.time()}"},
+                                    namespace="/chat", timeout=30)
+            ok = bool(ack and ack.get("ok"))
+        except (socketio.exceptions.SocketIOError, asyncio.TimeoutError):
+            ok = False
+        ops["send"].record(time.perf_counter() - started, ok)
+
+    expected = 0
+    with ops["send"]:
+        if clients:
+            sends = []
+            for n in range(args.messages):
+                sends.append(asyncio.ensure_future(send(n)))
+                await asyncio.sleep(1 / args.rate)
+            await asyncio.gather(*sends)
+            expected = ops["send"].report()["count"] * len(clients)
+    with ops["deliver"]:
+        deadline = time.monotonic() + args.drain
+        while len(ops["deliver"].samples) < expected and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+
+    async def history(cookie):
+        before = None
+        for _ in range(args.pages):
+            params = {"limit": args.page_size}
+            if before is not None:
+                params["before"] = before
+            async with limit:
+                started = time.perf_counter()
+                try:
+                    async with http.get(f"{url}/rooms/{room_id}/messages", params=params,
+                                        headers={"Cookie": cookie}) as response:
+                        page = await response.json() if response.status == 200 else None
+                except aiohttp.ClientError:
+                    page = None
+                ops["history"].record(time.perf_counter() - started, page is not None)
+            before = page["next_before"] if page else None
+            if before is None:
+                break
+
+    with ops["history"]:
+        await asyncio.gather(*(history(cookie) for cookie in cookies))
+
+    await asyncio.gather(*(client.disconnect() for client in clients), return_exceptions=True)
+    await http.close()
+    return {
+        "operations": {name: timings.report() for name, timings in ops.items()},
+        "deliveries_expected": expected,
+        "deliveries_received": len(ops["deliver"].samples),
+        "rss_per_connection_bytes": (rss_after - rss_before) // max(1, len(clients))
+        if rss_before and rss_after else None,
+    }
+
+
+def main(args):
+    if args.mode == "serve":
+        return serve(args)
+    if args.mode == "inprocess":
+        report = run_inprocess(args)
+    else:
+        import asyncio
+        report = asyncio.run(run_sockets(args))
+    report = {"mode": args.mode, "async_mode": os.environ.get("CHAT_ASYNC_MODE", "threading"),
+              "users": args.users, "clients": args.clients, "messages": args.messages,
+              "history": args.history, **report}
+    status = 0
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            report["regressions"] = compare(report, json.load(baseline), args.tolerance)
+        status = 1 if report["regressions"] else 0
+    print(json.dumps(report, indent=2))
+    return status
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("mode", choices=("inprocess", "sockets", "serve"))
+    parser.add_argument("--users", type=int, default=100, help="accounts, each logs in once")
+    parser.add_argument("--clients", type=int, default=1000, help="socket connections, spread over the users")
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=100, help="messages per second, sockets mode")
+    parser.add_argument("--drain", type=float, default=30, help="seconds to wait for deliveries")
+    parser.add_argument("--history", type=int, default=10000, help="messages seeded into the room")
+    parser.add_argument("--pages", type=int, default=3, help="history pages fetched per user")
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=200, help="requests in flight, sockets mode")
+    parser.add_argument("--baseline", help="earlier report to compare p99s with")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    # used by the sockets mode to start the server
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--database-url", help=argparse.SUPPRESS)
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,99 @@
+"""
+SQLite read/write concurrency benchmark
+
+Runs reader and writer threads against a scratch copy of the message table
+twice: once with SQLite's stock settings (rollback journal, synchronous=FULL,
+no mmap, what the app used before core/config.py) and once with the
+pragmas from core/config.py. Prints reads/s, writes/s and lock errors for
+both as JSON.
+
+    python benchmarks/db_concurrency.py --readers 8 --writers 2 --seconds 5
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import sqlalchemy as s
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "core"))
+from config import engine_options, sqlite_pragmas, install_sqlite_pragmas  # noqa: E402
+
+
+# pysqlite's own 5 second busy handler still applies here, as it did before
+STOCK = {"journal_mode": "DELETE", "synchronous": "FULL", "mmap_size": 0}
+
+
+def setup(engine, rows):
+    with engine.begin() as conn:
+        conn.execute(s.text(
+            "CREATE TABLE message (message_id INTEGER PRIMARY KEY, message_body VARCHAR, "
+            "sent_to_room_id VARCHAR, sent_id VARCHAR, date DATETIME)"))
+        conn.execute(s.text("CREATE INDEX ix_message_room_date ON message (sent_to_room_id, date, message_id)"))
+        conn.execute(
+            s.text("INSERT INTO message (message_body, sent_to_room_id, sent_id, date) "
+                   "VALUES (:body, :room, 'u', datetime('now'))"),
+            [{"body": f"message {n}", "room": f"room-{n % 20}"} for n in range(rows)],
+        )
+
+
+def reader(engine, stop, counts):
+    while not stop.is_set():
+        try:
+            with engine.connect() as conn:
+                conn.execute(s.text(
+                    "SELECT * FROM message WHERE sent_to_room_id = 'room-3' "
+                    "ORDER BY date DESC, message_id DESC LIMIT 50")).all()
+            counts["reads"] += 1
+        except s.exc.OperationalError:
+            counts["read_errors"] += 1
+
+
+def writer(engine, stop, counts):
+    while not stop.is_set():
+        try:
+            with engine.begin() as conn:
+                conn.execute(s.text(
+                    "INSERT INTO message (message_body, sent_to_room_id, sent_id, date) "
+                    "VALUES ('bench', 'room-3', 'u', datetime('now'))"))
+            counts["writes"] += 1
+        except s.exc.OperationalError:
+            counts["write_errors"] += 1
+
+
+def run(pragmas, args):
+    with tempfile.TemporaryDirectory() as tmp:
+        url = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        engine = s.create_engine(url, **engine_options(url))
+        install_sqlite_pragmas(engine, pragmas)
+        setup(engine, args.rows)
+        counts = {"reads": 0, "writes": 0, "read_errors": 0, "write_errors": 0}
+        stop = threading.Event()
+        threads = [threading.Thread(target=reader, args=(engine, stop, counts)) for _ in range(args.readers)]
+        threads += [threading.Thread(target=writer, args=(engine, stop, counts)) for _ in range(args.writers)]
+        for thread in threads:
+            thread.start()
+        time.sleep(args.seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        engine.dispose()
+    return {
+        "pragmas": pragmas,
+        "reads_per_second": round(counts["reads"] / args.seconds, 1),
+        "writes_per_second": round(counts["writes"] / args.seconds, 1),
+        "read_errors": counts["read_errors"],
+        "write_errors": counts["write_errors"],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--writers", type=int, default=2)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--rows", type=int, default=50000)
+    args = parser.parse_args()
+    print(json.dumps({"before": run(STOCK, args), "after": run(sqlite_pragmas(), args)}, indent=2))
@@ -0,0 +1,130 @@
+"""
+Socket load script
+
+Opens many Socket.IO connections to a running server, joins them all to one
+room and measures broadcast latency from one sender to every receiver.
+Prints a JSON report on stdout.
+
+    CHAT_ASYNC_MODE=eventlet python core/server.py
+    python benchmarks/socket_load.py --room-id <id> --username bob --password pw \\
+        --clients 10000 --messages 200 --server-pid <pid>
+
+Needs python-socketio[asyncio_client] (aiohttp) on the client side. Raise the
+open file limit (ulimit -n) on both sides for large --clients values.
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+import aiohttp
+import socketio
+
+
+def rss_bytes(pid):
+    if not pid:
+        return None
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return None
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+async def login(url, username, password):
+    async with aiohttp.ClientSession() as http:
+        async with http.post(f"{url}/login", data={"username": username, "password": password},
+                             allow_redirects=False) as response:
+            cookie = response.cookies.get("session")
+            if cookie is None:
+                raise SystemExit("login failed, no session cookie")
+            return f"session={cookie.value}"
+
+
+async def open_client(url, cookie, room_id, latencies):
+    client = socketio.AsyncClient(reconnection=False)
+
+    @client.on("message", namespace="/chat")
+    async def on_message(payload):
+        body = payload.get("body", "")
+        if body.startswith("bench "):
+            latencies.append(time.time() - float(body.split()[1]))
+
+    await client.connect(url, namespaces=["/chat"], transports=["websocket"],
+                         headers={"Cookie": cookie})
+    ack = await client.call("join", {"room_id": room_id}, namespace="/chat")
+    if not ack.get("ok"):
+        raise RuntimeError(ack)
+    return client
+
+
+async def main(args):
+    cookie = await login(args.url, args.username, args.password)
+    rss_before = rss_bytes(args.server_pid)
+    latencies = []
+    clients = []
+    failed = 0
+    started = time.perf_counter()
+    for offset in range(0, args.clients, args.batch):
+        batch = range(offset, min(offset + args.batch, args.clients))
+        results = await asyncio.gather(
+            *(open_client(args.url, cookie, args.room_id, latencies) for _ in batch),
+            return_exceptions=True,
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                failed += 1
+            else:
+                clients.append(result)
+    connect_seconds = time.perf_counter() - started
+    await asyncio.sleep(1)
+    rss_after = rss_bytes(args.server_pid)
+
+    sender = clients[0]
+    for _ in range(args.messages):
+        await sender.emit("send", {"room_id": args.room_id, "body": f"bench {time.time()}"},
+                          namespace="/chat")
+        await asyncio.sleep(1 / args.rate)
+    expected = args.messages * len(clients)
+    deadline = time.monotonic() + args.drain
+    while len(latencies) < expected and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+
+    report = {
+        "clients_requested": args.clients,
+        "clients_connected": len(clients),
+        "clients_failed": failed,
+        "connect_seconds": round(connect_seconds, 3),
+        "messages": args.messages,
+        "deliveries_expected": expected,
+        "deliveries_received": len(latencies),
+        "broadcast_latency_p50_ms": round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+        "broadcast_latency_p99_ms": round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+        "server_rss_per_connection_bytes": (rss_after - rss_before) // max(1, len(clients))
+        if rss_before and rss_after else None,
+    }
+    print(json.dumps(report, indent=2))
+    await asyncio.gather(*(client.disconnect() for client in clients), return_exceptions=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--username", required=True)
+    parser.add_argument("--password", required=True)
+    parser.add_argument("--room-id", required=True)
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--batch", type=int, default=200, help="connections opened concurrently")
+    parser.add_argument("--messages", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=20, help="messages per second")
+    parser.add_argument("--drain", type=float, default=30, help="seconds to wait for deliveries")
+    parser.add_argument("--server-pid", type=int, default=int(os.environ.get("CHAT_SERVER_PID", 0)))
+    asyncio.run(main(parser.parse_args()))
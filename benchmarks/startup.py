@@ -0,0 +1,56 @@
+"""
+Startup time benchmark
+
+Measures, in fresh interpreters, how long it takes from a cold import of the
+app to the first answered request, split into import time, create_app time
+and first request time. Prints min/median/max per phase as JSON.
+
+    python benchmarks/startup.py --runs 10
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+
+CORE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "core")
+
+PROBE = """
+import json, time
+started = time.perf_counter()
+from app import create_app
+imported = time.perf_counter()
+app = create_app()
+created = time.perf_counter()
+response = app.test_client().get("/")
+assert response.status_code == 200, response.status_code
+answered = time.perf_counter()
+print(json.dumps({"import": imported - started, "create_app": created - imported,
+                  "first_request": answered - created, "total": answered - started}))
+"""
+
+
+def main(args):
+    samples = []
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, DATABASE_URL=f"sqlite:///{os.path.join(tmp, 'startup.db')}")
+        for _ in range(args.runs):
+            output = subprocess.run([sys.executable, "-c", PROBE], cwd=CORE, env=env,
+                                    capture_output=True, text=True, check=True).stdout
+            samples.append(json.loads(output.strip().splitlines()[-1]))
+    report = {}
+    for phase in ("import", "create_app", "first_request", "total"):
+        values = [sample[phase] * 1000 for sample in samples]
+        report[f"{phase}_ms"] = {"min": round(min(values), 2),
+                                 "median": round(statistics.median(values), 2),
+                                 "max": round(max(values), 2)}
+    print(json.dumps({"runs": args.runs, **report}, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10)
+    main(parser.parse_args())
@@ -0,0 +1,156 @@
+"""
+Application factory
+
+    app = create_app()                       # config from the environment
+    app = create_app({"TESTING": True, ...})  # with overrides
+
+Building the app does no database work. The schema is created with
+`flask init-db` (or `flask db upgrade` for a migrated database), run from
+the core directory.
+"""
+import offload
+offload.patch()  # no-op unless CHAT_ASYNC_MODE asks for eventlet/gevent
+
+import click
+from flask import Flask, current_app, g
+from flask.cli import with_appcontext
+from config import Config, engine_options, install_sqlite_pragmas
+from models import db
+from hashing import hasher
+from extensions import login_manager, socketio
+from chat_namespace import ChatNamespace
+from write_buffer import message_buffer
+from recent_messages import recent_messages
+from user_cache import user_cache
+from invites import invite_cache
+from search import reindex_command
+from archive import archiver, archive_command
+from read_receipts import read_receipts
+from sessions import sessions
+from retention import pruner, prune_command
+from attachments import attachment_store
+from presence import presence
+from notifications import notifications
+from wire import emit_batcher
+from limits import rate_limiter, slow_consumers
+from metrics import metrics
+
+
+def create_app(config=None):
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    if config:
+        app.config.update(config)
+        if "SQLALCHEMY_DATABASE_URI" in config and "SQLALCHEMY_ENGINE_OPTIONS" not in config:
+            app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(config["SQLALCHEMY_DATABASE_URI"])
+
+    offload.init_app(app)
+    hasher.init_app(app)
+    db.init_app(app)
+    with app.app_context():
+        install_sqlite_pragmas(db.engine, app.config["SQLITE_PRAGMAS"])
+        metrics.init_app(app, db.engine)
+
+    login_manager.init_app(app)
+    sessions.init_app(app)
+    message_buffer.init_app(app)
+    recent_messages.init_app(app)
+    user_cache.init_app(app)
+    invite_cache.init_app(app)
+    attachment_store.init_app(app, socketio)
+    presence.init_app(app)
+    archiver.init_app(app)
+    read_receipts.init_app(app)
+    pruner.init_app(app)
+    notifications.init_app(app, socketio)
+    emit_batcher.init_app(app, socketio)
+    rate_limiter.init_app(app)
+    slow_consumers.init_app(app)
+    chat_namespace = ChatNamespace("/chat")
+    chat_namespace.init_app(app)
+    socketio.on_namespace(chat_namespace)
+    # the HTTP views publish room events through its fan-out
+    app.extensions["chat"] = chat_namespace
+    socketio.init_app(app, async_mode=offload.mode)
+
+    register_gauges()
+
+    from server import bp
+    app.register_blueprint(bp)
+    app.cli.add_command(init_db)
+    app.cli.add_command(migrations)
+    app.cli.add_command(reindex_command)
+    app.cli.add_command(archive_command)
+    app.cli.add_command(prune_command)
+    return app
+
+
+def register_gauges():
+    """
+    process state worth scraping next to the request metrics, once per process
+    """
+    if getattr(register_gauges, "done", False):
+        return
+    register_gauges.done = True
+    metrics.gauge("chat_write_buffer_pending", "messages waiting for the next flush", lambda: len(message_buffer))
+    metrics.gauge("chat_recent_cache_bytes", "estimated size of the recent messages cache",
+                  lambda: recent_messages.size)
+    metrics.counter("chat_write_buffer_dropped_total", "messages given up on after failed flushes",
+                    lambda: message_buffer.dropped)
+    metrics.counter("chat_rate_limited_total", "requests, events and sends turned away by the rate limiter",
+                    lambda: rate_limiter.rejected)
+    metrics.counter("chat_archived_messages_total", "messages this process moved to the archive",
+                    lambda: archiver.archived)
+    metrics.counter("chat_slow_consumers_disconnected_total", "connections cut for not reading",
+                    lambda: slow_consumers.disconnected)
+    metrics.counter("chat_pruned_messages_total", "messages this process deleted for retention",
+                    lambda: pruner.pruned)
+    metrics.gauge("chat_prune_rows_per_second", "pruning rate of the last retention pass", lambda: pruner.rate)
+    metrics.gauge("chat_prune_longest_batch_seconds", "longest pruning transaction of the last pass",
+                  lambda: pruner.longest_batch)
+    metrics.counter("chat_sessions_swept_total", "expired login sessions this process deleted",
+                    lambda: sessions.swept)
+    metrics.gauge("chat_read_receipts_pending", "read receipts waiting for the next flush",
+                  lambda: len(read_receipts))
+    metrics.counter("chat_batch_frames_total", "batched room event frames sent", lambda: emit_batcher.frames)
+
+
+class MigrateGroup(click.Group):
+    """
+    `flask db ...` without importing Flask-Migrate and Alembic on every
+    start, they are only loaded when a db command actually runs
+    """
+
+    def _commands(self):
+        from flask_migrate import Migrate, cli
+        if "migrate" not in current_app.extensions:
+            Migrate(current_app, db, render_as_batch=True)
+        return cli.db
+
+    def list_commands(self, ctx):
+        return self._commands().list_commands(ctx)
+
+    def get_command(self, ctx, name):
+        return self._commands().get_command(ctx, name)
+
+
+@click.group("db", cls=MigrateGroup)
+@click.option("-d", "--directory", default=None,
+              help='Migration script directory (default is "migrations")')
+@click.option("-x", "--x-arg", multiple=True,
+              help="Additional arguments consumed by custom env.py scripts")
+@with_appcontext
+def migrations(directory, x_arg):
+    """Perform database migrations."""
+    # same as flask_migrate.cli.db, Migrate.get_config reads these from g
+    g.directory = directory
+    g.x_arg = x_arg
+
+
+@click.command("init-db")
+def init_db():
+    """
+    creates any missing tables
+    """
+    db.create_all()
+    click.echo("database initialized")
@@ -0,0 +1,344 @@
+"""
+Message archive
+
+Messages older than CHAT_ARCHIVE_AFTER_DAYS leave the message table: the
+archiver moves them, oldest first, into message_segment rows of up to
+CHAT_ARCHIVE_SEGMENT_SIZE messages each, stored as zlib compressed JSON.
+Every segment row keeps its first and last (date, message_id) and its id
+range, so the segment table is a sparse index over the cold history and a
+page of it costs one index range scan plus a decompression. Decoded
+segments are kept in a small LRU, CHAT_ARCHIVE_CACHE_SEGMENTS of them,
+since paging backwards reads the same segment many times in a row.
+
+Because the oldest messages go first, everything cold in a room is older
+than everything hot, and history.fetch_page only has to continue into the
+segments when the hot rows run out. A room's last message always stays hot
+for the dashboard.
+
+The archiver is off unless CHAT_ARCHIVE_AFTER_DAYS is set, because
+archived messages are read-only for their senders: they can not be edited
+or deleted and are no longer in the search index. Moderation still reaches
+them, purge_users rewrites the segments holding a purged user's messages.
+Their room events are dropped with them, Room.archived_event_seq remembers
+how far, and delta sync answers "reset" to clients that were behind that
+point.
+
+The archiver runs every CHAT_ARCHIVE_INTERVAL seconds, at most
+CHAT_ARCHIVE_BATCHES segments per pass, and `flask archive-messages`
+archives everything that is due. Several nodes may run it at once: a batch
+whose messages were already taken by another node is rolled back.
+"""
+import json
+import logging
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import click
+import sqlalchemy as s
+from models import db, Room, Message, MessageSegment
+from offload import run_blocking
+import room_events
+
+
+logger = logging.getLogger(__name__)
+
+CODECS = {
+    "zlib": (lambda raw: zlib.compress(raw, 6), zlib.decompress),
+}
+# position of each payload key in an encoded row, new keys go at the end:
+# rows of older segments are shorter and decode with None for them
+FIELDS = ("id", "sender_id", "body", "date", "attachment", "version", "edited_at", "deleted", "number")
+# segments read at a time by purge_users
+PURGE_PAGE = 20
+
+
+def encode(payloads, codec="zlib"):
+    """
+    message payloads (Message.serialize) as a compressed block
+    """
+    rows = [[payload[field] for field in FIELDS] for payload in payloads]
+    compress, _ = CODECS[codec]
+    return compress(json.dumps(rows, separators=(",", ":")).encode())
+
+
+def decode(data, room_id, codec="zlib"):
+    _, decompress = CODECS[codec]
+    return [dict(zip(FIELDS, row + [None] * (len(FIELDS) - len(row))), room_id=room_id)
+            for row in json.loads(decompress(data))]
+
+
+def sort_key(payload):
+    """
+    the (date, message_id) history order of a payload
+    """
+    return datetime.fromisoformat(payload["date"]), payload["id"]
+
+
+def take_older(payloads, cursor, want):
+    """
+    the newest `want` payloads older than cursor, newest first. payloads are
+    in history order, cursor None means no bound
+    """
+    taken = []
+    for payload in reversed(payloads):
+        if cursor is None or sort_key(payload) < cursor:
+            taken.append(payload)
+            if len(taken) == want:
+                break
+    return taken
+
+
+class SegmentCache:
+    """
+    segment_id -> decoded payloads, segments never change once written
+    """
+
+    def __init__(self, max_size=32):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, segment):
+        with self._lock:
+            payloads = self._entries.get(segment.segment_id)
+            if payloads is not None:
+                self._entries.move_to_end(segment.segment_id)
+                return payloads
+        payloads = decode(segment.data, segment.room_id, segment.codec)
+        with self._lock:
+            self._entries[segment.segment_id] = payloads
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return payloads
+
+    def discard(self, segment_id):
+        with self._lock:
+            self._entries.pop(segment_id, None)
+
+    def discard_room(self, room_id):
+        """
+        drops the room's segments, after a purge rewrote some on any node
+        """
+        with self._lock:
+            for segment_id in [segment_id for segment_id, payloads in self._entries.items()
+                               if payloads and payloads[0]["room_id"] == room_id]:
+                del self._entries[segment_id]
+
+
+segment_cache = SegmentCache()
+
+
+def cold_cursor(room_id, message_id):
+    """
+    (date, message_id) of an archived message, None when it is not archived
+    """
+    segments = db.session.scalars(
+        s.select(MessageSegment).where(
+            MessageSegment.room_id == room_id,
+            MessageSegment.min_message_id <= message_id,
+            MessageSegment.max_message_id >= message_id,
+        )
+    ).all()
+    for segment in segments:
+        for payload in segment_cache.get(segment):
+            if payload["id"] == message_id:
+                return sort_key(payload)
+    return None
+
+
+def older(room_id, cursor, want, batch=4):
+    """
+    up to `want` archived messages older than cursor, newest first
+    """
+    taken = []
+    query = s.select(MessageSegment).where(MessageSegment.room_id == room_id)
+    if cursor is not None:
+        # segments holding at least one message older than the cursor
+        query = query.where(s.tuple_(MessageSegment.first_date, MessageSegment.first_message_id) < cursor)
+    query = query.order_by(MessageSegment.last_date.desc(), MessageSegment.last_message_id.desc())
+    while len(taken) < want:
+        segments = db.session.scalars(query.limit(batch)).all()
+        for segment in segments:
+            taken.extend(take_older(segment_cache.get(segment), cursor, want - len(taken)))
+            if len(taken) == want:
+                return taken
+        if len(segments) < batch:
+            break
+        last = segments[-1]
+        query = query.where(s.tuple_(MessageSegment.last_date, MessageSegment.last_message_id)
+                            < (last.last_date, last.last_message_id))
+    return taken
+
+
+def tombstone(payloads, user_ids):
+    """
+    blanks the payloads sent by user_ids in place, returns how many changed
+    """
+    purged = 0
+    for payload in payloads:
+        if payload["sender_id"] in user_ids and not payload["deleted"]:
+            payload.update(body="", attachment=None, deleted=True, version=payload["version"] + 1)
+            purged += 1
+    return purged
+
+
+def purge_users(room_id, user_ids, page=PURGE_PAGE):
+    """
+    tombstones the archived messages of user_ids in the room, rewriting
+    every segment that holds one, returns how many. Reads the room's
+    segments once, `page` at a time as plain rows, so at most a page of
+    compressed blobs is in memory and none stays in the session. Caller
+    commits
+    """
+    purged = 0
+    after = 0
+    while True:
+        rows = db.session.execute(
+            s.select(MessageSegment.segment_id, MessageSegment.codec, MessageSegment.data)
+            .where(MessageSegment.room_id == room_id, MessageSegment.segment_id > after)
+            .order_by(MessageSegment.segment_id)
+            .limit(page)
+        ).all()
+        if not rows:
+            return purged
+        for segment_id, codec, data in rows:
+            payloads = decode(data, room_id, codec)
+            changed = tombstone(payloads, user_ids)
+            if changed:
+                db.session.execute(
+                    s.update(MessageSegment).where(MessageSegment.segment_id == segment_id)
+                    .values(data=encode(payloads, codec))
+                )
+                segment_cache.discard(segment_id)
+                purged += changed
+        after = rows[-1].segment_id
+
+
+def archive_batch(room_id, cutoff, size, codec="zlib"):
+    """
+    moves the room's oldest messages from before cutoff into one segment and
+    commits, returns how many were moved
+    """
+    last_message = s.select(Room.last_message_id).where(Room.room_id == room_id).scalar_subquery()
+    rows = db.session.scalars(
+        s.select(Message)
+        .where(Message.sent_to_room_id == room_id, Message.date < cutoff,
+               Message.message_id != s.func.coalesce(last_message, 0))
+        .order_by(Message.date, Message.message_id)
+        .limit(size)
+    ).all()
+    if not rows:
+        return 0
+    ids = [row.message_id for row in rows]
+    db.session.add(MessageSegment(
+        room_id=room_id,
+        first_date=rows[0].date, first_message_id=rows[0].message_id,
+        last_date=rows[-1].date, last_message_id=rows[-1].message_id,
+        min_message_id=min(ids), max_message_id=max(ids),
+        count=len(rows), codec=codec, data=encode([row.serialize() for row in rows], codec),
+    ))
+    room_events.drop_events(room_id, ids)
+    deleted = db.session.execute(
+        s.delete(Message).where(Message.message_id.in_(ids)).execution_options(synchronize_session=False)
+    ).rowcount
+    if deleted != len(ids):
+        # another node archived some of them first
+        db.session.rollback()
+        return 0
+    db.session.commit()
+    db.session.expunge_all()
+    return len(rows)
+
+
+class Archiver:
+
+    def __init__(self, after_days=0, segment_size=500, interval=600.0, max_batches=20):
+        self.after_days = after_days
+        self.segment_size = segment_size
+        self.interval = interval
+        self.max_batches = max_batches
+        self.app = None
+        self.archived = 0
+        self._task = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self.after_days = app.config.get("CHAT_ARCHIVE_AFTER_DAYS", self.after_days)
+        self.segment_size = app.config.get("CHAT_ARCHIVE_SEGMENT_SIZE", self.segment_size)
+        self.interval = app.config.get("CHAT_ARCHIVE_INTERVAL", self.interval)
+        self.max_batches = app.config.get("CHAT_ARCHIVE_BATCHES", self.max_batches)
+        segment_cache.max_size = app.config.get("CHAT_ARCHIVE_CACHE_SEGMENTS", segment_cache.max_size)
+
+    def run_once(self, max_batches=None, now=None):
+        """
+        one pass, at most max_batches segments, returns the messages moved.
+        Needs an app context
+        """
+        if not self.after_days:
+            return 0
+        cutoff = (now or datetime.now()) - timedelta(days=self.after_days)
+        budget = self.max_batches if max_batches is None else max_batches
+        room_ids = db.session.scalars(
+            s.select(Room.room_id).where(
+                s.select(Message.message_id)
+                .where(Message.sent_to_room_id == Room.room_id, Message.date < cutoff)
+                .exists()
+            )
+        ).all()
+        moved = 0
+        for room_id in room_ids:
+            while budget:
+                count = archive_batch(room_id, cutoff, self.segment_size)
+                if count == 0:
+                    break
+                budget -= 1
+                moved += count
+                if count < self.segment_size:
+                    break
+            if not budget:
+                break
+        self.archived += moved
+        return moved
+
+    def _pass(self):
+        with self.app.app_context():
+            return self.run_once()
+
+    def run(self, sleep=time.sleep):
+        while True:
+            sleep(self.interval)
+            try:
+                moved = run_blocking(self._pass)
+                if moved:
+                    logger.info("archived %d messages", moved)
+            except Exception:
+                logger.exception("archive pass failed")
+
+    def start(self, socketio):
+        """
+        starts the archive loop once per process
+        """
+        with self._lock:
+            if self._task is None and self.after_days:
+                self._task = socketio.start_background_task(self.run, socketio.sleep)
+
+
+archiver = Archiver()
+
+
+@click.command("archive-messages")
+def archive_command():
+    """
+    archives every message that is due
+    """
+    total = 0
+    while True:
+        moved = archiver.run_once(max_batches=100)
+        if not moved:
+            break
+        total += moved
+        click.echo(f"archived {total} messages")
+    click.echo(f"done, {total} messages archived")
@@ -0,0 +1,211 @@
+"""
+Attachment store
+
+Images, GIFs, sound and video sent to rooms (and room banners) are kept on
+the local filesystem under CHAT_ATTACHMENT_DIR, named by the sha256 of
+their content so that the same file uploaded twice is stored once:
+
+    <dir>/blobs/ab/abcd...       the file
+    <dir>/thumbs/ab/abcd....jpg  its thumbnail, images only
+    <dir>/tmp/                   uploads in progress
+
+Uploads are copied to tmp in CHAT_ATTACHMENT_CHUNK sized chunks while they
+are hashed and then renamed into place, nothing holds a whole file in
+memory. Files are capped at CHAT_ATTACHMENT_MAX_BYTES.
+
+Attachment rows are the references to a blob. The retention pruner deletes
+the rows of pruned messages that nothing else uses and then the blobs with
+no row left, see retention.py. A blob stored or uploaded again in the last
+BLOB_GRACE seconds is kept, its new row may not be committed yet.
+
+Thumbnails are made after the upload has been answered, by at most
+CHAT_THUMBNAIL_WORKERS workers: processes in threading mode, blocking pool
+threads in the green modes. They need Pillow, without it there are none.
+Images over MAX_IMAGE_PIXELS are not decoded at all (a small PNG can claim
+to be gigapixels) and get no thumbnail.
+"""
+import hashlib
+import importlib.util
+import logging
+import os
+import tempfile
+import threading
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+import offload
+
+
+logger = logging.getLogger(__name__)
+
+ALLOWED_TYPES = ("image/", "audio/", "video/")
+# SVG can carry scripts, served from our own origin that is stored XSS
+BLOCKED_TYPES = ("image/svg+xml",)
+BLOB_GRACE = 3600
+# decompression bomb guard for thumbnails, 40 megapixels is a large photo
+MAX_IMAGE_PIXELS = 40_000_000
+
+
+class AttachmentTooLarge(Exception):
+    """
+    raised by save() once the upload goes over max_size
+    """
+
+
+def allowed_type(content_type):
+    return bool(content_type) and content_type.startswith(ALLOWED_TYPES) \
+        and content_type not in BLOCKED_TYPES
+
+
+def make_thumbnail(src, dst, size):
+    """
+    writes a JPEG thumbnail of the image at src to dst, runs in the pool.
+    Returns False for an image too large to decode
+    """
+    from PIL import Image  # optional dependency, see thumbnails_enabled
+    Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dst), suffix=".tmp")
+    try:
+        with warnings.catch_warnings():
+            # Pillow only warns between the limit and twice the limit
+            warnings.simplefilter("error", Image.DecompressionBombWarning)
+            with os.fdopen(fd, "wb") as out, Image.open(src) as image:
+                # lets JPEG decode straight at a reduced scale, no-op for the rest
+                image.draft("RGB", (size, size))
+                image.thumbnail((size, size))
+                image.convert("RGB").save(out, "JPEG", quality=80)
+        os.replace(tmp, dst)
+    except (Image.DecompressionBombError, Image.DecompressionBombWarning):
+        os.unlink(tmp)
+        logger.warning("no thumbnail for %s, over %d pixels", os.path.basename(src), MAX_IMAGE_PIXELS)
+        return False
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return True
+
+
+def _log_failure(future):
+    if future.exception() is not None:
+        logger.error("thumbnail failed", exc_info=future.exception())
+
+
+class AttachmentStore:
+
+    def __init__(self, root=None, max_size=25 * 1024 * 1024, chunk_size=64 * 1024,
+                 thumbnail_size=320, thumbnail_workers=2):
+        self.root = root
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self.thumbnail_size = thumbnail_size
+        self.thumbnail_workers = thumbnail_workers
+        self.thumbnails_enabled = importlib.util.find_spec("PIL") is not None
+        self.socketio = None
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._thumbnail_slots = offload.RealBoundedSemaphore(thumbnail_workers)
+
+    def init_app(self, app, socketio=None):
+        self.root = app.config.get("CHAT_ATTACHMENT_DIR") or os.path.join(app.instance_path, "attachments")
+        self.max_size = app.config.get("CHAT_ATTACHMENT_MAX_BYTES", self.max_size)
+        self.chunk_size = app.config.get("CHAT_ATTACHMENT_CHUNK", self.chunk_size)
+        self.thumbnail_size = app.config.get("CHAT_THUMBNAIL_SIZE", self.thumbnail_size)
+        self.thumbnail_workers = app.config.get("CHAT_THUMBNAIL_WORKERS", self.thumbnail_workers)
+        self._thumbnail_slots = offload.RealBoundedSemaphore(self.thumbnail_workers)
+        self.socketio = socketio
+
+    def path(self, digest):
+        return os.path.join(self.root, "blobs", digest[:2], digest)
+
+    def thumbnail_path(self, digest):
+        return os.path.join(self.root, "thumbs", digest[:2], digest + ".jpg")
+
+    def save(self, stream):
+        """
+        copies the stream into the store chunk by chunk, returns the sha256
+        hex digest and size of the content
+        """
+        tmp_dir = os.path.join(self.root, "tmp")
+        os.makedirs(tmp_dir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=tmp_dir)
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with os.fdopen(fd, "wb") as out:
+                while True:
+                    chunk = stream.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > self.max_size:
+                        raise AttachmentTooLarge()
+                    digest.update(chunk)
+                    out.write(chunk)
+            path = self.path(digest.hexdigest())
+            if os.path.exists(path):
+                # fresh again, see remove
+                os.utime(path)
+                os.unlink(tmp)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        return digest.hexdigest(), size
+
+    def remove(self, digest, grace=BLOB_GRACE):
+        """
+        deletes a blob no attachment row refers to any more, and its
+        thumbnail. Returns False for a blob touched in the last grace seconds
+        """
+        path = self.path(digest)
+        try:
+            if time.time() - os.path.getmtime(path) < grace:
+                return False
+            os.remove(path)
+        except FileNotFoundError:
+            return False
+        try:
+            os.remove(self.thumbnail_path(digest))
+        except FileNotFoundError:
+            pass
+        return True
+
+    def request_thumbnail(self, digest, content_type):
+        """
+        queues a thumbnail for an image and returns straight away
+        """
+        if not self.thumbnails_enabled or not content_type.startswith("image/"):
+            return
+        dst = self.thumbnail_path(digest)
+        if os.path.exists(dst):
+            return
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        args = (self.path(digest), dst, self.thumbnail_size)
+        if offload.mode == "threading":
+            self._executor().submit(make_thumbnail, *args).add_done_callback(_log_failure)
+        else:
+            # a process pool does not mix with monkey patching, a background
+            # green thread hands the work to the blocking pool instead
+            self.socketio.start_background_task(self._thumbnail_in_pool, *args)
+
+    def _thumbnail_in_pool(self, *args):
+        try:
+            offload.run_blocking(self._limited_thumbnail, *args)
+        except Exception:
+            logger.exception("thumbnail failed")
+
+    def _limited_thumbnail(self, *args):
+        with self._thumbnail_slots:
+            make_thumbnail(*args)
+
+    def _executor(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.thumbnail_workers)
+            return self._pool
+
+
+attachment_store = AttachmentStore()
@@ -0,0 +1,294 @@
+"""
+Socket.IO namespace for room traffic
+
+Every room is a Socket.IO room named after Room.room_id, clients join it
+with the "join" event and everything sent to it is broadcast to its members.
+Broadcasts go through the fan-out backend so that they reach the clients of
+every worker, see fanout.py. Who is online and typing is announced in
+batched "presence" events, see presence.py. Clients that negotiate a wire
+format get room events in batched frames instead, see wire.py.
+"""
+from flask import request
+from flask_login import current_user
+from flask_socketio import Namespace, join_room, leave_room, rooms
+import sqlalchemy as s
+from models import db, association_table, Attachment
+from write_buffer import message_buffer, BufferFull
+from recent_messages import recent_messages
+from presence import presence
+from notifications import notifications, user_room
+from archive import archiver, segment_cache
+from read_receipts import read_receipts
+from retention import pruner
+from sessions import sessions
+from wire import emit_batcher, negotiate, channel
+from limits import rate_limiter, slow_consumers, RateLimited
+from fanout import create_fanout
+from user_cache import user_cache
+from offload import run_blocking
+from metrics import metrics
+import history
+import room_events
+
+
+# fan-out "room" of the events every node handles itself, room ids are UUIDs
+NODE_ROOM = ""
+
+
+def payload_error(data):
+    """
+    what is wrong with an event payload from a client, None when nothing:
+    handlers can rely on a dict and a string room_id
+    """
+    if not isinstance(data, dict):
+        return "expected an object"
+    if data.get("room_id") is not None and not isinstance(data["room_id"], str):
+        return "room_id must be a string"
+    return None
+
+
+def is_member(user_id, room_id):
+    """
+    one primary key lookup on the association table
+    """
+    return db.session.scalar(
+        s.select(association_table.c.right_id).where(
+            association_table.c.left_id == user_id,
+            association_table.c.right_id == room_id,
+        )
+    ) is not None
+
+
+def sendable_attachment(attachment_id, user_id, room_id):
+    """
+    payload of an attachment user_id uploaded to room_id, None otherwise
+    """
+    attachment = db.session.get(Attachment, attachment_id)
+    if attachment is None or attachment.uploader_id != user_id or attachment.room_id != room_id:
+        return None
+    return attachment.payload()
+
+
+class ChatNamespace(Namespace):
+    """
+    join/leave/send handlers, mounted on /chat
+    """
+
+    def __init__(self, namespace=None):
+        super().__init__(namespace)
+        self.fanout = None
+        self.wires = {}  # sid -> negotiated wire format, see wire.py
+
+    def init_app(self, app):
+        self.fanout = create_fanout(app.config.get("CHAT_FANOUT_URL", "local"), self.deliver)
+        message_buffer.on_flush = self.publish_messages
+        presence.on_diffs = self.publish_presence
+        pruner.on_pruned = self.publish_pruned
+        user_cache.on_changed = self.publish_users_changed
+
+    def publish_messages(self, payloads):
+        notifications.queue(payloads)
+        self.fanout.publish_many([(p["room_id"], "message", p) for p in payloads])
+
+    def publish_presence(self, diffs):
+        self.fanout.publish_many([(room_id, "presence", diff) for room_id, diff in diffs])
+
+    def publish_pruned(self, room_ids):
+        self.fanout.publish_many([(room_id, "messages_pruned", {"room_id": room_id}) for room_id in room_ids])
+
+    def publish_users_changed(self, user_ids):
+        # not a room event, NODE_ROOM is never joined
+        self.fanout.publish(NODE_ROOM, "users_changed", {"user_ids": user_ids})
+
+    def disconnect_user(self, user_id):
+        """
+        closes the user's sockets on every node, after their sessions were
+        revoked
+        """
+        self.fanout.publish(NODE_ROOM, "sessions_revoked", {"user_id": user_id})
+
+    def deliver(self, room_id, event, payload):
+        """
+        called by the fan-out backend for every event that reaches this node
+        """
+        if room_id == NODE_ROOM:
+            if event == "users_changed":
+                for user_id in payload["user_ids"]:
+                    user_cache.invalidate(user_id)
+            elif event == "sessions_revoked":
+                for sid in presence.sids_of(payload["user_id"]):
+                    self.socketio.server.disconnect(sid, namespace=self.namespace)
+            return
+        if event == "message":
+            recent_messages.append(room_id, payload)
+            notifications.notify(room_id, payload)
+        elif event in ("message_edited", "message_deleted"):
+            recent_messages.replace(room_id, payload)
+        elif event in ("messages_purged", "messages_pruned"):
+            recent_messages.discard(room_id)
+            segment_cache.discard_room(room_id)
+        elif event == "members_removed":
+            notifications.invalidate(room_id)
+        # connections without a wire format get it on its own right away
+        self.socketio.emit(event, payload, to=room_id, namespace=self.namespace)
+        emit_batcher.add(room_id, event, payload)
+        if event == "members_removed":
+            # told first, then taken out of the room
+            emit_batcher.flush()
+            for sid in presence.sids_in(room_id, set(payload["user_ids"])):
+                self.socketio.server.leave_room(sid, channel(room_id, self.wires.get(sid)),
+                                                namespace=self.namespace)
+                presence.leave(sid, room_id)
+
+    def trigger_event(self, event, sid, *args):
+        """
+        every event but connect/disconnect spends from the connection's
+        bucket, and every event is timed, see metrics.py. Handlers get their
+        payload as a dict, anything else is answered with an error here.
+        Runs before the request context exists, hence the sid argument
+        """
+        # event names come from clients, only handled ones get their own series
+        handled = hasattr(self, "on_" + event)
+        with metrics.track("socket", event if handled else "unknown"):
+            if event not in ("connect", "disconnect") and not rate_limiter.allow(("connection", sid)):
+                return {"ok": False, "error": "rate limited"}
+            if handled and event not in ("connect", "disconnect", "heartbeat"):
+                error = payload_error(args[0] if args else None)
+                if error is not None:
+                    return {"ok": False, "error": error}
+            return super().trigger_event(event, sid, *args)
+
+    def in_room(self, room_id):
+        """
+        whether this connection has joined room_id, in its wire's channel
+        """
+        return room_id is not None and channel(room_id, self.wires.get(request.sid)) in rooms()
+
+    def on_connect(self, auth=None):
+        """
+        auth may ask for a wire format, {"wire": "json"|"msgpack"}
+        """
+        if not current_user.is_authenticated:
+            return False
+        self.wires[request.sid] = negotiate(auth.get("wire") if isinstance(auth, dict) else None)
+        message_buffer.start(self.socketio)
+        self.fanout.start(self.socketio)
+        presence.start(self.socketio)
+        slow_consumers.start(self.socketio)
+        notifications.start(self.socketio)
+        archiver.start(self.socketio)
+        read_receipts.start(self.socketio)
+        pruner.start(self.socketio)
+        sessions.start(self.socketio)
+        emit_batcher.start(self.socketio)
+        presence.connect(request.sid, current_user.id)
+        join_room(user_room(current_user.id))
+
+    def on_disconnect(self, *args):
+        presence.disconnect(request.sid)
+        self.wires.pop(request.sid, None)
+        rate_limiter.forget("connection", request.sid)
+
+    def on_heartbeat(self, data=None):
+        presence.heartbeat(request.sid)
+        return {"ok": True}
+
+    def on_typing(self, data):
+        """
+        {"room_id": ..., "typing": true|false}, announced with the next tick
+        """
+        presence.typing(request.sid, data.get("room_id"), bool(data.get("typing", True)))
+        return {"ok": True}
+
+    def on_join(self, data):
+        room_id = data.get("room_id")
+        since = data.get("since")
+        if since is not None and type(since) is not int:
+            return {"ok": False, "error": "since must be a seq"}
+        if not room_id or not run_blocking(is_member, current_user.id, room_id):
+            return {"ok": False, "error": "not a member of this room"}
+        if not presence.join(request.sid, room_id):
+            return {"ok": False, "error": "too many rooms open on this connection"}
+        wire = self.wires.get(request.sid)
+        join_room(channel(room_id, wire))
+        online = presence.online(room_id)
+        if since is not None:
+            # a reconnect, only what changed while the client was away
+            delta = run_blocking(room_events.delta, room_id, since)
+            if not delta.get("reset"):
+                return {"ok": True, "delta": delta, "online": online, "wire": wire}
+        # read before the snapshot: events between the two are sent again
+        # later, which clients absorb through the message version
+        seq = run_blocking(room_events.latest_seq, room_id)
+        messages, next_before = recent_messages.get(room_id, history.load_recent)
+        return {"ok": True, "messages": messages, "next_before": next_before,
+                "seq": seq, "online": online, "wire": wire}
+
+    def on_read(self, data):
+        """
+        the client has read the room up to message "number", or all of it
+        without one. Coalesced and written later, see read_receipts.py
+        """
+        room_id = data.get("room_id")
+        number = data.get("number")
+        if number is not None and (type(number) is not int or number < 0):
+            return {"ok": False, "error": "number must be a message number"}
+        if self.in_room(room_id):
+            read_receipts.mark(current_user.id, room_id, number)
+        return {"ok": True}
+
+    def on_edit(self, data):
+        """
+        {"message_id": ..., "body": ...}, senders only
+        """
+        body = data.get("body")
+        body = body.strip() if isinstance(body, str) else ""
+        if not body:
+            return {"ok": False, "error": "empty message"}
+        return self._change(room_events.edit_message, data.get("message_id"), "message_edited", body)
+
+    def on_delete(self, data):
+        return self._change(room_events.delete_message, data.get("message_id"), "message_deleted")
+
+    def _change(self, change, message_id, event, *args):
+        try:
+            rate_limiter.check(("user", current_user.id))
+        except RateLimited as error:
+            return {"ok": False, "error": "rate limited", "retry_after": error.retry_after}
+        payload = run_blocking(change, message_id, current_user.id, *args)
+        if payload is None:
+            return {"ok": False, "error": "no such message"}
+        self.fanout.publish(payload["room_id"], event, payload)
+        return {"ok": True, "seq": payload["seq"]}
+
+    def on_leave(self, data):
+        room_id = data.get("room_id")
+        if self.in_room(room_id):
+            leave_room(channel(room_id, self.wires.get(request.sid)))
+            presence.leave(request.sid, room_id)
+        return {"ok": True}
+
+    def on_send(self, data):
+        room_id = data.get("room_id")
+        body = data.get("body")
+        body = body.strip() if isinstance(body, str) else ""
+        if not self.in_room(room_id):
+            return {"ok": False, "error": "join the room first"}
+        attachment = None
+        if data.get("attachment_id"):
+            attachment = run_blocking(sendable_attachment, data["attachment_id"], current_user.id, room_id)
+            if attachment is None:
+                return {"ok": False, "error": "unknown attachment"}
+        if not body and attachment is None:
+            return {"ok": False, "error": "empty message"}
+        try:
+            rate_limiter.check(("user", current_user.id), ("room", room_id))
+        except RateLimited as error:
+            return {"ok": False, "error": "rate limited", "retry_after": error.retry_after}
+        presence.typing(request.sid, room_id, False)
+        # broadcast once the buffer has flushed it and it has an id
+        try:
+            message_buffer.add(room_id, current_user.id, body, attachment)
+        except BufferFull:
+            return {"ok": False, "error": "server busy", "retry_after": 1}
+        return {"ok": True}
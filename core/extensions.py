@@ -0,0 +1,9 @@
+"""
+Flask extensions, created unbound and attached to the app in app.create_app
+"""
+from flask_login import LoginManager
+from flask_socketio import SocketIO
+
+
+socketio = SocketIO()
+login_manager = LoginManager()
@@ -0,0 +1,198 @@
+"""
+Room event fan-out
+
+Every room event is published here instead of being emitted directly, and
+each node delivers what it receives to its own connected clients. Backends:
+
+    local             single process, delivers in place
+    sqlite:///<path>  shared append-only log in a SQLite file, polled by
+                      every node, works for several workers on one machine
+    redis://...       Redis pub/sub, needs the redis package
+
+All nodes see the events of a room in the same order: the SQLite backend
+delivers in log sequence order and Redis keeps publish order per channel.
+"""
+import json
+import logging
+from abc import ABC, abstractmethod
+import sqlite3
+import threading
+import time
+from offload import run_blocking, RealLock
+
+
+logger = logging.getLogger(__name__)
+
+
+class Fanout(ABC):
+    """
+    base backend, `deliver(room_id, event, payload)` is called for every
+    event that reaches this node
+    """
+
+    def __init__(self, deliver=None):
+        self.deliver = deliver
+        self._task = None
+        self._lock = threading.Lock()
+
+    def publish(self, room_id, event, payload):
+        self.publish_many([(room_id, event, payload)])
+
+    @abstractmethod
+    def publish_many(self, events):
+        """
+        sends (room_id, event, payload) triples to every node
+        """
+
+    def run(self, sleep=time.sleep):
+        pass
+
+    def start(self, socketio=None):
+        """
+        starts the receive loop once per process
+        """
+        with self._lock:
+            if self._task is not None:
+                return
+            if socketio is not None:
+                self._task = socketio.start_background_task(self.run, socketio.sleep)
+            else:
+                self._task = threading.Thread(target=self.run, daemon=True)
+                self._task.start()
+
+    def _dispatch(self, room_id, event, payload):
+        try:
+            self.deliver(room_id, event, payload)
+        except Exception:
+            logger.exception("delivering %s to room %s failed", event, room_id)
+
+
+class LocalFanout(Fanout):
+    """
+    in-process backend, for a single worker
+    """
+
+    def publish_many(self, events):
+        for room_id, event, payload in events:
+            self._dispatch(room_id, event, payload)
+
+    def start(self, socketio=None):
+        pass
+
+
+class SQLiteFanout(Fanout):
+    """
+    nodes append events to a shared log table and poll it for new rows
+    """
+
+    def __init__(self, path, deliver=None, poll_interval=0.02, retention=60.0):
+        super().__init__(deliver)
+        self.path = path
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self._conn = self._connect()
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS fanout_log ("
+            "seq INTEGER PRIMARY KEY AUTOINCREMENT, room_id TEXT NOT NULL, "
+            "event TEXT NOT NULL, payload TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        # a node only delivers what was published after it came up
+        self.last_seq = self._conn.execute("SELECT coalesce(max(seq), 0) FROM fanout_log").fetchone()[0]
+        self._write_lock = RealLock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        # the log is transient, losing the tail on a power cut is acceptable
+        conn.execute("PRAGMA synchronous=OFF")
+        return conn
+
+    def publish_many(self, events):
+        now = time.time()
+        rows = [(room_id, event, json.dumps(payload), now) for room_id, event, payload in events]
+        run_blocking(self._append, rows)
+
+    def _append(self, rows):
+        with self._write_lock:
+            self._conn.executemany(
+                "INSERT INTO fanout_log (room_id, event, payload, created) VALUES (?, ?, ?, ?)", rows
+            )
+
+    def poll(self, conn=None, limit=500):
+        """
+        delivers every row after last_seq in sequence order, returns the count
+        """
+        conn = conn or self._conn
+        # the read is offloaded, delivery stays on the calling (green) thread
+        rows = run_blocking(self._fetch, conn, limit)
+        for seq, room_id, event, payload in rows:
+            self.last_seq = seq
+            self._dispatch(room_id, event, json.loads(payload))
+        return len(rows)
+
+    def _fetch(self, conn, limit):
+        return conn.execute(
+            "SELECT seq, room_id, event, payload FROM fanout_log WHERE seq > ? ORDER BY seq LIMIT ?",
+            (self.last_seq, limit),
+        ).fetchall()
+
+    def trim(self, conn=None):
+        conn = conn or self._conn
+        with self._write_lock:
+            conn.execute("DELETE FROM fanout_log WHERE created < ?", (time.time() - self.retention,))
+
+    def run(self, sleep=time.sleep):
+        conn = self._connect()
+        last_trim = time.monotonic()
+        while True:
+            try:
+                if self.poll(conn) == 0:
+                    sleep(self.poll_interval)
+                if time.monotonic() - last_trim > self.retention:
+                    run_blocking(self.trim, conn)
+                    last_trim = time.monotonic()
+            except sqlite3.OperationalError:
+                logger.exception("fanout poll failed")
+                sleep(self.poll_interval)
+
+
+class RedisFanout(Fanout):
+    """
+    Redis pub/sub, one channel for all rooms so a single subscriber keeps order
+    """
+
+    def __init__(self, url, deliver=None, channel="chat-fanout"):
+        super().__init__(deliver)
+        import redis  # optional dependency, only needed for this backend
+        self.channel = channel
+        self._redis = redis.Redis.from_url(url)
+
+    def publish_many(self, events):
+        pipe = self._redis.pipeline(transaction=False)
+        for room_id, event, payload in events:
+            pipe.publish(self.channel, json.dumps([room_id, event, payload]))
+        pipe.execute()
+
+    def run(self, sleep=time.sleep):
+        pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.channel)
+        while True:
+            message = pubsub.get_message(timeout=1.0)
+            if message is None:
+                sleep(0)
+                continue
+            room_id, event, payload = json.loads(message["data"])
+            self._dispatch(room_id, event, payload)
+
+
+def create_fanout(url, deliver=None):
+    """
+    builds the backend named by CHAT_FANOUT_URL
+    """
+    if not url or url == "local":
+        return LocalFanout(deliver)
+    if url.startswith("sqlite:///"):
+        return SQLiteFanout(url[len("sqlite:///"):], deliver)
+    if url.startswith(("redis://", "rediss://")):
+        return RedisFanout(url, deliver)
+    raise ValueError(f"unknown fanout backend: {url}")
@@ -1,5 +1,6 @@
-from random import choice
+import secrets
 import string
 
-def gen_link(lenght=8, chars=string.ascii_letters + string.digits):
-    return ''.join([choice(chars) for i in range(lenght)])
\ No newline at end of file
+def gen_link(lenght=10, chars=string.ascii_letters + string.digits):
+    # secrets, not random: invite codes are the only thing guarding a room
+    return ''.join([secrets.choice(chars) for i in range(lenght)])
@@ -0,0 +1,106 @@
+"""
+Password hashing service
+
+Password hashes are slow on purpose, so they are kept off the request
+threads: in threading mode they run in a process pool, in the green modes
+on the blocking thread pool (hashlib releases the GIL while it hashes).
+At most CHAT_HASH_CPU_SHARE of the machine's cores hash at the same time,
+a request that can not get a slot within CHAT_HASH_WAIT seconds gets
+HashingBusy instead of queueing forever.
+
+CHAT_HASH_METHOD is any werkzeug method string. Hashes made with other
+parameters are upgraded on the next successful login, see needs_rehash.
+The settings come from the app config, see init_app.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
+import offload
+
+# what werkzeug fills in for the parts a method string leaves out
+SCRYPT_DEFAULTS = ("scrypt", "32768", "8", "1")
+
+
+class HashingBusy(Exception):
+    """
+    raised when every hashing slot stays taken for longer than the wait
+    """
+
+
+def _hash(secret, method):
+    return generate_password_hash(secret, method=method)
+
+
+def _verify(pwhash, secret):
+    return check_password_hash(pwhash, secret)
+
+
+def parameters(method):
+    """
+    a werkzeug method string with the defaults filled in, as a tuple:
+    "scrypt" -> ("scrypt", "32768", "8", "1"), "pbkdf2" -> ("pbkdf2",
+    "sha256", "<DEFAULT_PBKDF2_ITERATIONS>"). A stored hash starts with the
+    full method string of the hash, "<method>$<salt>$<hash>"
+    """
+    parts = tuple(method.split(":"))
+    if parts[0] == "scrypt":
+        return parts + SCRYPT_DEFAULTS[len(parts):]
+    if parts[0] == "pbkdf2":
+        return parts + ("pbkdf2", "sha256", str(DEFAULT_PBKDF2_ITERATIONS))[len(parts):]
+    return parts
+
+
+class PasswordHasher:
+
+    def __init__(self, method="scrypt:32768:8:1", cpu_share=0.5, wait=2.0):
+        self.method = method
+        self.wait = wait
+        self._pool = None
+        self._pool_lock = offload.RealLock()
+        self._set_slots(cpu_share)
+
+    def init_app(self, app):
+        self.method = app.config.get("CHAT_HASH_METHOD", self.method)
+        self.wait = app.config.get("CHAT_HASH_WAIT", self.wait)
+        if "CHAT_HASH_CPU_SHARE" in app.config:
+            self._set_slots(app.config["CHAT_HASH_CPU_SHARE"])
+
+    def _set_slots(self, cpu_share):
+        self.slots = max(1, int((os.cpu_count() or 1) * cpu_share))
+        # only ever touched from inside run_blocking, hence the real primitives
+        self._admission = offload.RealBoundedSemaphore(self.slots)
+
+    def _run(self, fn, *args):
+        return offload.run_blocking(self._admitted, fn, *args)
+
+    def _admitted(self, fn, *args):
+        if not self._admission.acquire(timeout=self.wait):
+            raise HashingBusy()
+        try:
+            if offload.mode == "threading":
+                return self._executor().submit(fn, *args).result()
+            return fn(*args)
+        finally:
+            self._admission.release()
+
+    def _executor(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.slots)
+            return self._pool
+
+    def hash(self, secret):
+        return self._run(_hash, secret, self.method)
+
+    def verify(self, pwhash, secret):
+        return self._run(_verify, pwhash, secret)
+
+    def needs_rehash(self, pwhash):
+        """
+        true when the stored hash was made with another method or cost, read
+        from the hash itself
+        """
+        return parameters(pwhash.split("$", 1)[0]) != parameters(self.method)
+
+
+hasher = PasswordHasher()
@@ -0,0 +1,69 @@
+"""
+Room history
+
+Pages through a room's messages newest first using a keyset cursor on
+(date, message_id), so every page is an index range scan on
+ix_message_room_date no matter how long the room has existed. Once the hot
+rows run out the page continues into the archived segments, see archive.py.
+"""
+import sqlalchemy as s
+from models import db, Message
+from write_buffer import message_buffer
+from offload import run_blocking
+import archive
+
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def clamp_limit(limit):
+    if limit is None:
+        return DEFAULT_PAGE_SIZE
+    return max(1, min(int(limit), MAX_PAGE_SIZE))
+
+
+def fetch_page(room_id, before=None, limit=None):
+    """
+    returns up to `limit` messages older than the message id `before`,
+    in chronological order, plus the cursor for the next (older) page
+    """
+    limit = clamp_limit(limit)
+    query = s.select(Message).where(Message.sent_to_room_id == room_id)
+    cursor = None
+    if before is not None:
+        cursor = db.session.execute(
+            s.select(Message.date, Message.message_id).where(
+                Message.message_id == before,
+                Message.sent_to_room_id == room_id,
+            )
+        ).first()
+        if cursor is None:
+            cursor = archive.cold_cursor(room_id, before)
+            if cursor is None:
+                return [], None
+        cursor = tuple(cursor)
+        query = query.where(s.tuple_(Message.date, Message.message_id) < cursor)
+    # one extra row tells us whether there is an older page
+    rows = db.session.scalars(
+        query.order_by(Message.date.desc(), Message.message_id.desc()).limit(limit + 1)
+    ).all()
+    messages = [row.serialize() for row in rows]
+    if len(rows) <= limit:
+        # everything archived is older than every hot row
+        older_than = (rows[-1].date, rows[-1].message_id) if rows else cursor
+        messages += archive.older(room_id, older_than, limit + 1 - len(rows))
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    messages.reverse()
+    next_before = messages[0]["id"] if has_more else None
+    return messages, next_before
+
+
+def load_recent(room_id, limit):
+    """
+    loader for the recent messages cache, flushes first so that rows still
+    sitting in the write buffer are part of the page
+    """
+    message_buffer.flush()
+    return run_blocking(fetch_page, room_id, limit=limit)
@@ -0,0 +1,72 @@
+"""
+Invite codes
+
+Every room gets a random code from gen_link, stored in the unique indexed
+Room.invite_code column. With 62^10 possible codes a fresh code is almost
+never taken, so creating one costs one index lookup on average however many
+rooms exist. Resolving a code goes through a small LRU cache so that a burst
+of joins after a link is posted does not turn into a burst of room lookups.
+"""
+import threading
+from collections import OrderedDict
+import sqlalchemy as s
+from models import db, Room
+from gen_link import gen_link
+
+
+MAX_ATTEMPTS = 8
+
+
+def new_invite_code():
+    """
+    a code no room is using yet, the unique index still guards against a
+    concurrent room grabbing the same one
+    """
+    for _ in range(MAX_ATTEMPTS):
+        code = gen_link()
+        taken = db.session.scalar(s.select(Room.room_id).where(Room.invite_code == code))
+        if taken is None:
+            return code
+    raise RuntimeError("could not find a free invite code")
+
+
+def code_from_url(url):
+    """
+    accepts a full invite link or just the code
+    """
+    return url.strip().rstrip("/").rsplit("/", 1)[-1]
+
+
+class InviteCache:
+    """
+    code -> (room_id, room_name), only hits are cached
+    """
+
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.max_size = app.config.get("CHAT_INVITE_CACHE_SIZE", self.max_size)
+
+    def resolve(self, code):
+        with self._lock:
+            entry = self._entries.get(code)
+            if entry is not None:
+                self._entries.move_to_end(code)
+                return entry
+        row = db.session.execute(
+            s.select(Room.room_id, Room.room_name).where(Room.invite_code == code)
+        ).first()
+        if row is None:
+            return None
+        entry = tuple(row)
+        with self._lock:
+            self._entries[code] = entry
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return entry
+
+
+invite_cache = InviteCache()
@@ -0,0 +1,153 @@
+"""
+Rate limits and outbound backpressure
+
+Token buckets, refilled continuously at `rate` tokens per second up to
+`burst`. The scopes and their defaults (rate, burst):
+
+    connection  CHAT_RATE_CONNECTION  (20, 40)   every socket event of a connection
+    user        CHAT_RATE_USER        (5, 10)    messages a user sends, over all connections
+    room        CHAT_RATE_ROOM        (50, 100)  messages sent to one room
+    http        CHAT_RATE_HTTP        (20, 60)   HTTP requests per user, per address when signed out
+
+Buckets for idle keys are dropped LRU first past CHAT_RATE_MAX_KEYS.
+
+SlowConsumerGuard bounds what the server buffers for each client: every
+CHAT_OUTBOUND_CHECK seconds it disconnects the connections whose outgoing
+queue holds more than CHAT_OUTBOUND_MAX packets. A disconnected client
+reconnects and catches up from the room's history on join.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LIMITS = {
+    "connection": (20.0, 40.0),
+    "user": (5.0, 10.0),
+    "room": (50.0, 100.0),
+    "http": (20.0, 60.0),
+}
+
+
+class RateLimited(Exception):
+    """
+    raised by RateLimiter.check, retry_after is in seconds
+    """
+
+    def __init__(self, retry_after):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens, updated):
+        self.tokens = tokens
+        self.updated = updated
+
+    def refill(self, rate, burst, now):
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+
+class RateLimiter:
+
+    def __init__(self, limits=None, max_keys=100000):
+        self.limits = dict(DEFAULT_LIMITS, **(limits or {}))
+        self.max_keys = max_keys
+        self.rejected = 0
+        self._buckets = OrderedDict()  # (scope, key) -> TokenBucket
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        for scope in DEFAULT_LIMITS:
+            self.limits[scope] = app.config.get(f"CHAT_RATE_{scope.upper()}", self.limits[scope])
+        self.max_keys = app.config.get("CHAT_RATE_MAX_KEYS", self.max_keys)
+
+    def _bucket(self, scope, key, now):
+        rate, burst = self.limits[scope]
+        bucket = self._buckets.get((scope, key))
+        if bucket is None:
+            bucket = self._buckets[(scope, key)] = TokenBucket(burst, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end((scope, key))
+            bucket.refill(rate, burst, now)
+        return bucket
+
+    def check(self, *keys, cost=1.0, now=None):
+        """
+        takes `cost` tokens from each (scope, key) bucket, or from none of
+        them and raises RateLimited when any is short
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            buckets = [(self.limits[scope][0], self._bucket(scope, key, now)) for scope, key in keys]
+            short = [(cost - bucket.tokens) / rate for rate, bucket in buckets if bucket.tokens < cost]
+            if short:
+                self.rejected += 1
+                raise RateLimited(max(short))
+            for _, bucket in buckets:
+                bucket.tokens -= cost
+
+    def allow(self, *keys, cost=1.0, now=None):
+        try:
+            self.check(*keys, cost=cost, now=now)
+        except RateLimited:
+            return False
+        return True
+
+    def forget(self, scope, key):
+        with self._lock:
+            self._buckets.pop((scope, key), None)
+
+
+class SlowConsumerGuard:
+    """
+    disconnects clients that do not read what is sent to them
+    """
+
+    def __init__(self, max_queued=1000, interval=1.0):
+        self.max_queued = max_queued
+        self.interval = interval
+        self.disconnected = 0
+        self._task = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.max_queued = app.config.get("CHAT_OUTBOUND_MAX", self.max_queued)
+        self.interval = app.config.get("CHAT_OUTBOUND_CHECK", self.interval)
+
+    def sweep(self, eio):
+        """
+        one pass over the Engine.IO server's sockets, returns how many were cut
+        """
+        slow = [sid for sid, socket in list(eio.sockets.items())
+                if socket.queue.qsize() > self.max_queued]
+        for sid in slow:
+            logger.warning("disconnecting slow consumer %s", sid)
+            eio.disconnect(sid)
+        self.disconnected += len(slow)
+        return len(slow)
+
+    def run(self, socketio, sleep=time.sleep):
+        while True:
+            sleep(self.interval)
+            try:
+                self.sweep(socketio.server.eio)
+            except Exception:
+                logger.exception("slow consumer sweep failed")
+
+    def start(self, socketio):
+        with self._lock:
+            if self._task is None:
+                self._task = socketio.start_background_task(self.run, socketio, socketio.sleep)
+
+
+rate_limiter = RateLimiter()
+slow_consumers = SlowConsumerGuard()
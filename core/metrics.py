@@ -0,0 +1,356 @@
+"""
+Request and event instrumentation
+
+Every HTTP request and every Socket.IO event is a unit of work: its latency
+goes into a histogram per endpoint (chat_http_request_seconds) or per event
+(chat_socket_event_seconds), and the SQL statements it runs, counted by
+SQLAlchemy engine events, into chat_unit_sql_statements and
+chat_unit_sql_seconds. A unit that runs more than CHAT_SQL_WARN_STATEMENTS
+statements is logged as a likely N+1. Everything is served in the
+Prometheus text format on /metrics, to scrapers that send CHAT_METRICS_TOKEN
+as a bearer token; without a token set the endpoint is off.
+
+Recording is a bisect and an add under a short lock, there is no work on
+the hot path beyond that. Histograms are cumulative since process start.
+
+Slow unit profiler: with CHAT_PROFILE_SLOW_MS set, a sampler thread looks
+at the stack of every thread running a unit every CHAT_PROFILE_INTERVAL
+seconds, and units slower than the threshold are written to
+CHAT_PROFILE_DIR (instance/profiles by default) as collapsed stacks, one
+"frame;frame;frame count" line each, ready for flamegraph.pl or
+speedscope. It only samples OS threads, so it is for the threading mode.
+"""
+import bisect
+import contextvars
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter as StackCounter
+from contextlib import contextmanager
+import offload
+
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def _labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}  # label values -> [per bucket counts, sum]
+        # observed from inside run_blocking too, hence the real lock
+        self._lock = offload.RealLock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = [(values, list(counts), total) for values, (counts, total) in self._series.items()]
+        for values, counts, total in sorted(series):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = 'le="%s"' % (bound if bound == "+Inf" else _number(float(bound)))
+                lines.append(f"{self.name}_bucket{_labels(self.labels, values, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, values)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labels, values)} {cumulative}")
+        return lines
+
+
+class Counter:
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = offload.RealLock()
+
+    def inc(self, amount=1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        lines.extend(f"{self.name}{_labels(self.labels, labels)} {_number(value)}" for labels, value in values)
+        return lines
+
+
+class Gauge:
+    """
+    read when scraped, fn returns the current value
+    """
+    type = "gauge"
+
+    def __init__(self, name, help, fn):
+        self.name = name
+        self.help = help
+        self.fn = fn
+
+    def render(self):
+        try:
+            value = self.fn()
+        except Exception:
+            logger.exception("gauge %s failed", self.name)
+            return []
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}",
+                f"{self.name} {_number(value)}"]
+
+
+class ReadCounter(Gauge):
+    """
+    a running total kept by a service, read when scraped. fn must never
+    go down
+    """
+    type = "counter"
+
+
+class Unit:
+    """
+    one request or socket event in flight
+    """
+    __slots__ = ("kind", "name", "started", "statements", "sql_seconds", "samples")
+
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.sql_seconds = 0.0
+        self.samples = None
+
+
+# the unit the current request or event belongs to. run_blocking copies the
+# context, so statements run on the blocking pool are still counted
+_current = contextvars.ContextVar("chat_metrics_unit", default=None)
+
+
+def collapse(frame):
+    """
+    a stack as "outermost;...;innermost", the collapsed stack format
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class SlowUnitProfiler:
+    """
+    samples the stacks of running units, keeps the ones of slow units
+    """
+
+    def __init__(self, threshold=None, interval=0.005, directory=None):
+        self.threshold = threshold  # seconds, None when off
+        self.interval = interval
+        self.directory = directory
+        self.dumped = 0
+        self._active = {}  # thread ident -> Unit
+        self._task = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        slow_ms = app.config.get("CHAT_PROFILE_SLOW_MS")
+        self.threshold = slow_ms / 1000 if slow_ms else None
+        self.interval = app.config.get("CHAT_PROFILE_INTERVAL", self.interval)
+        self.directory = app.config.get("CHAT_PROFILE_DIR") or os.path.join(app.instance_path, "profiles")
+        if self.threshold is not None and offload.mode != "threading":
+            logger.warning("the slow unit profiler only samples OS threads, it is off in %s mode", offload.mode)
+            self.threshold = None
+
+    def begin(self, unit):
+        if self.threshold is None:
+            return
+        self.start()
+        unit.samples = StackCounter()
+        self._active[threading.get_ident()] = unit
+
+    def end(self, unit, elapsed):
+        if unit.samples is None:
+            return
+        self._active.pop(threading.get_ident(), None)
+        if elapsed >= self.threshold and unit.samples:
+            self.dump(unit, elapsed)
+
+    def dump(self, unit, elapsed):
+        os.makedirs(self.directory, exist_ok=True)
+        name = "".join(c if c.isalnum() or c in "-_." else "_" for c in unit.name)
+        path = os.path.join(self.directory, f"{unit.kind}-{name}-{int(time.time() * 1000)}-{int(elapsed * 1000)}ms.folded")
+        with open(path, "w") as out:
+            out.writelines(f"{stack} {count}\n" for stack, count in unit.samples.most_common())
+        self.dumped += 1
+        logger.warning("slow %s %s took %.0f ms, stacks in %s", unit.kind, unit.name, elapsed * 1000, path)
+
+    def sample(self):
+        frames = sys._current_frames()
+        for ident, unit in list(self._active.items()):
+            frame = frames.get(ident)
+            if frame is not None:
+                unit.samples[collapse(frame)] += 1
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.sample()
+
+    def start(self):
+        with self._lock:
+            if self._task is None:
+                self._task = threading.Thread(target=self.run, name="slow-unit-profiler", daemon=True)
+                self._task.start()
+
+
+class Metrics:
+    """
+    the registry, plus the Flask and SQLAlchemy hooks that feed it
+    """
+
+    def __init__(self):
+        self.warn_statements = 50
+        self.profiler = SlowUnitProfiler()
+        self.latency = {
+            "http": Histogram("chat_http_request_seconds", "HTTP request latency", ("endpoint",)),
+            "socket": Histogram("chat_socket_event_seconds", "Socket.IO event handler latency", ("event",)),
+        }
+        self.unit_statements = Histogram("chat_unit_sql_statements", "SQL statements per request or event",
+                                         ("kind", "name"), STATEMENT_BUCKETS)
+        self.unit_sql_seconds = Histogram("chat_unit_sql_seconds", "time in SQL per request or event",
+                                          ("kind", "name"))
+        self.statements = Counter("chat_sql_statements_total", "SQL statements run, in units or not")
+        self.sql_seconds = Counter("chat_sql_seconds_total", "time spent in SQL statements")
+        self.n_plus_one = Counter("chat_sql_statement_warnings_total",
+                                  "units over CHAT_SQL_WARN_STATEMENTS statements", ("kind", "name"))
+        self._metrics = [*self.latency.values(), self.unit_statements, self.unit_sql_seconds,
+                         self.statements, self.sql_seconds, self.n_plus_one]
+
+    def init_app(self, app, engine):
+        self.warn_statements = app.config.get("CHAT_SQL_WARN_STATEMENTS", self.warn_statements)
+        self.profiler.init_app(app)
+        self.instrument_engine(engine)
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name, help, fn):
+        return self.register(Gauge(name, help, fn))
+
+    def counter(self, name, help, fn):
+        """
+        a total some service counts itself, name ends in _total
+        """
+        return self.register(ReadCounter(name, help, fn))
+
+    # units
+
+    def begin(self, kind, name):
+        unit = Unit(kind, name)
+        self.profiler.begin(unit)
+        return unit, _current.set(unit)
+
+    def end(self, unit, token):
+        elapsed = time.perf_counter() - unit.started
+        try:
+            _current.reset(token)
+        except ValueError:
+            # ended from another context than the one it began in
+            _current.set(None)
+        self.profiler.end(unit, elapsed)
+        self.latency[unit.kind].observe(elapsed, unit.name)
+        self.unit_statements.observe(unit.statements, unit.kind, unit.name)
+        self.unit_sql_seconds.observe(unit.sql_seconds, unit.kind, unit.name)
+        if unit.statements > self.warn_statements:
+            self.n_plus_one.inc(1, unit.kind, unit.name)
+            logger.warning("%s %s ran %d SQL statements (%.1f ms), likely an N+1",
+                           unit.kind, unit.name, unit.statements, unit.sql_seconds * 1000)
+
+    @contextmanager
+    def track(self, kind, name):
+        """
+        wraps a unit of work that is not an HTTP request
+        """
+        unit, token = self.begin(kind, name)
+        try:
+            yield unit
+        finally:
+            self.end(unit, token)
+
+    def _before_request(self):
+        from flask import g, request
+        # unmatched URLs share one series, the label set stays bounded
+        g.metrics_unit = self.begin("http", request.endpoint or "unmatched")
+
+    def _teardown_request(self, error=None):
+        from flask import g
+        started = g.pop("metrics_unit", None)
+        if started is not None:
+            self.end(*started)
+
+    # SQL
+
+    def instrument_engine(self, engine):
+        from sqlalchemy import event
+        event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+
+    @staticmethod
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info["metrics_started"] = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.pop("metrics_started", None)
+        elapsed = time.perf_counter() - started if started is not None else 0.0
+        self.statements.inc()
+        self.sql_seconds.inc(elapsed)
+        unit = _current.get()
+        if unit is not None:
+            unit.statements += 1
+            unit.sql_seconds += elapsed
+
+    # exposition
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
@@ -0,0 +1,67 @@
+"""per room message numbers and membership read watermarks
+
+Revision ID: a2d6e9c3f147
+Revises: f1c4a7d2e058
+Create Date: 2026-10-19 00:41:53.208317
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a2d6e9c3f147'
+down_revision = 'f1c4a7d2e058'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('room', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('message_count', sa.Integer(), server_default='0', nullable=False))
+
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('number', sa.Integer(), nullable=True))
+
+    with op.batch_alter_table('association_table', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('last_read_number', sa.Integer(), server_default='0', nullable=False))
+
+    # backfill, numbers follow the message ids and every member keeps what
+    # they had read. Archived messages are left out, they are all older
+    op.execute(
+        "UPDATE message SET number = numbered.n FROM ("
+        "SELECT message_id, row_number() OVER (PARTITION BY sent_to_room_id ORDER BY message_id) AS n "
+        "FROM message) AS numbered WHERE message.message_id = numbered.message_id"
+    )
+    op.execute(
+        "UPDATE room SET message_count = coalesce("
+        "(SELECT max(number) FROM message WHERE sent_to_room_id = room.room_id), 0)"
+    )
+    op.execute(
+        "UPDATE association_table SET last_read_number = coalesce("
+        "(SELECT max(number) FROM message WHERE sent_to_room_id = association_table.right_id "
+        "AND message_id <= association_table.last_read_message_id), 0)"
+    )
+
+    with op.batch_alter_table('association_table', schema=None) as batch_op:
+        batch_op.drop_column('last_read_message_id')
+
+
+def downgrade():
+    with op.batch_alter_table('association_table', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('last_read_message_id', sa.Integer(), server_default='0', nullable=False))
+
+    op.execute(
+        "UPDATE association_table SET last_read_message_id = coalesce("
+        "(SELECT max(message_id) FROM message WHERE sent_to_room_id = association_table.right_id "
+        "AND number <= association_table.last_read_number), 0)"
+    )
+
+    with op.batch_alter_table('association_table', schema=None) as batch_op:
+        batch_op.drop_column('last_read_number')
+
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.drop_column('number')
+
+    with op.batch_alter_table('room', schema=None) as batch_op:
+        batch_op.drop_column('message_count')
@@ -0,0 +1,52 @@
+"""attachments for messages and room banners
+
+Revision ID: a9d4c7e1f358
+Revises: f5c3a8d2b917
+Create Date: 2026-10-18 20:11:47.530964
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a9d4c7e1f358'
+down_revision = 'f5c3a8d2b917'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('attachment',
+    sa.Column('attachment_id', sa.String(), nullable=False),
+    sa.Column('sha256', sa.String(length=64), nullable=False),
+    sa.Column('size', sa.Integer(), nullable=False),
+    sa.Column('content_type', sa.String(length=127), nullable=False),
+    sa.Column('filename', sa.String(length=255), nullable=True),
+    sa.Column('uploader_id', sa.String(), nullable=False),
+    sa.Column('room_id', sa.String(), nullable=True),
+    sa.Column('date', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['room_id'], ['room.room_id'], ),
+    sa.ForeignKeyConstraint(['uploader_id'], ['user.userID'], ),
+    sa.PrimaryKeyConstraint('attachment_id')
+    )
+    with op.batch_alter_table('attachment', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_attachment_sha256'), ['sha256'], unique=False)
+
+    # a plain ADD COLUMN: adding the foreign key through batch mode would
+    # rebuild message on SQLite and drop the search triggers with it
+    op.add_column('message', sa.Column('attachment_id', sa.String(), nullable=True))
+    if op.get_bind().dialect.name != 'sqlite':
+        op.create_foreign_key('fk_message_attachment_id', 'message', 'attachment',
+                              ['attachment_id'], ['attachment_id'])
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        op.drop_constraint('fk_message_attachment_id', 'message', type_='foreignkey')
+    op.drop_column('message', 'attachment_id')
+
+    with op.batch_alter_table('attachment', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_attachment_sha256'))
+
+    op.drop_table('attachment')
@@ -0,0 +1,26 @@
+"""index message by room and date for history pagination
+
+Revision ID: b31c7a2e4f10
+Revises: 5f369d408a9a
+Create Date: 2026-10-18 17:10:02.114527
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b31c7a2e4f10'
+down_revision = '5f369d408a9a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.create_index('ix_message_room_date', ['sent_to_room_id', 'date', 'message_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.drop_index('ix_message_room_date')
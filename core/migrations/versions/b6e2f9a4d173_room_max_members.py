@@ -0,0 +1,26 @@
+"""per room member cap
+
+Revision ID: b6e2f9a4d173
+Revises: a9d4c7e1f358
+Create Date: 2026-10-18 20:48:02.114585
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b6e2f9a4d173'
+down_revision = 'a9d4c7e1f358'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('room', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('max_members', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('room', schema=None) as batch_op:
+        batch_op.drop_column('max_members')
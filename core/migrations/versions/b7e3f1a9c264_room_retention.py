@@ -0,0 +1,34 @@
+"""room retention policies
+
+Revision ID: b7e3f1a9c264
+Revises: a2d6e9c3f147
+Create Date: 2026-10-19 01:27:35.918420
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e3f1a9c264'
+down_revision = 'a2d6e9c3f147'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('room', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('retention_days', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('retention_count', sa.Integer(), nullable=True))
+
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.create_index('ix_message_room_number', ['sent_to_room_id', 'number'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.drop_index('ix_message_room_number')
+
+    with op.batch_alter_table('room', schema=None) as batch_op:
+        batch_op.drop_column('retention_count')
+        batch_op.drop_column('retention_days')
@@ -0,0 +1,45 @@
+"""denormalized room counters and member read pointer for the dashboard
+
+Revision ID: c4e8d1f2a7b3
+Revises: b31c7a2e4f10
+Create Date: 2026-10-18 18:02:41.530114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4e8d1f2a7b3'
+down_revision = 'b31c7a2e4f10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('room', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('member_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('last_message_id', sa.Integer(), nullable=True))
+
+    with op.batch_alter_table('association_table', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('last_read_message_id', sa.Integer(), server_default='0', nullable=False))
+
+    # backfill, existing members start with everything read
+    op.execute(
+        "UPDATE room SET "
+        "member_count = (SELECT count(*) FROM association_table WHERE right_id = room.room_id), "
+        "last_message_id = (SELECT max(message_id) FROM message WHERE sent_to_room_id = room.room_id)"
+    )
+    op.execute(
+        "UPDATE association_table SET last_read_message_id = coalesce("
+        "(SELECT last_message_id FROM room WHERE room.room_id = association_table.right_id), 0)"
+    )
+
+
+def downgrade():
+    with op.batch_alter_table('association_table', schema=None) as batch_op:
+        batch_op.drop_column('last_read_message_id')
+
+    with op.batch_alter_table('room', schema=None) as batch_op:
+        batch_op.drop_column('last_message_id')
+        batch_op.drop_column('member_count')
@@ -0,0 +1,48 @@
+"""message versions, tombstones and the room event log
+
+Revision ID: c8f1d3b5e624
+Revises: b6e2f9a4d173
+Create Date: 2026-10-18 21:20:36.902114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c8f1d3b5e624'
+down_revision = 'b6e2f9a4d173'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # plain ADD COLUMNs, batch mode would rebuild message on SQLite and drop
+    # the search triggers
+    op.add_column('message', sa.Column('version', sa.Integer(), nullable=False, server_default='1'))
+    op.add_column('message', sa.Column('edited_at', sa.DateTime(), nullable=True))
+    op.add_column('message', sa.Column('deleted_at', sa.DateTime(), nullable=True))
+
+    op.create_table('room_event',
+    sa.Column('seq', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('room_id', sa.String(), nullable=False),
+    sa.Column('message_id', sa.Integer(), nullable=False),
+    sa.Column('kind', sa.String(length=8), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.Column('date', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['message_id'], ['message.message_id'], ),
+    sa.ForeignKeyConstraint(['room_id'], ['room.room_id'], ),
+    sa.PrimaryKeyConstraint('seq')
+    )
+    with op.batch_alter_table('room_event', schema=None) as batch_op:
+        batch_op.create_index('ix_room_event_room_seq', ['room_id', 'seq'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('room_event', schema=None) as batch_op:
+        batch_op.drop_index('ix_room_event_room_seq')
+
+    op.drop_table('room_event')
+    op.drop_column('message', 'deleted_at')
+    op.drop_column('message', 'edited_at')
+    op.drop_column('message', 'version')
@@ -0,0 +1,26 @@
+"""per membership notification level
+
+Revision ID: d3a7c9e5f812
+Revises: c8f1d3b5e624
+Create Date: 2026-10-18 22:05:13.417820
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd3a7c9e5f812'
+down_revision = 'c8f1d3b5e624'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('association_table', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('notify_level', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade():
+    with op.batch_alter_table('association_table', schema=None) as batch_op:
+        batch_op.drop_column('notify_level')
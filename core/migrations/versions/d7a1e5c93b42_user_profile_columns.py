@@ -0,0 +1,28 @@
+"""user columns that were added to the model without a migration
+
+Revision ID: d7a1e5c93b42
+Revises: c4e8d1f2a7b3
+Create Date: 2026-10-18 18:40:12.902311
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd7a1e5c93b42'
+down_revision = 'c4e8d1f2a7b3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('about_me', sa.String(length=255), nullable=True))
+        batch_op.add_column(sa.Column('date_joined', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('date_joined')
+        batch_op.drop_column('about_me')
@@ -0,0 +1,48 @@
+"""unique invite code per room
+
+Revision ID: e2b9f4a6c815
+Revises: d7a1e5c93b42
+Create Date: 2026-10-18 19:05:33.418027
+
+"""
+import secrets
+import string
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2b9f4a6c815'
+down_revision = 'd7a1e5c93b42'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('room', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('invite_code', sa.String(length=16), nullable=True))
+        batch_op.create_index('ix_room_invite_code', ['invite_code'], unique=True)
+
+    # existing rooms keep the code at the end of their joining_url, so the
+    # links already handed out still resolve. A room whose suffix is not
+    # usable as a code gets a new one, written into its joining_url as well
+    bind = op.get_bind()
+    chars = string.ascii_letters + string.digits
+    rooms = bind.execute(sa.text("SELECT room_id, joining_url FROM room WHERE invite_code IS NULL")).all()
+    used = set()
+    for room_id, joining_url in rooms:
+        prefix, slash, code = (joining_url or "").rpartition("/")
+        if not 0 < len(code) <= 16 or not all(c in chars for c in code) or code in used:
+            code = ''.join(secrets.choice(chars) for _ in range(10))
+            while code in used:
+                code = ''.join(secrets.choice(chars) for _ in range(10))
+            joining_url = prefix + slash + code
+        used.add(code)
+        bind.execute(sa.text("UPDATE room SET invite_code = :code, joining_url = :url WHERE room_id = :room_id"),
+                     {"code": code, "url": joining_url, "room_id": room_id})
+
+
+def downgrade():
+    with op.batch_alter_table('room', schema=None) as batch_op:
+        batch_op.drop_index('ix_room_invite_code')
+        batch_op.drop_column('invite_code')
@@ -0,0 +1,31 @@
+"""per membership role, room creators become admins
+
+Revision ID: e6b2d8f4a913
+Revises: d3a7c9e5f812
+Create Date: 2026-10-18 22:41:50.228316
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e6b2d8f4a913'
+down_revision = 'd3a7c9e5f812'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('association_table', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('role', sa.Integer(), server_default='0', nullable=False))
+
+    op.execute(
+        "UPDATE association_table SET role = 1 WHERE left_id = "
+        "(SELECT creator_id FROM room WHERE room.room_id = association_table.right_id)"
+    )
+
+
+def downgrade():
+    with op.batch_alter_table('association_table', schema=None) as batch_op:
+        batch_op.drop_column('role')
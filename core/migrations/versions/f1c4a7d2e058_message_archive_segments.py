@@ -0,0 +1,49 @@
+"""compressed message archive segments
+
+Revision ID: f1c4a7d2e058
+Revises: e6b2d8f4a913
+Create Date: 2026-10-18 23:12:07.664902
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f1c4a7d2e058'
+down_revision = 'e6b2d8f4a913'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('message_segment',
+    sa.Column('segment_id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('room_id', sa.String(), nullable=False),
+    sa.Column('first_date', sa.DateTime(), nullable=False),
+    sa.Column('first_message_id', sa.Integer(), nullable=False),
+    sa.Column('last_date', sa.DateTime(), nullable=False),
+    sa.Column('last_message_id', sa.Integer(), nullable=False),
+    sa.Column('min_message_id', sa.Integer(), nullable=False),
+    sa.Column('max_message_id', sa.Integer(), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.Column('codec', sa.String(length=8), nullable=False),
+    sa.Column('data', sa.LargeBinary(), nullable=False),
+    sa.ForeignKeyConstraint(['room_id'], ['room.room_id'], ),
+    sa.PrimaryKeyConstraint('segment_id')
+    )
+    with op.batch_alter_table('message_segment', schema=None) as batch_op:
+        batch_op.create_index('ix_message_segment_room_last', ['room_id', 'last_date', 'last_message_id'], unique=False)
+
+    with op.batch_alter_table('room', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('archived_event_seq', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade():
+    with op.batch_alter_table('room', schema=None) as batch_op:
+        batch_op.drop_column('archived_event_seq')
+
+    with op.batch_alter_table('message_segment', schema=None) as batch_op:
+        batch_op.drop_index('ix_message_segment_room_last')
+
+    op.drop_table('message_segment')
@@ -0,0 +1,51 @@
+"""full-text search index on message bodies
+
+Revision ID: f5c3a8d2b917
+Revises: e2b9f4a6c815
+Create Date: 2026-10-18 19:42:10.207315
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f5c3a8d2b917'
+down_revision = 'e2b9f4a6c815'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # same DDL as search.py
+    bind = op.get_bind()
+    if bind.dialect.name == 'sqlite':
+        op.execute("CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5("
+                   "message_body, content='message', content_rowid='message_id', tokenize='unicode61')")
+        op.execute("CREATE TRIGGER IF NOT EXISTS message_fts_insert AFTER INSERT ON message BEGIN "
+                   "INSERT INTO message_fts(rowid, message_body) VALUES (new.message_id, new.message_body); END")
+        op.execute("CREATE TRIGGER IF NOT EXISTS message_fts_delete AFTER DELETE ON message BEGIN "
+                   "INSERT INTO message_fts(message_fts, rowid, message_body) "
+                   "VALUES ('delete', old.message_id, old.message_body); END")
+        op.execute("CREATE TRIGGER IF NOT EXISTS message_fts_update AFTER UPDATE OF message_body ON message BEGIN "
+                   "INSERT INTO message_fts(message_fts, rowid, message_body) "
+                   "VALUES ('delete', old.message_id, old.message_body); "
+                   "INSERT INTO message_fts(rowid, message_body) VALUES (new.message_id, new.message_body); END")
+        # index the existing messages, the external content table starts empty
+        op.execute("INSERT INTO message_fts(message_fts) VALUES ('rebuild')")
+    elif bind.dialect.name == 'postgresql':
+        op.execute("ALTER TABLE message ADD COLUMN IF NOT EXISTS search_vector tsvector "
+                   "GENERATED ALWAYS AS (to_tsvector('simple', coalesce(message_body, ''))) STORED")
+        op.execute("CREATE INDEX IF NOT EXISTS ix_message_search_vector ON message USING gin (search_vector)")
+
+
+def downgrade():
+    bind = op.get_bind()
+    if bind.dialect.name == 'sqlite':
+        op.execute("DROP TRIGGER IF EXISTS message_fts_update")
+        op.execute("DROP TRIGGER IF EXISTS message_fts_delete")
+        op.execute("DROP TRIGGER IF EXISTS message_fts_insert")
+        op.execute("DROP TABLE IF EXISTS message_fts")
+    elif bind.dialect.name == 'postgresql':
+        op.execute("DROP INDEX IF EXISTS ix_message_search_vector")
+        op.execute("ALTER TABLE message DROP COLUMN IF EXISTS search_vector")
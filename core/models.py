@@ -5,24 +5,20 @@ from typing import List
 import uuid
 from datetime import datetime
 from flask_login import UserMixin
-from sqlalchemy.orm import Mapped, mapped_column, relationship
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Unicode, Table
-from flask import Flask
-# from core.config import Config
+from sqlalchemy.orm import Mapped, DynamicMapped, mapped_column, relationship
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Unicode, Table, LargeBinary
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import DeclarativeBase
-from werkzeug.security import generate_password_hash, check_password_hash
-from flask_migrate import Migrate
+from sqlalchemy.orm import DeclarativeBase, Session, object_session
+from hashing import hasher
+from user_cache import user_cache
+from sqlalchemy import event
 
 
-app = Flask(__name__)
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///memory"
-
 class Base(DeclarativeBase):
     pass
 
-db = SQLAlchemy(app, model_class=Base)
-migrate = Migrate(app, db, render_as_batch=True)
+# bound to the app in app.create_app
+db = SQLAlchemy(model_class=Base)
 
 def generate_uuid():
     return str(uuid.uuid4())
@@ -33,6 +29,13 @@ association_table = Table( # many to many users -> rooms
     Base.metadata,
     db.Column("left_id", ForeignKey("user.userID"), primary_key=True),
     db.Column("right_id", ForeignKey("room.room_id"), primary_key=True),
+    # the member has read the room's messages up to this Message.number,
+    # unread is Room.message_count minus this, see read_receipts.py
+    db.Column("last_read_number", Integer, nullable=False, default=0, server_default="0"),
+    # 0 member, 1 admin, see moderation.py
+    db.Column("role", Integer, nullable=False, default=0, server_default="0"),
+    # 0 all, 1 digest only, 2 muted, see notifications.py
+    db.Column("notify_level", Integer, nullable=False, default=0, server_default="0"),
 )
 
 
@@ -48,8 +51,8 @@ class User(db.Model, UserMixin):
     about_me = db.Column("about_me", String(255))
     created_rooms: Mapped[List["Room"]] = db.relationship(back_populates="creator")
     rooms: Mapped[List["Room"]] = db.relationship(secondary=association_table, back_populates="users")
-    messages: Mapped[List["Message"]] = db.relationship(back_populates="sent_by")
-    date_joined= db.mapped_column(DateTime(), default=datetime.now())
+    messages: DynamicMapped["Message"] = db.relationship(back_populates="sent_by", lazy="dynamic")
+    date_joined= db.mapped_column(DateTime(), default=datetime.now)
 
    
     def set_password(self, secret):
@@ -57,8 +60,9 @@ class User(db.Model, UserMixin):
         set password method, sets the password by converting it in to a hash
         and then stores that hash in the database
         """
-        # password hash
-        return generate_password_hash(secret)
+        # password hash, computed off the request thread, see hashing.py
+        self.password = hasher.hash(secret)
+        return self.password
    
     def check_password(self, secret):
         """
@@ -66,12 +70,18 @@ class User(db.Model, UserMixin):
         during login, with stored hash of the loaded column's password field, the column is
         loaded in the login view function, using db.session.scalar(...)
         """
-        return check_password_hash(self.password, secret)
+        return hasher.verify(self.password, secret)
+
+    def password_needs_rehash(self):
+        """
+        true when the stored hash was made with an older method or cost
+        """
+        return hasher.needs_rehash(self.password)
 
 
     def __init__(self, username, password, email):
         self.username = username
-        self.password = self.set_password(password)
+        self.set_password(password)
         self.email = email
 
 
@@ -79,37 +89,118 @@ class User(db.Model, UserMixin):
         return f'<User %r> {self.username}'
 
 
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def note_changed_user(mapper, connection, target):
+    """
+    the session user cache drops the user once the change commits
+    """
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault("changed_users", set()).add(target.id)
+
+
+@event.listens_for(Session, "after_commit")
+def drop_cached_users(session):
+    user_ids = session.info.pop("changed_users", None)
+    if user_ids:
+        user_cache.changed(user_ids)
+
+
+@event.listens_for(Session, "after_rollback")
+def keep_cached_users(session):
+    session.info.pop("changed_users", None)
+
+
 class Room(db.Model):
     """
     ROOM MODEL
     """
     __tablename__ = "room"
     room_name: Mapped[str] = db.Column("room_name", String, nullable=False)
-    room_id: Mapped[str] = db.mapped_column("room_id", ForeignKey(User.id), primary_key=True, default=uuid)
+    room_id: Mapped[str] = db.mapped_column("room_id", String, primary_key=True, default=generate_uuid)
     room_banner = db.Column("room_banner", String, nullable=True)
-    creator: Mapped["User"] = db.relationship(foreign_keys=[room_id], back_populates="created_rooms")
+    creator_id: Mapped[str] = db.mapped_column("creator_id", ForeignKey(User.id), nullable=False)
+    creator: Mapped["User"] = db.relationship(foreign_keys=[creator_id], back_populates="created_rooms")
     joining_url = db.Column("joining_url", String, nullable=False)
+    invite_code: Mapped[str] = db.mapped_column("invite_code", String(16), unique=True, index=True, nullable=True)
     users: Mapped[List["User"]] = db.relationship(secondary=association_table, back_populates="rooms") # Many To Many
-    messages: Mapped[List["Message"]] = db.relationship(back_populates="sent_to_room")
+    # dynamic so that touching room.messages builds a query instead of loading the whole history
+    messages: DynamicMapped["Message"] = db.relationship(back_populates="sent_to_room", lazy="dynamic")
+    # denormalized for the dashboard, kept up to date by the join and send paths
+    member_count: Mapped[int] = db.mapped_column("member_count", Integer, nullable=False,
+                                                 default=0, server_default="0")
+    last_message_id: Mapped[int] = db.mapped_column("last_message_id", Integer, nullable=True)
+    # messages ever stored in the room, the Message.number of the newest one
+    message_count: Mapped[int] = db.mapped_column("message_count", Integer, nullable=False,
+                                                  default=0, server_default="0")
+    # None falls back to CHAT_ROOM_MAX_MEMBERS
+    max_members: Mapped[int] = db.mapped_column("max_members", Integer, nullable=True)
+    # retention policy, messages older than this many days or not among the
+    # newest retention_count are pruned, None for no limit, see retention.py
+    retention_days: Mapped[int] = db.mapped_column("retention_days", Integer, nullable=True)
+    retention_count: Mapped[int] = db.mapped_column("retention_count", Integer, nullable=True)
+    # room events up to this seq may have been dropped with their messages,
+    # see room_events.drop_events
+    archived_event_seq: Mapped[int] = db.mapped_column("archived_event_seq", Integer, nullable=False,
+                                                       default=0, server_default="0")
 
 
     def __init__(self, room_name: String, room_banner: String,
-                joining_url: String, created_by: User):
+                joining_url: String, created_by: User, invite_code: String = None,
+                max_members: Integer = None):
         self.room_name = room_name
         self.room_banner = room_banner
         self.joining_url = joining_url
-        self.created_by = created_by
+        self.creator = created_by
+        self.invite_code = invite_code
+        self.member_count = 0
+        self.max_members = max_members
 
 
     def __repr__(self):
         return '<User %r>' % self.room_name
 
 
+class Attachment(db.Model):
+    """
+    ATTACHMENT MODEL
+
+    an uploaded file, the bytes live in the attachment store under their
+    sha256 so identical uploads share one blob
+    """
+    __tablename__ = "attachment"
+    id: Mapped[str] = mapped_column("attachment_id", String, primary_key=True, default=generate_uuid)
+    sha256 = db.Column("sha256", String(64), nullable=False, index=True)
+    size = db.Column("size", Integer, nullable=False)
+    content_type = db.Column("content_type", String(127), nullable=False)
+    filename = db.Column("filename", String(255))
+    uploader_id: Mapped[str] = mapped_column(ForeignKey("user.userID"), nullable=False)
+    # the room whose members may download it, None for a banner not yet set on a room
+    room_id: Mapped[str] = mapped_column(ForeignKey("room.room_id"), nullable=True)
+    date = db.Column(DateTime(), default=datetime.now)
+
+
+    def payload(self):
+        return {"id": self.id, "content_type": self.content_type,
+                "filename": self.filename, "size": self.size}
+
+
+    def __repr__(self):
+        return '<Attachment %r>' % self.filename
+
+
 class Message(db.Model):
     """
     MESSAGE MODEL
     """
     __tablename__ = "message"
+    __table_args__ = (
+        # backs the keyset pagination in history.py, (room, date, id) is the sort key
+        db.Index("ix_message_room_date", "sent_to_room_id", "date", "message_id"),
+        # count based retention, see retention.py
+        db.Index("ix_message_room_number", "sent_to_room_id", "number"),
+    )
     message_id: Mapped[int] = mapped_column("message_id", Integer, primary_key=True, autoincrement=True)
     message_body = db.Column("message_body", String)
     # message_body can contain image, gif or sound clip, video, stickers -> BLOB (binary large object)
@@ -118,6 +209,16 @@ class Message(db.Model):
     sent_id: Mapped[str] = db.mapped_column(ForeignKey("user.userID"))
     sent_by: Mapped["User"] = relationship(foreign_keys=[sent_id], back_populates="messages")
     date = db.Column(DateTime(), default=datetime.now)
+    attachment_id: Mapped[str] = mapped_column(ForeignKey(Attachment.id), nullable=True)
+    # many to one on the primary key, joined so serializing a page is one query
+    attachment: Mapped["Attachment"] = relationship(lazy="joined")
+    # bumped by every edit and by the delete, see room_events.py
+    version: Mapped[int] = mapped_column("version", Integer, nullable=False, default=1, server_default="1")
+    edited_at = db.Column("edited_at", DateTime(), nullable=True)
+    # a deleted message stays as a tombstone with an empty body
+    deleted_at = db.Column("deleted_at", DateTime(), nullable=True)
+    # position in the room, 1, 2, 3, ... in the order the write buffer stored them
+    number: Mapped[int] = mapped_column("number", Integer, nullable=True)
 
 
     def __init__(self, message_body: String, sent_by: User, sent_to_room: Room):
@@ -126,14 +227,78 @@ class Message(db.Model):
         self.sent_by = sent_by
 
 
+    def serialize(self):
+        """
+        plain dict of the message, this is what goes over the socket to clients
+        """
+        attachment = self.attachment.payload() if self.attachment is not None else None
+        return message_payload(self.message_id, self.sent_to_room_id, self.sent_id,
+                               self.message_body, self.date, attachment,
+                               self.version, self.edited_at, self.deleted_at is not None, self.number)
+
+
     def __repr__(self):
         return '<User %r>' % self.message_body
 
 
-# This context manager is used here to initialize the database if it does not exist in the first place
-with app.app_context():
-    db.create_all()
-    user = User(username=f"daisy {generate_uuid()}", password="password", email="example@example.com")
-    db.session.add(user)
-    db.session.commit()
-    print("database initialized")
+def message_payload(message_id, room_id, sender_id, body, date, attachment=None,
+                    version=1, edited_at=None, deleted=False, number=None):
+    """
+    builds the wire shape of a message, shared by ORM rows and the rows
+    sitting in the write buffer that have not been inserted yet
+    """
+    return {
+        "id": message_id,
+        "room_id": room_id,
+        "sender_id": sender_id,
+        "body": body,
+        "date": date.isoformat() if date is not None else None,
+        "attachment": attachment,
+        "version": version,
+        "edited_at": edited_at.isoformat() if edited_at is not None else None,
+        "deleted": deleted,
+        "number": number,
+    }
+
+
+class RoomEvent(db.Model):
+    """
+    ROOM EVENT MODEL
+
+    append-only log of message changes, see room_events.py
+    """
+    __tablename__ = "room_event"
+    __table_args__ = (
+        db.Index("ix_room_event_room_seq", "room_id", "seq"),
+    )
+    seq: Mapped[int] = mapped_column("seq", Integer, primary_key=True, autoincrement=True)
+    room_id: Mapped[str] = mapped_column(ForeignKey(Room.room_id), nullable=False)
+    message_id: Mapped[int] = mapped_column(ForeignKey(Message.message_id), nullable=False)
+    kind = db.Column("kind", String(8), nullable=False)  # create, edit or delete
+    version = db.Column("version", Integer, nullable=False)
+    date = db.Column(DateTime(), default=datetime.now)
+
+
+class MessageSegment(db.Model):
+    """
+    MESSAGE SEGMENT MODEL
+
+    a compressed block of a room's archived messages, see archive.py. The
+    bounds make the segment table a sparse index over the cold history
+    """
+    __tablename__ = "message_segment"
+    __table_args__ = (
+        # keyset paging over segments, same sort key as ix_message_room_date
+        db.Index("ix_message_segment_room_last", "room_id", "last_date", "last_message_id"),
+    )
+    segment_id: Mapped[int] = mapped_column("segment_id", Integer, primary_key=True, autoincrement=True)
+    room_id: Mapped[str] = mapped_column(ForeignKey(Room.room_id), nullable=False)
+    first_date = db.Column("first_date", DateTime(), nullable=False)
+    first_message_id = db.Column("first_message_id", Integer, nullable=False)
+    last_date = db.Column("last_date", DateTime(), nullable=False)
+    last_message_id = db.Column("last_message_id", Integer, nullable=False)
+    min_message_id = db.Column("min_message_id", Integer, nullable=False)
+    max_message_id = db.Column("max_message_id", Integer, nullable=False)
+    count = db.Column("count", Integer, nullable=False)
+    codec = db.Column("codec", String(8), nullable=False)
+    data = db.Column("data", LargeBinary, nullable=False)
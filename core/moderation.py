@@ -0,0 +1,112 @@
+"""
+Room moderation
+
+Members have a role on their membership row, ROLE_MEMBER or ROLE_ADMIN; the
+creator of a room is its first admin and can not be kicked or demoted.
+Admins act on sets of users, and every action is a fixed number of
+set-based statements whatever the size of the set, no row is loaded into
+Python:
+
+    purge_messages  tombstones all of the users' messages in the room, one
+                    UPDATE plus one INSERT ... SELECT into the room event
+                    log so reconnecting clients see the deletes in their delta,
+                    plus a rewrite of the archived segments holding any of
+                    them (archive.purge_users), the one part that reads rows
+    kick            one DELETE ... RETURNING of the membership rows, one
+                    UPDATE of the member counter
+    set_role        one UPDATE ... RETURNING
+
+Callers commit, then publish the returned event once through the fan-out:
+"messages_purged", "members_removed" or "roles_changed", each carrying the
+room_id and the user ids. Every node drops its cached state for the room
+when the event reaches it, see ChatNamespace.deliver.
+"""
+from datetime import datetime
+import sqlalchemy as s
+from models import db, Room, Message, RoomEvent, association_table
+import room_events
+import archive
+
+
+ROLE_MEMBER, ROLE_ADMIN = 0, 1
+ROLES = {"member": ROLE_MEMBER, "admin": ROLE_ADMIN}
+
+# users per request, keeps the IN lists and the broadcast payload bounded
+MAX_USERS = 1000
+
+
+def is_admin(user_id, room_id):
+    return db.session.scalar(
+        s.select(association_table.c.role).where(
+            association_table.c.left_id == user_id,
+            association_table.c.right_id == room_id,
+        )
+    ) == ROLE_ADMIN
+
+
+def _not_creator(room_id):
+    creator = s.select(Room.creator_id).where(Room.room_id == room_id).scalar_subquery()
+    return association_table.c.left_id != creator
+
+
+def purge_messages(room_id, user_ids):
+    """
+    returns the "messages_purged" payload, with the number of messages
+    removed and the seq of the last delete event
+    """
+    now = datetime.now()
+    purged = db.session.execute(
+        s.update(Message)
+        .where(Message.sent_to_room_id == room_id, Message.sent_id.in_(user_ids),
+               Message.deleted_at.is_(None))
+        .values(message_body="", attachment_id=None, deleted_at=now, version=Message.version + 1)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if purged:
+        db.session.execute(
+            s.insert(RoomEvent).from_select(
+                ["room_id", "message_id", "kind", "version", "date"],
+                s.select(Message.sent_to_room_id, Message.message_id, s.literal("delete"),
+                         Message.version, s.literal(now, s.DateTime()))
+                .where(Message.sent_to_room_id == room_id, Message.sent_id.in_(user_ids),
+                       Message.deleted_at == now)
+                .order_by(Message.message_id),
+            )
+        )
+    purged += archive.purge_users(room_id, set(user_ids))
+    return {"room_id": room_id, "user_ids": list(user_ids) if purged else [], "messages": purged,
+            "seq": room_events.latest_seq(room_id)}
+
+
+def kick(room_id, user_ids):
+    """
+    removes the users from the room, returns the "members_removed" payload
+    with the ids that actually were members
+    """
+    removed = db.session.scalars(
+        s.delete(association_table).where(
+            association_table.c.right_id == room_id,
+            association_table.c.left_id.in_(user_ids),
+            _not_creator(room_id),
+        ).returning(association_table.c.left_id)
+    ).all()
+    if removed:
+        db.session.execute(
+            s.update(Room).where(Room.room_id == room_id)
+            .values(member_count=Room.member_count - len(removed))
+        )
+    return {"room_id": room_id, "user_ids": removed}
+
+
+def set_role(room_id, user_ids, role):
+    """
+    returns the "roles_changed" payload, with the ids that are members
+    """
+    changed = db.session.scalars(
+        s.update(association_table).where(
+            association_table.c.right_id == room_id,
+            association_table.c.left_id.in_(user_ids),
+            _not_creator(room_id),
+        ).values(role=role).returning(association_table.c.left_id)
+    ).all()
+    return {"room_id": room_id, "user_ids": changed, "role": role}
@@ -0,0 +1,199 @@
+"""
+Notification settings and delivery
+
+Every membership has a notify_level: "all" (a live "notification" event
+when a message arrives in a room the member is not looking at, and a
+digest while offline), "digest" (the digest only) or "mute" (nothing).
+The levels of a room's members are cached in memory as two sets, so the
+broadcast path picks recipients with set operations instead of a query per
+message. Entries are loaded with one query per cold room, dropped when a
+setting or membership changes on this node and after CHAT_NOTIFY_CACHE_TTL
+seconds otherwise, which bounds how stale other nodes can be.
+
+Live notifications go to the members connected to the node that delivers
+the message, through a per user Socket.IO room (user_room). Members who are
+not connected get one digest per CHAT_DIGEST_INTERVAL seconds covering
+every room that had messages, however many, handed to `on_digest(user_id,
+rooms)`, which is where a push or mail gateway plugs in. Digests are built
+on the node that stored the messages and "offline" means not connected to
+it, like presence.py.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+import sqlalchemy as s
+from models import db, association_table
+from offload import run_blocking
+from presence import presence
+
+
+logger = logging.getLogger(__name__)
+
+NOTIFY_ALL, NOTIFY_DIGEST, NOTIFY_MUTE = 0, 1, 2
+LEVELS = {"all": NOTIFY_ALL, "digest": NOTIFY_DIGEST, "mute": NOTIFY_MUTE}
+LEVEL_NAMES = {level: name for name, level in LEVELS.items()}
+
+PREVIEW_LENGTH = 80
+
+
+def user_room(user_id):
+    """
+    the Socket.IO room every connection of user_id is in
+    """
+    return "user:" + user_id
+
+
+def set_level(user_id, room_id, level):
+    """
+    changes a member's notify_level, false when they are not a member.
+    Caller commits
+    """
+    result = db.session.execute(
+        s.update(association_table)
+        .where(association_table.c.left_id == user_id, association_table.c.right_id == room_id)
+        .values(notify_level=level)
+    )
+    return result.rowcount > 0
+
+
+def load_levels(room_id):
+    """
+    {user_id: notify_level} of the room's members
+    """
+    return dict(db.session.execute(
+        s.select(association_table.c.left_id, association_table.c.notify_level)
+        .where(association_table.c.right_id == room_id)
+    ).all())
+
+
+class Audience:
+    """
+    who in a room gets what, as of `expires`
+    """
+    __slots__ = ("live", "digest", "expires")
+
+    def __init__(self, levels, expires):
+        self.live = frozenset(user_id for user_id, level in levels.items() if level == NOTIFY_ALL)
+        self.digest = frozenset(user_id for user_id, level in levels.items() if level <= NOTIFY_DIGEST)
+        self.expires = expires
+
+
+class Notifications:
+
+    def __init__(self, ttl=60.0, max_rooms=10000, digest_interval=300.0):
+        self.ttl = ttl
+        self.max_rooms = max_rooms
+        self.digest_interval = digest_interval
+        self.app = None
+        self.socketio = None
+        self.loader = None
+        self.on_digest = self.log_digest
+        self._audiences = OrderedDict()  # room_id -> Audience, LRU
+        self._pending = {}  # room_id -> [messages since the last digest, newest payload]
+        self._lock = threading.Lock()
+        self._task = None
+
+    def init_app(self, app, socketio=None):
+        self.app = app
+        self.socketio = socketio
+        self.ttl = app.config.get("CHAT_NOTIFY_CACHE_TTL", self.ttl)
+        self.max_rooms = app.config.get("CHAT_NOTIFY_CACHE_ROOMS", self.max_rooms)
+        self.digest_interval = app.config.get("CHAT_DIGEST_INTERVAL", self.digest_interval)
+
+    def _load(self, room_id):
+        if self.loader is not None:
+            return self.loader(room_id)
+        with self.app.app_context():
+            return run_blocking(load_levels, room_id)
+
+    def audience(self, room_id, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            audience = self._audiences.get(room_id)
+            if audience is not None and audience.expires > now:
+                self._audiences.move_to_end(room_id)
+                return audience
+        audience = Audience(self._load(room_id), now + self.ttl)
+        with self._lock:
+            self._audiences[room_id] = audience
+            self._audiences.move_to_end(room_id)
+            while len(self._audiences) > self.max_rooms:
+                self._audiences.popitem(last=False)
+        return audience
+
+    def invalidate(self, room_id):
+        with self._lock:
+            self._audiences.pop(room_id, None)
+
+    def recipients(self, room_id, sender_id):
+        """
+        users connected here who get a live notification for a message
+        """
+        audience = self.audience(room_id)
+        viewing = presence.online(room_id)
+        return presence.connected(audience.live).difference(viewing, (sender_id,))
+
+    def notify(self, room_id, payload):
+        """
+        live notifications for a message delivered to this node
+        """
+        recipients = self.recipients(room_id, payload["sender_id"])
+        if not recipients or self.socketio is None:
+            return
+        notification = {"room_id": room_id, "message_id": payload["id"],
+                        "sender_id": payload["sender_id"],
+                        "preview": (payload.get("body") or "")[:PREVIEW_LENGTH]}
+        for user_id in recipients:
+            self.socketio.emit("notification", notification, to=user_room(user_id), namespace="/chat")
+
+    def queue(self, payloads):
+        """
+        counts stored messages towards the next digest, O(1) per message
+        """
+        with self._lock:
+            for payload in payloads:
+                entry = self._pending.setdefault(payload["room_id"], [0, None])
+                entry[0] += 1
+                entry[1] = payload
+
+    def collect(self):
+        """
+        {user_id: [room summaries]} for the offline members of every room
+        that had messages since the last call
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        digests = {}
+        for room_id, (count, last) in pending.items():
+            summary = {"room_id": room_id, "messages": count, "last_sender_id": last["sender_id"],
+                       "preview": (last.get("body") or "")[:PREVIEW_LENGTH]}
+            audience = self.audience(room_id)
+            for user_id in audience.digest - presence.connected(audience.digest):
+                digests.setdefault(user_id, []).append(summary)
+        return digests
+
+    @staticmethod
+    def log_digest(user_id, rooms):
+        logger.info("digest for %s: %d messages in %d rooms", user_id,
+                    sum(room["messages"] for room in rooms), len(rooms))
+
+    def run(self, sleep=time.sleep):
+        while True:
+            sleep(self.digest_interval)
+            try:
+                for user_id, rooms in self.collect().items():
+                    self.on_digest(user_id, rooms)
+            except Exception:
+                logger.exception("sending digests failed")
+
+    def start(self, socketio):
+        """
+        starts the digest loop once per process
+        """
+        with self._lock:
+            if self._task is None:
+                self._task = socketio.start_background_task(self.run, socketio.sleep)
+
+
+notifications = Notifications()
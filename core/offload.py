@@ -0,0 +1,107 @@
+"""
+Async worker mode and blocking work offload
+
+CHAT_ASYNC_MODE picks how the server runs: "threading" (the default),
+"eventlet" or "gevent". In the two cooperative modes every socket is a
+green thread, so anything that blocks in C code (SQLite, password hashing)
+has to be pushed to a real thread or it stalls every connection of the
+process. run_blocking does that through a bounded pool of
+CHAT_BLOCKING_WORKERS threads.
+
+patch() has to run before anything imports socket or threading, that is,
+first thing in server.py, before there is an app: the mode is read from
+the environment at import. Config carries the same two settings, init_app
+checks the mode agrees and resizes the pool in threading mode, the green
+modes size theirs when patching.
+"""
+import contextvars
+import os
+import threading
+from functools import wraps
+
+
+MODES = ("threading", "eventlet", "gevent")
+
+mode = os.environ.get("CHAT_ASYNC_MODE", "threading")
+workers = int(os.environ.get("CHAT_BLOCKING_WORKERS", "16"))
+
+_patched = False
+# captured before patch(), these stay real OS primitives in the green modes
+# and are what code running inside run_blocking must use for locking
+RealLock = threading.Lock
+RealBoundedSemaphore = threading.BoundedSemaphore
+_local = threading.local()
+_limit = RealBoundedSemaphore(workers)
+
+
+def patch():
+    """
+    monkey patches the standard library for the configured cooperative mode
+    """
+    global _patched
+    if mode not in MODES:
+        raise ValueError(f"CHAT_ASYNC_MODE must be one of {MODES}, got {mode!r}")
+    if _patched or mode == "threading":
+        return
+    if mode == "eventlet":
+        import eventlet
+        from eventlet import tpool
+        eventlet.monkey_patch()
+        tpool.set_num_threads(workers)
+    else:
+        from gevent import monkey, get_hub
+        monkey.patch_all()
+        get_hub().threadpool.maxsize = workers
+    _patched = True
+
+
+def init_app(app):
+    global workers, _limit
+    if app.config.get("CHAT_ASYNC_MODE", mode) != mode:
+        raise ValueError("CHAT_ASYNC_MODE is applied at import, set it in the environment, not the app config")
+    if mode == "threading":
+        workers = app.config.get("CHAT_BLOCKING_WORKERS", workers)
+        _limit = RealBoundedSemaphore(workers)
+
+
+def in_worker():
+    return getattr(_local, "active", False)
+
+
+def _call(ctx, fn, args, kwargs):
+    _local.active = True
+    try:
+        return ctx.run(fn, *args, **kwargs)
+    finally:
+        _local.active = False
+
+
+def run_blocking(fn, *args, **kwargs):
+    """
+    runs fn on the blocking pool and waits for it without holding up the
+    event loop. Flask's app/request context is carried over, and calls made
+    from inside the pool run inline
+    """
+    if in_worker():
+        return fn(*args, **kwargs)
+    ctx = contextvars.copy_context()
+    if mode == "eventlet":
+        from eventlet import tpool
+        return tpool.execute(_call, ctx, fn, args, kwargs)
+    if mode == "gevent":
+        from gevent import get_hub
+        return get_hub().threadpool.apply(_call, (ctx, fn, args, kwargs))
+    # threading mode, every connection already has its own thread, the pool
+    # size only bounds how many of them hit the database at once
+    with _limit:
+        return _call(ctx, fn, args, kwargs)
+
+
+def blocking(view):
+    """
+    decorator for HTTP views that only touch the database and templates
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        return run_blocking(view, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,262 @@
+"""
+Presence and typing indicators
+
+Tracks which users are connected to which rooms and who is typing, per
+socket connection. Changes are not broadcast as they happen: every
+CHAT_PRESENCE_TICK seconds each room that changed gets one "presence" event
+with the net difference since the last one, so a user who reconnects or
+types a burst within a tick costs the room nothing or a single entry:
+
+    {"room_id": ..., "online": [user ids], "offline": [...],
+     "typing": [...], "stopped_typing": [...]}
+
+Connections send "heartbeat" events, one that stays silent for
+CHAT_PRESENCE_TIMEOUT seconds counts as gone until it beats again. Typing
+lapses after CHAT_TYPING_TTL seconds unless refreshed. A connection can be
+in at most CHAT_PRESENCE_MAX_ROOMS rooms, which bounds its footprint.
+
+State is per node, with several nodes the diffs reach every client through
+the fan-out but the online list sent on join covers the local node only.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+
+logger = logging.getLogger(__name__)
+
+
+class Session:
+    """
+    one socket connection
+    """
+    __slots__ = ("user_id", "rooms", "active")
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.rooms = set()
+        self.active = True
+
+
+class Presence:
+
+    def __init__(self, tick=1.0, timeout=45.0, typing_ttl=5.0, max_rooms=50):
+        self.tick_interval = tick
+        self.timeout = timeout
+        self.typing_ttl = typing_ttl
+        self.max_rooms = max_rooms
+        self.on_diffs = None
+        self._sessions = {}  # sid -> Session
+        self._users = {}  # user_id -> connection count, for notifications.py
+        self._beats = OrderedDict()  # sid -> last heartbeat of active sessions, oldest first
+        self._online = {}  # room_id -> {user_id: active connection count}
+        self._typing = OrderedDict()  # (room_id, user_id) -> expires, soonest first
+        self._announced = {}  # room_id -> {user_id: typing} as of the last diff
+        self._dirty = {}  # room_id -> user ids changed since the last diff
+        self._lock = threading.Lock()
+        self._task = None
+
+    def init_app(self, app):
+        self.tick_interval = app.config.get("CHAT_PRESENCE_TICK", self.tick_interval)
+        self.timeout = app.config.get("CHAT_PRESENCE_TIMEOUT", self.timeout)
+        self.typing_ttl = app.config.get("CHAT_TYPING_TTL", self.typing_ttl)
+        self.max_rooms = app.config.get("CHAT_PRESENCE_MAX_ROOMS", self.max_rooms)
+
+    def _touch(self, user_id, room_id):
+        self._dirty.setdefault(room_id, set()).add(user_id)
+
+    def _add(self, session, room_id):
+        users = self._online.setdefault(room_id, {})
+        users[session.user_id] = users.get(session.user_id, 0) + 1
+        self._touch(session.user_id, room_id)
+
+    def _remove(self, session, room_id):
+        users = self._online.get(room_id)
+        if users is None or session.user_id not in users:
+            return
+        users[session.user_id] -= 1
+        if users[session.user_id] == 0:
+            del users[session.user_id]
+            self._typing.pop((room_id, session.user_id), None)
+            if not users:
+                del self._online[room_id]
+        self._touch(session.user_id, room_id)
+
+    def connect(self, sid, user_id, now=None):
+        with self._lock:
+            self._sessions[sid] = Session(user_id)
+            self._users[user_id] = self._users.get(user_id, 0) + 1
+            self._beats[sid] = time.monotonic() if now is None else now
+
+    def disconnect(self, sid):
+        with self._lock:
+            session = self._sessions.pop(sid, None)
+            self._beats.pop(sid, None)
+            if session is None:
+                return
+            if self._users[session.user_id] == 1:
+                del self._users[session.user_id]
+            else:
+                self._users[session.user_id] -= 1
+            if session.active:
+                for room_id in session.rooms:
+                    self._remove(session, room_id)
+
+    def heartbeat(self, sid, now=None):
+        with self._lock:
+            session = self._sessions.get(sid)
+            if session is None:
+                return
+            self._beats[sid] = time.monotonic() if now is None else now
+            self._beats.move_to_end(sid)
+            if not session.active:
+                session.active = True
+                for room_id in session.rooms:
+                    self._add(session, room_id)
+
+    def join(self, sid, room_id):
+        """
+        false when the connection is already in max_rooms rooms
+        """
+        with self._lock:
+            session = self._sessions.get(sid)
+            if session is None:
+                return False
+            if room_id in session.rooms:
+                return True
+            if len(session.rooms) >= self.max_rooms:
+                return False
+            session.rooms.add(room_id)
+            if session.active:
+                self._add(session, room_id)
+            return True
+
+    def leave(self, sid, room_id):
+        with self._lock:
+            session = self._sessions.get(sid)
+            if session is None or room_id not in session.rooms:
+                return
+            session.rooms.discard(room_id)
+            if session.active:
+                self._remove(session, room_id)
+
+    def typing(self, sid, room_id, active=True, now=None):
+        with self._lock:
+            session = self._sessions.get(sid)
+            if session is None or not session.active or room_id not in session.rooms:
+                return
+            key = (room_id, session.user_id)
+            if active:
+                now = time.monotonic() if now is None else now
+                if key not in self._typing:
+                    self._touch(session.user_id, room_id)
+                self._typing[key] = now + self.typing_ttl
+                self._typing.move_to_end(key)
+            elif self._typing.pop(key, None) is not None:
+                self._touch(session.user_id, room_id)
+
+    def is_online(self, room_id, user_id):
+        return user_id in self._online.get(room_id, ())
+
+    def online(self, room_id):
+        return list(self._online.get(room_id, ()))
+
+    def sids_in(self, room_id, user_ids):
+        """
+        this node's connections of user_ids that have room_id open
+        """
+        return [sid for sid, session in list(self._sessions.items())
+                if session.user_id in user_ids and room_id in session.rooms]
+
+    def sids_of(self, user_id):
+        """
+        this node's connections of the user
+        """
+        return [sid for sid, session in list(self._sessions.items()) if session.user_id == user_id]
+
+    def connected(self, user_ids):
+        """
+        the users of user_ids with a connection to this node, walks whichever
+        of the two is smaller
+        """
+        users = self._users
+        if len(users) < len(user_ids):
+            return {user_id for user_id in list(users) if user_id in user_ids}
+        return {user_id for user_id in user_ids if user_id in users}
+
+    def _expire(self, now):
+        while self._beats:
+            sid, last_seen = next(iter(self._beats.items()))
+            if last_seen + self.timeout > now:
+                break
+            del self._beats[sid]
+            # stays in _sessions so that a late heartbeat can bring it back
+            session = self._sessions[sid]
+            session.active = False
+            for room_id in session.rooms:
+                self._remove(session, room_id)
+        while self._typing:
+            key, expires = next(iter(self._typing.items()))
+            if expires > now:
+                break
+            del self._typing[key]
+            self._touch(key[1], key[0])
+
+    def tick(self, now=None):
+        """
+        expires silent connections and stale typing, returns the (room_id,
+        diff) pairs for every room whose announced state changed
+        """
+        now = time.monotonic() if now is None else now
+        diffs = []
+        with self._lock:
+            self._expire(now)
+            dirty, self._dirty = self._dirty, {}
+            for room_id, user_ids in dirty.items():
+                announced = self._announced.setdefault(room_id, {})
+                online = self._online.get(room_id, {})
+                diff = {"room_id": room_id, "online": [], "offline": [], "typing": [], "stopped_typing": []}
+                for user_id in user_ids:
+                    was_online = user_id in announced
+                    was_typing = announced.get(user_id, False)
+                    is_typing = (room_id, user_id) in self._typing
+                    if user_id in online:
+                        announced[user_id] = is_typing
+                        if not was_online:
+                            diff["online"].append(user_id)
+                    else:
+                        announced.pop(user_id, None)
+                        is_typing = False
+                        if was_online:
+                            diff["offline"].append(user_id)
+                    if is_typing and not was_typing:
+                        diff["typing"].append(user_id)
+                    elif was_typing and not is_typing:
+                        diff["stopped_typing"].append(user_id)
+                if not announced:
+                    del self._announced[room_id]
+                if any(diff[key] for key in ("online", "offline", "typing", "stopped_typing")):
+                    diffs.append((room_id, diff))
+        return diffs
+
+    def run(self, sleep=time.sleep):
+        while True:
+            sleep(self.tick_interval)
+            try:
+                diffs = self.tick()
+                if diffs and self.on_diffs is not None:
+                    self.on_diffs(diffs)
+            except Exception:
+                logger.exception("presence tick failed")
+
+    def start(self, socketio):
+        """
+        starts the tick loop once per process
+        """
+        with self._lock:
+            if self._task is None:
+                self._task = socketio.start_background_task(self.run, socketio.sleep)
+
+
+presence = Presence()
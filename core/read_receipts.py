@@ -0,0 +1,118 @@
+"""
+Read receipts
+
+A client reports how far it has read in a room with the "read" event,
+{"room_id": ..., "number": n} with the Message.number of the newest message
+it has shown, or without a number for everything. Receipts are not written
+one by one: they are coalesced in memory per (user, room), keeping the
+furthest, and flushed every CHAT_READ_FLUSH_INTERVAL seconds with two
+executemany UPDATEs, so scrolling through a hundred messages is one row
+write at most. A pointer only ever moves forward.
+
+Until a flush the newest receipts only exist on the node that got them,
+`pending(user_id)` lets that node answer with them applied.
+"""
+import atexit
+import logging
+import threading
+import time
+from models import db
+from offload import run_blocking
+import room_list
+
+
+logger = logging.getLogger(__name__)
+
+# stands for "everything in the room" in the pending map, beats any number
+EVERYTHING = float("inf")
+
+
+class ReadReceipts:
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.app = None
+        self.written = 0
+        self._pending = {}  # (user_id, room_id) -> furthest number read
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._task = None
+
+    def init_app(self, app):
+        self.app = app
+        self.interval = app.config.get("CHAT_READ_FLUSH_INTERVAL", self.interval)
+        atexit.register(self.flush)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def mark(self, user_id, room_id, number=None):
+        key = (user_id, room_id)
+        number = EVERYTHING if number is None else number
+        with self._lock:
+            if number > self._pending.get(key, 0):
+                self._pending[key] = number
+
+    def pending(self, user_id):
+        """
+        {room_id: number} of the user's receipts not written yet, None for
+        everything
+        """
+        with self._lock:
+            return {room_id: None if number == EVERYTHING else number
+                    for (uid, room_id), number in self._pending.items() if uid == user_id}
+
+    def unread(self, user_id, counts):
+        """
+        {room_id: unread} from room_list.unread_counts, with this node's
+        pending receipts applied
+        """
+        pending = self.pending(user_id)
+        return {room_id: room_list.unread(room_id, count, last_read, pending)
+                for room_id, (count, last_read) in counts.items()}
+
+    def flush(self):
+        """
+        writes every pending receipt, returns how many
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return 0
+            marks = [(user_id, room_id, None if number == EVERYTHING else number)
+                     for (user_id, room_id), number in batch.items()]
+            try:
+                run_blocking(self._write, marks)
+            except Exception:
+                logger.exception("read receipt flush failed, keeping %d receipts", len(marks))
+                for (user_id, room_id), number in batch.items():
+                    self.mark(user_id, room_id, None if number == EVERYTHING else number)
+                return 0
+            self.written += len(marks)
+            return len(marks)
+
+    def _write(self, marks):
+        with self.app.app_context():
+            try:
+                room_list.mark_read(marks)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+
+    def run(self, sleep=time.sleep):
+        while True:
+            sleep(self.interval)
+            self.flush()
+
+    def start(self, socketio):
+        """
+        starts the flush loop once per process
+        """
+        with self._lock:
+            if self._task is None:
+                self._task = socketio.start_background_task(self.run, socketio.sleep)
+
+
+read_receipts = ReadReceipts()
@@ -0,0 +1,218 @@
+"""
+Recent messages cache
+
+Keeps the last N serialized messages of every warm room in memory so that
+opening a room reads no message rows, what is left is the membership check
+(one primary key lookup). Rooms are evicted least recently used first once
+the total size goes over the memory budget.
+
+A cold room is loaded outside the lock. Messages delivered while the load
+runs are held for it and merged in by id once it is done, so none is lost
+whether the load's query saw them or not, and a room discarded meanwhile
+(purged) is not cached from a load that may predate the purge.
+"""
+import threading
+from collections import OrderedDict, deque
+
+
+# rough per message overhead of the dict and its keys, on top of the body
+PAYLOAD_OVERHEAD = 160
+
+
+def payload_size(payload):
+    return PAYLOAD_OVERHEAD + len(payload.get("body") or "")
+
+
+class RoomRing:
+    """
+    fixed capacity ring of one room's most recent messages
+    """
+
+    def __init__(self, capacity, messages=(), truncated=False):
+        self.capacity = capacity
+        self.messages = deque()
+        self.ids = set()
+        self.size = 0
+        # true when older messages exist in the database
+        self.truncated = truncated
+        for payload in messages:
+            self.append(payload)
+
+    def append(self, payload):
+        """
+        adds a message, returns the change in size. A message that is already
+        in the ring (loaded from the DB and then delivered) is skipped
+        """
+        if payload["id"] in self.ids:
+            return 0
+        before = self.size
+        self.messages.append(payload)
+        self.ids.add(payload["id"])
+        self.size += payload_size(payload)
+        while len(self.messages) > self.capacity:
+            dropped = self.messages.popleft()
+            self.ids.discard(dropped["id"])
+            self.size -= payload_size(dropped)
+            self.truncated = True
+        return self.size - before
+
+    def replace(self, payload):
+        """
+        swaps in a newer version of a message already in the ring, returns
+        the change in size
+        """
+        if payload["id"] not in self.ids:
+            return 0
+        for index, current in enumerate(self.messages):
+            if current["id"] == payload["id"]:
+                if current.get("version", 1) >= payload.get("version", 1):
+                    return 0
+                self.messages[index] = payload
+                change = payload_size(payload) - payload_size(current)
+                self.size += change
+                return change
+        return 0
+
+    def snapshot(self):
+        messages = list(self.messages)
+        next_before = None
+        if self.truncated and messages:
+            next_before = messages[0]["id"]
+        return messages, next_before
+
+
+class Load:
+    """
+    what was delivered to a cold room while loaders were filling it
+    """
+
+    def __init__(self):
+        self.loaders = 0
+        self.held = []  # (kind, payload), kind "append" or "replace"
+        self.discarded = False
+
+
+def merge(messages, held):
+    """
+    the loaded messages plus the held appends, by id, each once
+    """
+    by_id = {payload["id"]: payload for payload in messages}
+    for kind, payload in held:
+        if kind == "append":
+            by_id.setdefault(payload["id"], payload)
+    return [by_id[message_id] for message_id in sorted(by_id)]
+
+
+class RecentMessageCache:
+    """
+    room_id -> RoomRing, bounded by a global byte budget
+    """
+
+    def __init__(self, per_room=50, budget=32 * 1024 * 1024):
+        self.per_room = per_room
+        self.budget = budget
+        self._rooms = OrderedDict()
+        self._loading = {}  # room_id -> Load of the loads running
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.per_room = app.config.get("CHAT_RECENT_PER_ROOM", self.per_room)
+        self.budget = app.config.get("CHAT_RECENT_BUDGET", self.budget)
+
+    def __contains__(self, room_id):
+        return room_id in self._rooms
+
+    @property
+    def size(self):
+        return self._size
+
+    def get(self, room_id, loader=None):
+        """
+        returns (messages, next_before) for the room. A cold room is filled
+        by calling loader(room_id, limit), which must return the same pair;
+        without a loader a cold room returns None
+        """
+        with self._lock:
+            ring = self._rooms.get(room_id)
+            if ring is not None:
+                self._rooms.move_to_end(room_id)
+                return ring.snapshot()
+            if loader is None:
+                return None
+            load = self._loading.get(room_id)
+            if load is None:
+                load = self._loading[room_id] = Load()
+            load.loaders += 1
+        try:
+            messages, next_before = loader(room_id, self.per_room)
+        except Exception:
+            with self._lock:
+                self._loaded(room_id, load)
+            raise
+        with self._lock:
+            self._loaded(room_id, load)
+            if room_id in self._rooms:
+                return self._rooms[room_id].snapshot()
+            if load.discarded:
+                return messages, next_before
+            ring = RoomRing(self.per_room, merge(messages, load.held), truncated=next_before is not None)
+            for kind, payload in load.held:
+                if kind == "replace":
+                    ring.replace(payload)
+            self._rooms[room_id] = ring
+            self._size += ring.size
+            self._evict()
+            return ring.snapshot()
+
+    def append(self, room_id, payload):
+        """
+        records a sent message, cold rooms are skipped and loaded on next open
+        """
+        with self._lock:
+            ring = self._rooms.get(room_id)
+            if ring is None:
+                self._hold(room_id, "append", payload)
+                return
+            self._rooms.move_to_end(room_id)
+            self._size += ring.append(payload)
+            self._evict()
+
+    def replace(self, room_id, payload):
+        """
+        records an edited or deleted message, if the room is warm
+        """
+        with self._lock:
+            ring = self._rooms.get(room_id)
+            if ring is not None:
+                self._size += ring.replace(payload)
+            else:
+                self._hold(room_id, "replace", payload)
+
+    def discard(self, room_id):
+        with self._lock:
+            ring = self._rooms.pop(room_id, None)
+            if ring is not None:
+                self._size -= ring.size
+            load = self._loading.pop(room_id, None)
+            if load is not None:
+                load.discarded = True
+
+    def _loaded(self, room_id, load):
+        load.loaders -= 1
+        if not load.loaders and self._loading.get(room_id) is load:
+            del self._loading[room_id]
+
+    def _hold(self, room_id, kind, payload):
+        load = self._loading.get(room_id)
+        if load is not None:
+            load.held.append((kind, payload))
+
+    def _evict(self):
+        # never evicts the room that was just touched
+        while self._size > self.budget and len(self._rooms) > 1:
+            _, ring = self._rooms.popitem(last=False)
+            self._size -= ring.size
+
+
+recent_messages = RecentMessageCache()
@@ -0,0 +1,320 @@
+"""
+Message retention
+
+A room can limit how long its messages are kept, Room.retention_days, and
+how many, Room.retention_count (the newest ones by Message.number). Both
+None keeps everything. Messages out of retention are deleted by the
+pruner, hot rows and archived segments alike, together with their room
+events (clients behind that point get a "reset" delta, see room_events.py).
+The attachments of pruned messages go too when no other message and no
+room banner points at them, and their blobs once no attachment row is left
+for the content. Archived messages are older than every hot one, so when a
+pass prunes a hot message it prunes any archived one sharing its
+attachment as well.
+
+Deleting is done in small batches, one short transaction each, so the
+SQLite write lock is never held for long: every batch is timed and the
+batch size halves when a batch took longer than CHAT_PRUNE_LOCK_MS and
+doubles, up to CHAT_PRUNE_BATCH, when it took less than a quarter of it.
+Between batches the pruner sleeps CHAT_PRUNE_PAUSE_MS so that chat writes
+waiting for the lock get it. Freed pages are returned to the file system
+with PRAGMA incremental_vacuum, CHAT_PRUNE_VACUUM_PAGES pages per step with
+the same pauses; that needs a database in auto_vacuum=INCREMENTAL mode,
+which new databases are (SQLITE_AUTO_VACUUM) and existing ones become after
+`flask prune-messages --enable-incremental-vacuum`.
+
+The pruner runs every CHAT_PRUNE_INTERVAL seconds and `flask
+prune-messages` runs one pass. Each pass logs the rows pruned per second
+and the longest batch.
+"""
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+import click
+import sqlalchemy as s
+from models import db, Room, Message, MessageSegment, Attachment
+from offload import run_blocking
+from attachments import attachment_store
+import archive
+import room_events
+
+
+logger = logging.getLogger(__name__)
+
+MIN_BATCH = 10
+
+
+def policy_rooms():
+    """
+    (room_id, retention_days, retention_count, message_count) of the rooms
+    with a retention policy
+    """
+    return db.session.execute(
+        s.select(Room.room_id, Room.retention_days, Room.retention_count, Room.message_count)
+        .where(s.or_(Room.retention_days.is_not(None), Room.retention_count.is_not(None)))
+    ).all()
+
+
+def expired(retention_days, retention_count, message_count, now):
+    """
+    conditions on Message for a room's messages out of retention, one per
+    limit so that each can use its own index
+    """
+    conditions = []
+    if retention_days is not None:
+        conditions.append(Message.date < now - timedelta(days=retention_days))
+    if retention_count is not None and message_count > retention_count:
+        conditions.append(Message.number <= message_count - retention_count)
+    return conditions
+
+
+def prune_batch(room_id, condition, size):
+    """
+    deletes up to size of the room's messages matching condition and
+    commits, returns how many
+    """
+    rows = db.session.execute(
+        s.select(Message.message_id, Message.attachment_id)
+        .where(Message.sent_to_room_id == room_id, condition).limit(size)
+    ).all()
+    if not rows:
+        return 0
+    ids = [row.message_id for row in rows]
+    room_events.drop_events(room_id, ids)
+    deleted = db.session.execute(
+        s.delete(Message).where(Message.message_id.in_(ids)).execution_options(synchronize_session=False)
+    ).rowcount
+    # the dashboard shows the newest message left, if any
+    db.session.execute(
+        s.update(Room).where(Room.room_id == room_id, Room.last_message_id.in_(ids))
+        .values(last_message_id=s.select(s.func.max(Message.message_id))
+                .where(Message.sent_to_room_id == room_id).scalar_subquery())
+    )
+    digests = drop_attachments({row.attachment_id for row in rows if row.attachment_id})
+    db.session.commit()
+    db.session.expunge_all()
+    remove_blobs(digests)
+    return deleted
+
+
+def prune_segments(room_id, retention_days, retention_count, now, size):
+    """
+    deletes up to size archived segments out of retention and commits,
+    returns the messages they held. Everything archived is older than every
+    hot message, so once the room has retention_count hot messages all of
+    its segments are out
+    """
+    conditions = []
+    if retention_days is not None:
+        conditions.append(MessageSegment.last_date < now - timedelta(days=retention_days))
+    if retention_count is not None:
+        hot = db.session.scalar(
+            s.select(s.func.count()).select_from(
+                s.select(Message.message_id).where(Message.sent_to_room_id == room_id)
+                .limit(retention_count).subquery()
+            )
+        )
+        if hot >= retention_count:
+            conditions.append(s.true())
+    if not conditions:
+        return 0
+    segments = db.session.execute(
+        s.select(MessageSegment.segment_id, MessageSegment.count, MessageSegment.codec, MessageSegment.data)
+        .where(MessageSegment.room_id == room_id, s.or_(*conditions))
+        .limit(size)
+    ).all()
+    if not segments:
+        return 0
+    attachment_ids = {payload["attachment"]["id"] for row in segments
+                      for payload in archive.decode(row.data, room_id, row.codec) if payload.get("attachment")}
+    db.session.execute(
+        s.delete(MessageSegment).where(MessageSegment.segment_id.in_([row.segment_id for row in segments]))
+    )
+    digests = drop_attachments(attachment_ids)
+    db.session.commit()
+    remove_blobs(digests)
+    return sum(row.count for row in segments)
+
+
+def drop_attachments(attachment_ids):
+    """
+    deletes the attachments among attachment_ids that no message and no
+    room banner points at any more, caller commits. Returns the sha256 of
+    the blobs that have no attachment row left
+    """
+    if not attachment_ids:
+        return []
+    ids = list(attachment_ids)
+    unused = db.session.execute(
+        s.select(Attachment.id, Attachment.sha256).where(
+            Attachment.id.in_(ids),
+            Attachment.id.not_in(s.select(Message.attachment_id).where(Message.attachment_id.in_(ids))),
+            Attachment.id.not_in(s.select(Room.room_banner).where(Room.room_banner.in_(ids))),
+        )
+    ).all()
+    if not unused:
+        return []
+    db.session.execute(s.delete(Attachment).where(Attachment.id.in_([row.id for row in unused])))
+    digests = {row.sha256 for row in unused}
+    shared = db.session.scalars(s.select(Attachment.sha256).where(Attachment.sha256.in_(digests))).all()
+    return sorted(digests.difference(shared))
+
+
+def remove_blobs(digests):
+    """
+    after the commit, a failed removal only leaves an orphaned file
+    """
+    for digest in digests:
+        try:
+            attachment_store.remove(digest)
+        except OSError:
+            logger.exception("removing blob %s failed", digest)
+
+
+def incremental_vacuum(pages):
+    """
+    frees up to `pages` pages, returns how many free pages are left, None
+    when the database can not do it
+    """
+    if db.engine.dialect.name != "sqlite":
+        return None
+    with db.engine.connect() as conn:
+        if conn.exec_driver_sql("PRAGMA auto_vacuum").scalar() != 2:
+            return None
+        # executescript steps the pragma to the end, a plain execute frees
+        # a single page
+        conn.connection.driver_connection.executescript(f"PRAGMA incremental_vacuum({int(pages)})")
+        return conn.exec_driver_sql("PRAGMA freelist_count").scalar()
+
+
+class Pruner:
+
+    def __init__(self, interval=300.0, max_batch=500, lock_budget=0.05, pause=0.02, vacuum_pages=256):
+        self.interval = interval
+        self.max_batch = max_batch
+        self.lock_budget = lock_budget
+        self.pause = pause
+        self.vacuum_pages = vacuum_pages
+        self.batch = max_batch
+        self.app = None
+        self.on_pruned = None  # called with the room ids after a pass
+        self.pruned = 0
+        self.rate = 0.0  # rows per second of the last pass
+        self.longest_batch = 0.0  # seconds, of the last pass
+        self._vacuum_warned = False
+        self._task = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self.interval = app.config.get("CHAT_PRUNE_INTERVAL", self.interval)
+        self.max_batch = self.batch = app.config.get("CHAT_PRUNE_BATCH", self.max_batch)
+        self.lock_budget = app.config.get("CHAT_PRUNE_LOCK_MS", self.lock_budget * 1000) / 1000
+        self.pause = app.config.get("CHAT_PRUNE_PAUSE_MS", self.pause * 1000) / 1000
+        self.vacuum_pages = app.config.get("CHAT_PRUNE_VACUUM_PAGES", self.vacuum_pages)
+
+    def adapt(self, elapsed):
+        """
+        the next batch size after a batch that held the lock for elapsed
+        seconds
+        """
+        if elapsed > self.lock_budget:
+            self.batch = max(MIN_BATCH, self.batch // 2)
+        elif elapsed < self.lock_budget / 4:
+            self.batch = min(self.max_batch, self.batch * 2)
+        self.longest_batch = max(self.longest_batch, elapsed)
+        return self.batch
+
+    def _in_app(self, fn, *args):
+        with self.app.app_context():
+            return fn(*args)
+
+    def _timed(self, fn, *args):
+        started = time.perf_counter()
+        count = run_blocking(self._in_app, fn, *args)
+        self.adapt(time.perf_counter() - started)
+        return count
+
+    def run_once(self, sleep=time.sleep, now=None):
+        """
+        one pass over every room with a policy, returns the ids of the rooms
+        that lost messages
+        """
+        now = now or datetime.now()
+        started = time.perf_counter()
+        self.longest_batch = 0.0
+        pruned, rooms = 0, []
+        for room_id, days, count, message_count in run_blocking(self._in_app, policy_rooms):
+            before = pruned
+            steps = [(prune_batch, room_id, condition) for condition in expired(days, count, message_count, now)]
+            steps.append((prune_segments, room_id, days, count, now))
+            for fn, *args in steps:
+                while True:
+                    # a segment holds up to CHAT_ARCHIVE_SEGMENT_SIZE messages
+                    size = self.batch if fn is prune_batch else max(1, self.batch // 100)
+                    deleted = self._timed(fn, *args, size)
+                    if not deleted:
+                        break
+                    pruned += deleted
+                    sleep(self.pause)
+            if pruned > before:
+                rooms.append(room_id)
+        self.pruned += pruned
+        if pruned:
+            elapsed = time.perf_counter() - started
+            self.rate = pruned / elapsed if elapsed else 0.0
+            self.vacuum(sleep)
+            logger.info("pruned %d messages in %.1f s (%.0f rows/s), longest batch %.0f ms",
+                        pruned, elapsed, self.rate, self.longest_batch * 1000)
+        return rooms
+
+    def vacuum(self, sleep=time.sleep):
+        while True:
+            left = run_blocking(self._in_app, incremental_vacuum, self.vacuum_pages)
+            if left is None and not self._vacuum_warned:
+                self._vacuum_warned = True
+                logger.info("incremental vacuum is off, run `flask prune-messages --enable-incremental-vacuum`"
+                            " once to reclaim the space of pruned messages")
+            if not left:
+                return
+            sleep(self.pause)
+
+    def run(self, sleep=time.sleep):
+        while True:
+            sleep(self.interval)
+            try:
+                rooms = self.run_once(sleep)
+                if rooms and self.on_pruned is not None:
+                    self.on_pruned(rooms)
+            except Exception:
+                logger.exception("retention pass failed")
+
+    def start(self, socketio):
+        """
+        starts the pruning loop once per process
+        """
+        with self._lock:
+            if self._task is None:
+                self._task = socketio.start_background_task(self.run, socketio.sleep)
+
+
+pruner = Pruner()
+
+
+@click.command("prune-messages")
+@click.option("--enable-incremental-vacuum", is_flag=True,
+              help="switch a SQLite database to auto_vacuum=INCREMENTAL, rewrites the whole file")
+def prune_command(enable_incremental_vacuum):
+    """
+    deletes every message out of retention
+    """
+    if enable_incremental_vacuum:
+        with db.engine.connect() as conn:
+            conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+            conn.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.exec_driver_sql("VACUUM")
+        click.echo("incremental vacuum enabled")
+    before = pruner.pruned
+    rooms = pruner.run_once()
+    click.echo(f"done, {pruner.pruned - before} messages pruned in {len(rooms)} rooms ({pruner.rate:.0f} rows/s)")
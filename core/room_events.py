@@ -0,0 +1,136 @@
+"""
+Room event log
+
+Every change to a room's messages is appended to room_event: "create" when
+the write buffer inserts a message, "edit" and "delete" when its sender
+changes it. seq is a single autoincrement, so within a room it only ever
+grows and a reconnecting client only has to say which seq it has seen:
+
+    delta(room_id, since) -> {"seq": ..., "messages": [...], "deleted": [ids]}
+
+messages is the current state of every message created or edited after
+`since`, once each, deleted the ids removed since then (a message created
+and removed in between is left out altogether). When more than
+MAX_DELTA_EVENTS happened the delta is no cheaper than a reload and comes
+back as {"seq": ..., "reset": true} instead, and so does a delta from before
+events that were dropped with their messages by the archiver or the
+retention pruner (Room.archived_event_seq, see drop_events).
+
+Live events carry their seq too: "message", "message_edited" and
+"message_deleted" payloads are full message payloads plus "seq".
+"""
+from datetime import datetime
+import sqlalchemy as s
+from models import db, Room, Message, RoomEvent
+
+
+MAX_DELTA_EVENTS = 500
+
+
+def _append(events):
+    return db.session.scalars(
+        s.insert(RoomEvent).returning(RoomEvent.seq, sort_by_parameter_order=True), events
+    ).all()
+
+
+def record_created(rows, message_ids):
+    """
+    create events for a batch of freshly inserted write buffer rows, returns
+    their seqs. Caller commits
+    """
+    return _append([
+        {"room_id": row["sent_to_room_id"], "message_id": message_id,
+         "kind": "create", "version": 1, "date": row["date"]}
+        for row, message_id in zip(rows, message_ids)
+    ])
+
+
+def drop_events(room_id, message_ids):
+    """
+    removes the events of messages that are leaving the message table and
+    moves the room's horizon past them, caller commits
+    """
+    dropped_seq = db.session.scalar(
+        s.select(s.func.max(RoomEvent.seq)).where(RoomEvent.message_id.in_(message_ids))
+    )
+    db.session.execute(s.delete(RoomEvent).where(RoomEvent.message_id.in_(message_ids)))
+    if dropped_seq:
+        db.session.execute(
+            s.update(Room).where(Room.room_id == room_id, Room.archived_event_seq < dropped_seq)
+            .values(archived_event_seq=dropped_seq)
+        )
+
+
+def latest_seq(room_id):
+    return db.session.scalar(
+        s.select(s.func.max(RoomEvent.seq)).where(RoomEvent.room_id == room_id)
+    ) or 0
+
+
+def _change(message_id, user_id, kind, values):
+    now = datetime.now()
+    message = db.session.scalar(
+        s.update(Message)
+        .where(Message.message_id == message_id, Message.sent_id == user_id,
+               Message.deleted_at.is_(None))
+        .values(version=Message.version + 1, **values(now))
+        .returning(Message)
+    )
+    if message is None:
+        return None
+    seq, = _append([{"room_id": message.sent_to_room_id, "message_id": message_id,
+                     "kind": kind, "version": message.version, "date": now}])
+    payload = message.serialize()
+    db.session.commit()
+    payload["seq"] = seq
+    return payload
+
+
+def edit_message(message_id, user_id, body):
+    """
+    changes the body of one of user_id's messages and commits, returns the
+    new payload or None when there is no such live message of theirs
+    """
+    return _change(message_id, user_id, "edit",
+                   lambda now: {"message_body": body, "edited_at": now})
+
+
+def delete_message(message_id, user_id):
+    """
+    turns one of user_id's messages into a tombstone and commits, returns the
+    tombstone payload or None like edit_message
+    """
+    return _change(message_id, user_id, "delete",
+                   lambda now: {"message_body": "", "attachment_id": None, "deleted_at": now})
+
+
+def delta(room_id, since, limit=MAX_DELTA_EVENTS):
+    """
+    what changed in room_id after seq `since`, see the module docstring
+    """
+    horizon = db.session.scalar(s.select(Room.archived_event_seq).where(Room.room_id == room_id)) or 0
+    if since < horizon:
+        return {"seq": latest_seq(room_id), "reset": True}
+    events = db.session.execute(
+        s.select(RoomEvent.seq, RoomEvent.message_id, RoomEvent.kind)
+        .where(RoomEvent.room_id == room_id, RoomEvent.seq > since)
+        .order_by(RoomEvent.seq)
+        .limit(limit + 1)
+    ).all()
+    if not events:
+        return {"seq": since, "messages": [], "deleted": []}
+    if len(events) > limit:
+        return {"seq": latest_seq(room_id), "reset": True}
+    created = {message_id for _, message_id, kind in events if kind == "create"}
+    touched = {message_id for _, message_id, _ in events}
+    alive = db.session.scalars(
+        s.select(Message)
+        .where(Message.message_id.in_(touched), Message.deleted_at.is_(None))
+        .order_by(Message.message_id)
+    ).all()
+    alive_ids = {message.message_id for message in alive}
+    return {
+        "seq": events[-1].seq,
+        "messages": [message.serialize() for message in alive],
+        "deleted": sorted(touched - alive_ids - created),
+    }
@@ -0,0 +1,170 @@
+"""
+Room list queries for the dashboard
+
+Everything the dashboard shows for a user's rooms comes from one SELECT:
+the membership rows joined to the room, the room's last message through the
+denormalized Room.last_message_id pointer, and the unread count.
+
+Unread counts are a subtraction, Room.message_count minus the member's
+last_read_number, no message row is looked at. Every stored message counts,
+a message deleted after it was sent stays counted until the member reads
+past it. Receipts not flushed yet (read_receipts.pending) are applied on
+top, the same way for the dashboard and for /rooms/unread.
+"""
+from collections import namedtuple
+import sqlalchemy as s
+from sqlalchemy.orm import aliased
+from models import db, Room, Message, association_table
+
+
+PREVIEW_LENGTH = 80
+
+RoomSummary = namedtuple(
+    "RoomSummary",
+    ["room_id", "room_name", "joining_url", "member_count", "last_message", "last_message_date", "unread",
+     "notify_level"],
+)
+
+
+def user_rooms(user_id, pending=None):
+    """
+    one round-trip list of the user's rooms, most recently active first.
+    pending is read_receipts.pending(user_id)
+    """
+    last = aliased(Message)
+    rows = db.session.execute(
+        s.select(
+            Room.room_id,
+            Room.room_name,
+            Room.joining_url,
+            Room.member_count,
+            s.func.substr(last.message_body, 1, PREVIEW_LENGTH),
+            last.date,
+            Room.message_count,
+            association_table.c.last_read_number,
+            association_table.c.notify_level,
+        )
+        .join(association_table, association_table.c.right_id == Room.room_id)
+        .outerjoin(last, last.message_id == Room.last_message_id)
+        .where(association_table.c.left_id == user_id)
+        .order_by(last.date.desc().nulls_last(), Room.room_name)
+    ).all()
+    pending = pending or {}
+    return [RoomSummary(*row[:6], unread(row[0], row[6], row[7], pending), row[8]) for row in rows]
+
+
+def unread(room_id, count, last_read, pending):
+    """
+    count - last_read with the user's pending receipt for the room, if any,
+    applied. pending is {room_id: number, None for everything}
+    """
+    if room_id in pending:
+        number = pending[room_id]
+        last_read = count if number is None else max(last_read, number)
+    return max(count - last_read, 0)
+
+
+def unread_counts(user_id):
+    """
+    {room_id: (message_count, last_read_number)} for all of the user's rooms
+    in one query
+    """
+    rows = db.session.execute(
+        s.select(Room.room_id, Room.message_count, association_table.c.last_read_number)
+        .join(association_table, association_table.c.right_id == Room.room_id)
+        .where(association_table.c.left_id == user_id)
+    ).all()
+    return {room_id: (count, last_read) for room_id, count, last_read in rows}
+
+
+class RoomFull(Exception):
+    """
+    raised by add_member when the room is at its member cap
+    """
+
+
+def add_member(user_id, room_id, default_cap=None, role=0):
+    """
+    membership row plus the member counter, caller commits. role is one of
+    the moderation.py roles. The counter is
+    only bumped while under the room's max_members (default_cap when the
+    room has none, no cap when both are None), in the same statement so
+    concurrent joins can not overshoot
+    """
+    cap = s.func.coalesce(Room.max_members, default_cap)
+    result = db.session.execute(
+        s.update(Room)
+        .where(Room.room_id == room_id, s.or_(cap.is_(None), Room.member_count < cap))
+        .values(member_count=Room.member_count + 1)
+    )
+    if result.rowcount == 0:
+        raise RoomFull(room_id)
+    db.session.execute(s.insert(association_table).values(left_id=user_id, right_id=room_id, role=role))
+
+
+def number_messages(rows):
+    """
+    gives each write buffer row the next Message.number of its room, one
+    UPDATE ... RETURNING per room in the batch, caller commits. rows are in
+    insertion order
+    """
+    counts = {}
+    for row in rows:
+        counts[row["sent_to_room_id"]] = counts.get(row["sent_to_room_id"], 0) + 1
+    next_number = {}
+    for room_id, count in counts.items():
+        last = db.session.scalar(
+            s.update(Room).where(Room.room_id == room_id)
+            .values(message_count=Room.message_count + count)
+            .returning(Room.message_count)
+        )
+        next_number[room_id] = (last or count) - count + 1
+    for row in rows:
+        row["number"] = next_number[row["sent_to_room_id"]]
+        next_number[row["sent_to_room_id"]] += 1
+
+
+def mark_read(marks):
+    """
+    moves read pointers forward, never back and never past the room's
+    message_count. marks are (user_id, room_id, number) with number None for
+    everything in the room. Two executemany UPDATEs whatever the number of
+    marks, caller commits
+    """
+    table = association_table
+    member = s.and_(table.c.left_id == s.bindparam("uid"), table.c.right_id == s.bindparam("rid"))
+    count = s.select(Room.message_count).where(Room.room_id == table.c.right_id).scalar_subquery()
+    upto = [{"uid": user_id, "rid": room_id, "n": number} for user_id, room_id, number in marks
+            if number is not None]
+    everything = [{"uid": user_id, "rid": room_id} for user_id, room_id, number in marks if number is None]
+    if upto:
+        number = s.bindparam("n", type_=s.Integer)
+        # min(:n, message_count), a client can not read ahead of the room
+        number = s.case((number < count, number), else_=count)
+        db.session.execute(
+            s.update(table).where(member, table.c.last_read_number < number)
+            .values(last_read_number=number),
+            upto,
+        )
+    if everything:
+        db.session.execute(
+            s.update(table).where(member, table.c.last_read_number < count)
+            .values(last_read_number=count),
+            everything,
+        )
+
+
+def advance_last_message(room_ids_to_last_id):
+    """
+    points each room at its newest message, used by the write buffer flush
+    """
+    if not room_ids_to_last_id:
+        return
+    room = Room.__table__
+    db.session.execute(
+        s.update(room)
+        .where(room.c.room_id == s.bindparam("rid"),
+               s.or_(room.c.last_message_id.is_(None), room.c.last_message_id < s.bindparam("mid")))
+        .values(last_message_id=s.bindparam("mid")),
+        [{"rid": room_id, "mid": message_id} for room_id, message_id in room_ids_to_last_id.items()],
+    )
@@ -0,0 +1,140 @@
+"""
+Message search
+
+SQLite: an FTS5 index (message_fts) over message.message_body, stored as an
+external content table so the text is not duplicated. Triggers on message
+keep it up to date on insert, edit and delete, including the write buffer's
+bulk inserts. Results are ranked with bm25.
+
+Postgres: a generated tsvector column (message.search_vector) with a GIN
+index, ranked with ts_rank.
+
+Both are created by `flask init-db` and by the migration, `flask
+reindex-search` rebuilds the SQLite index from the message table in batches.
+"""
+import click
+import sqlalchemy as s
+from sqlalchemy import event, DDL
+from models import db, Message, association_table
+
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+SQLITE_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5("
+    "message_body, content='message', content_rowid='message_id', tokenize='unicode61')",
+    "CREATE TRIGGER IF NOT EXISTS message_fts_insert AFTER INSERT ON message BEGIN "
+    "INSERT INTO message_fts(rowid, message_body) VALUES (new.message_id, new.message_body); END",
+    "CREATE TRIGGER IF NOT EXISTS message_fts_delete AFTER DELETE ON message BEGIN "
+    "INSERT INTO message_fts(message_fts, rowid, message_body) "
+    "VALUES ('delete', old.message_id, old.message_body); END",
+    "CREATE TRIGGER IF NOT EXISTS message_fts_update AFTER UPDATE OF message_body ON message BEGIN "
+    "INSERT INTO message_fts(message_fts, rowid, message_body) "
+    "VALUES ('delete', old.message_id, old.message_body); "
+    "INSERT INTO message_fts(rowid, message_body) VALUES (new.message_id, new.message_body); END",
+]
+
+POSTGRES_DDL = [
+    "ALTER TABLE message ADD COLUMN IF NOT EXISTS search_vector tsvector "
+    "GENERATED ALWAYS AS (to_tsvector('simple', coalesce(message_body, ''))) STORED",
+    "CREATE INDEX IF NOT EXISTS ix_message_search_vector ON message USING gin (search_vector)",
+]
+
+for statement in SQLITE_DDL:
+    event.listen(Message.__table__, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+for statement in POSTGRES_DDL:
+    event.listen(Message.__table__, "after_create", DDL(statement).execute_if(dialect="postgresql"))
+
+
+def fts5_query(text):
+    """
+    user input as an FTS5 query: every word must match, the last one as a
+    prefix. Words are quoted so FTS5 syntax in the input is taken literally
+    """
+    words = text.split()
+    if not words:
+        return None
+    quoted = ['"' + word.replace('"', '""') + '"' for word in words]
+    quoted[-1] += "*"
+    return " ".join(quoted)
+
+
+def search(user_id, text, room_id=None, sender_id=None, page=1, limit=None):
+    """
+    ranked page of messages matching text in the rooms user_id belongs to,
+    narrowed to one room and/or one sender. Returns (results, has_more)
+    """
+    limit = max(1, min(int(limit or DEFAULT_PAGE_SIZE), MAX_PAGE_SIZE))
+    offset = (max(1, int(page)) - 1) * limit
+    member_rooms = s.select(association_table.c.right_id).where(association_table.c.left_id == user_id)
+
+    if db.engine.dialect.name == "postgresql":
+        query = s.func.plainto_tsquery("simple", text)
+        vector = s.column("search_vector")
+        rank = s.func.ts_rank(vector, query)
+        stmt = s.select(Message, rank.label("rank")).where(vector.op("@@")(query)).order_by(rank.desc())
+    else:
+        match = fts5_query(text)
+        if match is None:
+            return [], False
+        fts = s.table("message_fts", s.column("rowid"), s.column("rank"))
+        stmt = (
+            s.select(Message, fts.c.rank)
+            .join(fts, fts.c.rowid == Message.message_id)
+            .where(s.text("message_fts MATCH :match").bindparams(match=match))
+            # FTS5's rank column is bm25(), lower is better
+            .order_by(fts.c.rank)
+        )
+
+    stmt = stmt.where(Message.sent_to_room_id.in_(member_rooms))
+    if room_id is not None:
+        stmt = stmt.where(Message.sent_to_room_id == room_id)
+    if sender_id is not None:
+        stmt = stmt.where(Message.sent_id == sender_id)
+    rows = db.session.execute(stmt.limit(limit + 1).offset(offset)).all()
+    return [message.serialize() for message, _ in rows[:limit]], len(rows) > limit
+
+
+def reindex(batch_size=1000, echo=None):
+    """
+    rebuilds message_fts in keyset batches of batch_size rows, committing
+    after each, so neither Python nor the write lock holds the whole table
+    """
+    if db.engine.dialect.name != "sqlite":
+        # the Postgres column is generated, it can not go stale
+        return 0
+    for statement in SQLITE_DDL:
+        db.session.execute(s.text(statement))
+    db.session.execute(s.text("INSERT INTO message_fts(message_fts) VALUES ('delete-all')"))
+    db.session.commit()
+    last_id, total = 0, 0
+    while True:
+        rows = db.session.execute(
+            s.select(Message.message_id, Message.message_body)
+            .where(Message.message_id > last_id)
+            .order_by(Message.message_id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        db.session.execute(
+            s.text("INSERT INTO message_fts(rowid, message_body) VALUES (:id, :body)"),
+            [{"id": message_id, "body": body} for message_id, body in rows],
+        )
+        db.session.commit()
+        last_id = rows[-1][0]
+        total += len(rows)
+        if echo is not None:
+            echo(f"indexed {total} messages")
+    return total
+
+
+@click.command("reindex-search")
+@click.option("--batch-size", default=1000, show_default=True)
+def reindex_command(batch_size):
+    """
+    rebuilds the message search index
+    """
+    total = reindex(batch_size, echo=click.echo)
+    click.echo(f"done, {total} messages indexed")
@@ -15,52 +15,129 @@ def handle_json(json):
 
 
 """
-
-from flask import Flask, render_template, redirect, url_for, flash, request
-from flask_socketio import SocketIO
-from flask_login import LoginManager, login_user, logout_user, login_required, current_user
+import offload
+offload.patch()  # must come before anything imports socket or threading
+
+import os
+import math
+import hmac
+from functools import wraps
+from flask import Blueprint, render_template, redirect, url_for, flash, request, jsonify, abort, send_file, current_app, \
+    session
+from flask_login import login_user, logout_user, login_required, current_user
 import models as orm
-from models import app, db
+from models import db
 import sqlalchemy as s
 from urllib.parse import urlsplit
 from forms import LoginForm, RegistrationForm
-import requests
-from gen_link import gen_link
+from invites import new_invite_code, code_from_url, invite_cache
+from hashing import HashingBusy
+from user_cache import user_cache, SessionUser
+from chat_namespace import is_member
+from extensions import login_manager, socketio
+import history
+import room_list
+import search
+import room_events
+from recent_messages import recent_messages
+from attachments import attachment_store, allowed_type, AttachmentTooLarge
+from limits import rate_limiter, RateLimited
+from metrics import metrics
+from notifications import notifications, set_level, LEVELS
+from read_receipts import read_receipts
+from sessions import sessions
+import moderation
+
+
+# the views, registered on the app by app.create_app
+bp = Blueprint("chat", __name__)
+
+
+@bp.route("/")
+def home():
+    """
+    Default view
+    """
+    return render_template("base.html")
 
 
+@bp.before_request
+def limit_requests():
+    """
+    per user request budget, per address before sign in, see limits.py
+    """
+    key = current_user.id if current_user.is_authenticated else request.remote_addr
+    rate_limiter.check(("http", key))
 
-# app = Flask(__name__)
-# db.init_app(app)
 
+@bp.app_errorhandler(RateLimited)
+def rate_limited(error):
+    return "Too many requests, slow down", 429, {"Retry-After": str(math.ceil(error.retry_after))}
 
-app.config["SECRET_KEY"] = "secret!"
-socketio = SocketIO(app)
-login_manager = LoginManager(app)
 
+# User auth
+@bp.app_errorhandler(HashingBusy)
+def hashing_busy(error):
+    """
+    admission control for /login and /register, see hashing.py
+    """
+    return "Too many sign-ins right now, please try again in a moment", 503, {"Retry-After": "1"}
 
-# current session
-session = db.session
 
+def load_user_snapshot(user_id):
+    user = db.session.get(orm.User, user_id)
+    return SessionUser.from_user(user) if user is not None else None
 
 
-@app.route("/")
-def home():
+@login_manager.user_loader
+def load_user(token):
     """
-    Default view
+    token is a server-side session token, see sessions.py. current_user is
+    a cached SessionUser snapshot, not an ORM instance, views that need the
+    row load it with db.session.get
     """
-    return render_template("base.html")
+    user_id = sessions.user_id(token)
+    if user_id is None:
+        return None
+    # the socket handlers and the upload view are not offloaded, a cache miss
+    # there must not query from the event loop
+    return user_cache.get(user_id, lambda user_id: offload.run_blocking(load_user_snapshot, user_id))
 
 
-# User auth
-@login_manager.user_loader
-def load_user(user_id):
-    try:
-        return orm.User.query.get(user_id)
-    except:
-        return None
+def metrics_token_required(view):
+    """
+    for the operator endpoints: the request must carry CHAT_METRICS_TOKEN as
+    "Authorization: Bearer <token>", and without a token set they are off
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        token = current_app.config.get("CHAT_METRICS_TOKEN")
+        if not token:
+            abort(404)
+        scheme, _, given = request.headers.get("Authorization", "").partition(" ")
+        if scheme.lower() != "bearer" or not hmac.compare_digest(given.encode(), token.encode()):
+            abort(401)
+        return view(*args, **kwargs)
+    return wrapper
+
+
+@bp.route("/stats/user-cache", methods=["GET"])
+@metrics_token_required
+def user_cache_stats():
+    return jsonify(user_cache.stats())
+
+
+@bp.route("/metrics", methods=["GET"])
+@metrics_token_required
+def metrics_text():
+    """
+    Prometheus text exposition, see metrics.py
+    """
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
 
 
-@app.route("/login", methods=["GET", "POST"])
+@bp.route("/login", methods=["GET", "POST"])
+@offload.blocking
 def login():
     """
     Login view
@@ -69,7 +146,7 @@ def login():
     #     return redirect(url_for("dashboard"))
     form = LoginForm()
     if current_user.is_authenticated:
-        return redirect(url_for("dashboard"))
+        return redirect(url_for("chat.dashboard"))
     if request.method == "GET":
         return render_template("login.html", form=form)
     if request.method == "POST":
@@ -82,12 +159,16 @@ def login():
         # with input password, if they match, means user is valid, creds are matching
         if user is None or not user.check_password(form.password.data):
             flash("Invalid username or password")
-            return redirect(url_for("login"))
-        login_user(user, remember=form.remember_me.data)
+            return redirect(url_for("chat.login"))
+        if user.password_needs_rehash():
+            user.set_password(form.password.data)
+            db.session.commit()
+        token = sessions.login(user.id, remember=form.remember_me.data)
+        login_user(SessionUser.from_user(user, token), remember=form.remember_me.data)
         next_page = request.args.get("next")
         if not next_page or urlsplit(next_page).netloc != "":
-            next_page = url_for("home")
-        return redirect(url_for("dashboard"))
+            next_page = url_for("chat.home")
+        return redirect(url_for("chat.dashboard"))
         # the login system is working now
 
         # password_check = orm.User.check_password(request.form["password"])
@@ -108,33 +189,60 @@ def login():
     return render_template("login.html")
 
 
-@app.route("/logout")
+@bp.route("/logout")
 @login_required
 def logout():
     """
     Logout view
     """
+    sessions.logout(session.get("_user_id"))
+    logout_user()
+    return redirect(url_for("chat.home"))
+
+
+@bp.route("/sessions", methods=["GET"])
+@login_required
+def session_count():
+    """
+    how many live sessions the user has, see sessions.py
+    """
+    return jsonify(active=sessions.count(current_user.id))
+
+
+@bp.route("/sessions/revoke", methods=["POST"])
+@login_required
+def revoke_sessions():
+    """
+    signs the user out everywhere, this session included, and closes their
+    sockets on every node
+    """
+    user_id = current_user.id
+    revoked = sessions.revoke_user(user_id)
     logout_user()
-    return redirect(url_for("home"))
+    current_app.extensions["chat"].disconnect_user(user_id)
+    return jsonify(revoked=revoked)
 
 
-@app.route("/dashboard", methods=["GET"])
+@bp.route("/dashboard", methods=["GET"])
+@offload.blocking
 @login_required
 def dashboard():
     """
     Dashboard view, is accessible after successful register/login
     """
-    return render_template("dashboard.html")
+    rooms = room_list.user_rooms(current_user.id, read_receipts.pending(current_user.id))
+    return render_template("dashboard.html", rooms=rooms)
 
 
-@app.route("/register", methods=["GET", "POST"])
+@bp.route("/register", methods=["GET", "POST"])
+@offload.blocking
 def user_register():
     """
     register view
     """
     form = RegistrationForm() # class's instance is mapped to form page' data now
     if current_user.is_authenticated:
-        return redirect(url_for("dashboard"))
+        return redirect(url_for("chat.dashboard"))
     if request.method == "GET":
         flash("Entered in the GET request")
         return render_template("register.html", form=form)
@@ -145,7 +253,7 @@ def user_register():
                                 password=form.password.data, email=form.email.data)
             db.session.add(new_user)
             db.session.commit()
-            return redirect(url_for("login"))
+            return redirect(url_for("chat.login"))
     return render_template("register.html", form=form)
 
         # username = request.form["username"]
@@ -169,58 +277,363 @@ def user_register():
         #     return redirect(url_for("login"))     
 
 
-@app.route("/create", methods=["GET", "POST"])
+@bp.route("/create", methods=["GET", "POST"])
 @login_required
 def create_room():
+    """
+    not offloaded as a whole for the same reason as upload_attachment, the
+    banner is streamed from here and only the database work goes to the pool
+    """
     if request.method == "GET":
         return render_template("create-room.html")
     else: # some error returns 400 on POST
         room_name = request.form["roomname"]
-        # external image server
-        flash("continuing the post req")
-        #third_party_url = "https://api.imgbb.com/1/upload?expiration=600&key=232a019e6eebdad639ac9080d8897172/" + request.form["banner"]
-        #banner_url = requests.post(third_party_url)
-        # api response in JSON, we need to parse and get url
-        banner_url = "empty"
-        # generating unique url for the room
-        domain = "http://127.0.0.1/" + gen_link()
-        new_room = orm.Room(room_name, banner_url, domain, orm.User)
-        current_user.admin_status = True
-        db.session.add(new_room)
-        db.session.commit()
-        new_room.users.insert(current_user)
-        db.session.commit()
-        return redirect(url_for("dashboard"))
-
-
-
-
-
-@app.route("/join", methods=["GET", "POST"])
+        max_members = request.form.get("max_members", type=int)
+        banner_id = None
+        banner = request.files.get("banner")
+        if banner is not None and banner.filename:
+            # uploader only until add_room hands it to the room
+            banner_id = store_upload(banner.stream, banner.mimetype, banner.filename, None)["id"]
+        offload.run_blocking(add_room, room_name, banner_id,
+                             max_members if max_members and max_members > 0 else None)
+        return redirect(url_for("chat.dashboard"))
+
+
+def add_room(room_name, banner_id, max_members):
+    """
+    the room, its creator as admin and its banner, then commits
+    """
+    # generating unique url for the room
+    code = new_invite_code()
+    domain = url_for("chat.join_invite", code=code, _external=True)
+    user = db.session.get(orm.User, current_user.id)
+    new_room = orm.Room(room_name, None, domain, user, invite_code=code, max_members=max_members)
+    db.session.add(new_room)
+    db.session.flush()
+    if banner_id is not None:
+        # room_banner holds the id of the banner's attachment
+        new_room.room_banner = banner_id
+        db.session.get(orm.Attachment, banner_id).room_id = new_room.room_id
+    room_list.add_member(user.id, new_room.room_id, role=moderation.ROLE_ADMIN)
+    db.session.commit()
+
+
+@bp.route("/join", methods=["GET", "POST"])
+@offload.blocking
 @login_required
 def join_room():
     if request.method == "GET":
         return render_template("join-room.html")
-    url = request.form["url"]
-    room = db.session.scalar(
-        s.select(orm.Room).where(url == orm.Room.room_name)
-    )
+    return join_by_code(code_from_url(request.form["url"]))
+
+
+@bp.route("/join/<code>", methods=["GET"])
+@offload.blocking
+@login_required
+def join_invite(code):
+    """
+    the room's joining_url points here
+    """
+    return join_by_code(code)
+
+
+def join_by_code(code):
+    room = invite_cache.resolve(code)
     if room is not None:
-        orm.Room.users.append(current_user)
-        flash(f"successfully joined {room.room_name}")
-        return redirect(url_for("dashboard"))
+        room_id, room_name = room
+        if not is_member(current_user.id, room_id):
+            try:
+                room_list.add_member(current_user.id, room_id, current_app.config.get("CHAT_ROOM_MAX_MEMBERS"))
+            except room_list.RoomFull:
+                db.session.rollback()
+                flash(f"{room_name} is full")
+                return redirect(url_for("chat.dashboard"))
+            db.session.commit()
+            notifications.invalidate(room_id)
+        flash(f"successfully joined {room_name}")
+        return redirect(url_for("chat.dashboard"))
     else:
         flash("Room does not exist !")
-        return redirect(url_for("join_room"))
+        return redirect(url_for("chat.join_room"))
 
 
-@app.route("/message_room/<detail>", methods=["GET", "POST"])
+@bp.route("/message_room/<detail>", methods=["GET", "POST"])
 @login_required
 def open_room(detail):
+    if not offload.run_blocking(is_member, current_user.id, detail):
+        abort(404)
     if request.method == "GET":
-        return render_template("message-room.html")
+        # first screen comes from the in-memory ring, messages are only read
+        # from the DB for a cold room
+        messages, next_before = recent_messages.get(detail, history.load_recent)
+        return render_template("message-room.html", room_id=detail,
+                               messages=messages, next_before=next_before)
+
+
+@bp.route("/rooms/<room_id>/notifications", methods=["POST"])
+@offload.blocking
+@login_required
+def room_notifications(room_id):
+    """
+    level=all|digest|mute, as a form field or JSON, see notifications.py
+    """
+    data = request.get_json(silent=True) or request.form
+    level = LEVELS.get(data.get("level"))
+    if level is None:
+        abort(400)
+    if not set_level(current_user.id, room_id, level):
+        abort(404)
+    db.session.commit()
+    notifications.invalidate(room_id)
+    if request.is_json:
+        return jsonify(room_id=room_id, level=data["level"])
+    return redirect(url_for("chat.dashboard"))
+
+
+def moderation_request():
+    """
+    the JSON body's user_ids
+    """
+    user_ids = (request.get_json(silent=True) or {}).get("user_ids")
+    if not isinstance(user_ids, list) or not 0 < len(user_ids) <= moderation.MAX_USERS \
+            or not all(isinstance(user_id, str) for user_id in user_ids):
+        abort(400)
+    return set(user_ids)
+
+
+def apply_moderation(action, room_id, *args):
+    if not moderation.is_admin(current_user.id, room_id):
+        abort(403)
+    payload = action(room_id, *args)
+    db.session.commit()
+    return payload
+
+
+def moderate(event, action, room_id, *args):
+    """
+    runs a moderation.py action for an admin of the room and publishes its
+    event once. Only the database work is offloaded, the publish stays on
+    the request's own thread like the socket handlers' publishes
+    """
+    payload = offload.run_blocking(apply_moderation, action, room_id, moderation_request(), *args)
+    if payload["user_ids"]:
+        current_app.extensions["chat"].fanout.publish(room_id, event, payload)
+    return jsonify(payload)
+
 
+@bp.route("/rooms/<room_id>/moderation/purge", methods=["POST"])
+@login_required
+def purge_messages(room_id):
+    """
+    {"user_ids": [...]}, deletes every message they sent to the room
+    """
+    return moderate("messages_purged", moderation.purge_messages, room_id)
+
+
+@bp.route("/rooms/<room_id>/moderation/kick", methods=["POST"])
+@login_required
+def kick_members(room_id):
+    """
+    {"user_ids": [...]}, removes them from the room
+    """
+    return moderate("members_removed", moderation.kick, room_id)
+
+
+@bp.route("/rooms/<room_id>/moderation/roles", methods=["POST"])
+@login_required
+def change_roles(room_id):
+    """
+    {"user_ids": [...], "role": "admin"|"member"}
+    """
+    role = moderation.ROLES.get((request.get_json(silent=True) or {}).get("role"))
+    if role is None:
+        abort(400)
+    return moderate("roles_changed", moderation.set_role, room_id, role)
+
+
+@bp.route("/rooms/<room_id>/retention", methods=["POST"])
+@offload.blocking
+@login_required
+def room_retention(room_id):
+    """
+    {"max_age_days": n|null, "max_count": n|null}, admins only, null keeps
+    everything. Pruned in the background, see retention.py
+    """
+    data = request.get_json(silent=True) or {}
+    days, count = data.get("max_age_days"), data.get("max_count")
+    for value in (days, count):
+        if value is not None and (not isinstance(value, int) or isinstance(value, bool) or value < 1):
+            abort(400)
+    if not moderation.is_admin(current_user.id, room_id):
+        abort(403)
+    db.session.execute(
+        s.update(orm.Room).where(orm.Room.room_id == room_id)
+        .values(retention_days=days, retention_count=count)
+    )
+    db.session.commit()
+    return jsonify(room_id=room_id, max_age_days=days, max_count=count)
+
+
+@bp.route("/rooms/unread", methods=["GET"])
+@offload.blocking
+@login_required
+def unread_counts():
+    """
+    {"rooms": {room_id: unread}} for every room of the user, one query
+    """
+    return jsonify(rooms=read_receipts.unread(current_user.id, room_list.unread_counts(current_user.id)))
+
+
+@bp.route("/rooms/<room_id>/messages", methods=["GET"])
+@offload.blocking
+@login_required
+def room_messages(room_id):
+    """
+    keyset paginated history, ?before=<message_id>&limit=N
+    """
+    if not is_member(current_user.id, room_id):
+        abort(404)
+    before = request.args.get("before", type=int)
+    limit = request.args.get("limit", type=int)
+    messages, next_before = history.fetch_page(room_id, before=before, limit=limit)
+    return jsonify(messages=messages, next_before=next_before)
+
+
+@bp.route("/rooms/<room_id>/events", methods=["GET"])
+@offload.blocking
+@login_required
+def room_event_delta(room_id):
+    """
+    ?since=<seq>, what changed in the room after that seq, see room_events.py
+    """
+    if not is_member(current_user.id, room_id):
+        abort(404)
+    since = request.args.get("since", type=int)
+    if since is None:
+        abort(400)
+    return jsonify(room_events.delta(room_id, since))
+
+
+@bp.route("/search", methods=["GET"])
+@offload.blocking
+@login_required
+def search_messages():
+    """
+    ranked search over the user's rooms, ?q=...&room_id=...&sender_id=...&page=N&limit=N
+    """
+    text = request.args.get("q", "").strip()
+    if not text:
+        return jsonify(messages=[], page=1, has_more=False)
+    page = request.args.get("page", 1, type=int)
+    results, has_more = search.search(
+        current_user.id,
+        text,
+        room_id=request.args.get("room_id"),
+        sender_id=request.args.get("sender_id"),
+        page=page,
+        limit=request.args.get("limit", type=int),
+    )
+    return jsonify(messages=results, page=page, has_more=has_more)
+
+def add_attachment(digest, size, content_type, filename, room_id):
+    attachment = orm.Attachment(sha256=digest, size=size, content_type=content_type,
+                                filename=filename, uploader_id=current_user.id, room_id=room_id)
+    db.session.add(attachment)
+    db.session.flush()
+    return attachment.payload()
+
+
+def store_upload(stream, content_type, filename, room_id):
+    """
+    streams an upload into the attachment store and records it, the caller
+    commits. Returns the attachment payload
+    """
+    if not allowed_type(content_type):
+        abort(415)
+    if (request.content_length or 0) > attachment_store.max_size:
+        abort(413)
+    try:
+        digest, size = attachment_store.save(stream)
+    except AttachmentTooLarge:
+        abort(413)
+    if size == 0:
+        abort(400)
+    payload = offload.run_blocking(add_attachment, digest, size, content_type, filename, room_id)
+    attachment_store.request_thumbnail(digest, content_type)
+    return payload
+
+
+@bp.route("/rooms/<room_id>/attachments", methods=["POST"])
+@login_required
+def upload_attachment(room_id):
+    """
+    stores the "file" field of a multipart form, or the raw request body
+    with ?filename=..., as an attachment of the room. Not offloaded as a
+    whole: a slow client would hold a blocking pool thread for the entire
+    upload, only the database work goes to the pool
+    """
+    if not offload.run_blocking(is_member, current_user.id, room_id):
+        abort(404)
+    upload = request.files.get("file")
+    if upload is not None:
+        payload = store_upload(upload.stream, upload.mimetype, upload.filename, room_id)
+    else:
+        payload = store_upload(request.stream, request.mimetype, request.args.get("filename"), room_id)
+    offload.run_blocking(db.session.commit)
+    return jsonify(payload), 201
+
+
+def readable_attachment(attachment_id):
+    attachment = db.session.get(orm.Attachment, attachment_id)
+    if attachment is None:
+        abort(404)
+    if attachment.room_id is None:
+        allowed = attachment.uploader_id == current_user.id
+    else:
+        allowed = is_member(current_user.id, attachment.room_id)
+    if not allowed:
+        abort(404)
+    return attachment
+
+
+def send_blob(path, attachment, mimetype, etag):
+    """
+    streams a stored file, with Range and If-None-Match support. Blobs never
+    change, so the etag is derived from the sha256
+    """
+    response = send_file(path, mimetype=mimetype, download_name=attachment.filename or attachment.sha256,
+                         conditional=True, etag=etag, max_age=31536000)
+    # members only, shared caches must not keep it
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.headers["X-Content-Type-Options"] = "nosniff"
+    return response
+
+
+@bp.route("/attachments/<attachment_id>", methods=["GET"])
+@offload.blocking
+@login_required
+def download_attachment(attachment_id):
+    attachment = readable_attachment(attachment_id)
+    return send_blob(attachment_store.path(attachment.sha256), attachment, attachment.content_type, attachment.sha256)
+
+
+@bp.route("/attachments/<attachment_id>/thumbnail", methods=["GET"])
+@offload.blocking
+@login_required
+def attachment_thumbnail(attachment_id):
+    """
+    404 until the thumbnail has been made, and for anything but images
+    """
+    attachment = readable_attachment(attachment_id)
+    path = attachment_store.thumbnail_path(attachment.sha256)
+    if not attachment.content_type.startswith("image/") or not os.path.exists(path):
+        abort(404)
+    return send_blob(path, attachment, "image/jpeg", attachment.sha256 + "-thumb")
 
 
 if __name__ == "__main__":
-    socketio.run(app)
+    from app import create_app
+    # threading mode runs on the Werkzeug development server, for production
+    # use CHAT_ASYNC_MODE=eventlet or gevent
+    socketio.run(create_app(), allow_unsafe_werkzeug=offload.mode == "threading")
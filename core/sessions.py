@@ -0,0 +1,393 @@
+"""
+Server-side login sessions
+
+A login creates a session record in the store and the signed cookie only
+carries its random token (Flask-Login's "alternative token": the token is
+what ends up in session["_user_id"] and in the remember cookie). Loading
+the user of a request or of a Socket.IO handshake is one lookup of the
+token, then the user cache, and a session can be revoked, alone or all of
+a user's, which a signed cookie could not.
+
+A record is only (user_id, expires), expires in whole seconds. Backends,
+picked by CHAT_SESSION_STORE:
+
+    memory            a dict per process plus a heap on expires, for a
+                      single worker and tests, sessions end with the process
+    sqlite:///<path>  a WITHOUT ROWID table keyed on the token, with indexes
+                      on expires and user_id, shared by the workers of a
+                      machine. The default, in the instance folder
+    file:///<dir>     one small file per session under a directory per
+                      expiry hour, named in the token, so a lookup is one
+                      open() and expired hours are removed a directory at a
+                      time. Counting or revoking a user's sessions reads
+                      every file
+
+Sessions last CHAT_SESSION_TTL seconds, CHAT_SESSION_REMEMBER_TTL with
+"remember me". Expired records are refused on lookup and deleted in bulk
+every CHAT_SESSION_SWEEP_INTERVAL seconds.
+"""
+import heapq
+import logging
+from abc import ABC, abstractmethod
+import os
+import secrets
+import shutil
+import sqlite3
+import threading
+import time
+from offload import run_blocking, RealLock
+
+
+logger = logging.getLogger(__name__)
+
+BUCKET_SECONDS = 3600
+
+
+def new_token():
+    return secrets.token_urlsafe(24)
+
+
+class SessionStore(ABC):
+    """
+    base backend, times are Unix seconds
+    """
+
+    @abstractmethod
+    def create(self, user_id, ttl, now=None):
+        """
+        stores a new session, returns its token
+        """
+
+    @abstractmethod
+    def get(self, token, now=None):
+        """
+        the user_id of a live session, None otherwise
+        """
+
+    @abstractmethod
+    def revoke(self, token):
+        """
+        ends one session
+        """
+
+    @abstractmethod
+    def revoke_user(self, user_id):
+        """
+        ends every session of the user, returns how many
+        """
+
+    @abstractmethod
+    def count(self, user_id=None, now=None):
+        """
+        live sessions, of one user or of everyone
+        """
+
+    @abstractmethod
+    def sweep(self, now=None, limit=1000):
+        """
+        deletes up to limit expired records, returns how many
+        """
+
+
+class MemoryStore(SessionStore):
+
+    def __init__(self):
+        self._records = {}  # token -> (user_id, expires)
+        self._by_user = {}  # user_id -> {token}
+        self._expiry = []  # heap of (expires, token), may hold revoked tokens
+        self._lock = threading.Lock()
+
+    def create(self, user_id, ttl, now=None):
+        token = new_token()
+        expires = int((now or time.time()) + ttl)
+        with self._lock:
+            self._records[token] = (user_id, expires)
+            self._by_user.setdefault(user_id, set()).add(token)
+            heapq.heappush(self._expiry, (expires, token))
+        return token
+
+    def get(self, token, now=None):
+        record = self._records.get(token)
+        if record is None or record[1] <= (now or time.time()):
+            return None
+        return record[0]
+
+    def _drop(self, token):
+        record = self._records.pop(token, None)
+        if record is not None:
+            tokens = self._by_user.get(record[0])
+            if tokens is not None:
+                tokens.discard(token)
+                if not tokens:
+                    del self._by_user[record[0]]
+        return record
+
+    def revoke(self, token):
+        with self._lock:
+            self._drop(token)
+
+    def revoke_user(self, user_id):
+        with self._lock:
+            tokens = list(self._by_user.get(user_id, ()))
+            for token in tokens:
+                self._drop(token)
+        return len(tokens)
+
+    def count(self, user_id=None, now=None):
+        now = now or time.time()
+        with self._lock:
+            tokens = self._by_user.get(user_id, ()) if user_id is not None else self._records
+            return sum(1 for token in tokens if self._records[token][1] > now)
+
+    def sweep(self, now=None, limit=1000):
+        now = now or time.time()
+        swept = 0
+        with self._lock:
+            while self._expiry and self._expiry[0][0] <= now and swept < limit:
+                expires, token = heapq.heappop(self._expiry)
+                record = self._records.get(token)
+                if record is not None and record[1] == expires:
+                    self._drop(token)
+                    swept += 1
+        return swept
+
+
+class SQLiteStore(SessionStore):
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS login_session ("
+            "token TEXT PRIMARY KEY, user_id TEXT NOT NULL, expires INTEGER NOT NULL) WITHOUT ROWID"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_login_session_expires ON login_session (expires)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_login_session_user ON login_session (user_id)")
+        # one connection for every thread, sqlite3 serializes on it anyway
+        self._lock = RealLock()
+
+    def _execute(self, sql, args=()):
+        with self._lock:
+            return self._conn.execute(sql, args)
+
+    def create(self, user_id, ttl, now=None):
+        token = new_token()
+        self._execute("INSERT INTO login_session (token, user_id, expires) VALUES (?, ?, ?)",
+                      (token, user_id, int((now or time.time()) + ttl)))
+        return token
+
+    def get(self, token, now=None):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT user_id FROM login_session WHERE token = ? AND expires > ?",
+                (token, int(now or time.time())),
+            ).fetchone()
+        return row[0] if row else None
+
+    def revoke(self, token):
+        self._execute("DELETE FROM login_session WHERE token = ?", (token,))
+
+    def revoke_user(self, user_id):
+        return self._execute("DELETE FROM login_session WHERE user_id = ?", (user_id,)).rowcount
+
+    def count(self, user_id=None, now=None):
+        now = int(now or time.time())
+        with self._lock:
+            if user_id is None:
+                query, args = "SELECT count(*) FROM login_session WHERE expires > ?", (now,)
+            else:
+                query, args = "SELECT count(*) FROM login_session WHERE user_id = ? AND expires > ?", (user_id, now)
+            return self._conn.execute(query, args).fetchone()[0]
+
+    def sweep(self, now=None, limit=1000):
+        return self._execute(
+            "DELETE FROM login_session WHERE token IN "
+            "(SELECT token FROM login_session WHERE expires <= ? LIMIT ?)",
+            (int(now or time.time()), limit),
+        ).rowcount
+
+
+class FileStore(SessionStore):
+    """
+    <dir>/<expiry hour>/<token>, the file holds "user_id expires" and the
+    token starts with the hour, "<hour>.<random>"
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, token):
+        bucket, sep, rest = token.partition(".")
+        if not sep or not bucket.isdigit() or not rest or "/" in rest or "\\" in rest or rest.startswith("."):
+            return None
+        return os.path.join(self.directory, bucket, rest)
+
+    def create(self, user_id, ttl, now=None):
+        expires = int((now or time.time()) + ttl)
+        # the hour the session ends in, rounded up so the whole bucket is
+        # expired once its hour has passed
+        bucket = -(-expires // BUCKET_SECONDS)
+        token = f"{bucket}.{new_token()}"
+        path = self._path(token)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "x") as out:
+            out.write(f"{user_id} {expires}")
+        return token
+
+    def _read(self, path):
+        try:
+            with open(path) as record:
+                user_id, expires = record.read().rsplit(" ", 1)
+            return user_id, int(expires)
+        except (OSError, ValueError):
+            return None
+
+    def get(self, token, now=None):
+        path = self._path(token)
+        record = self._read(path) if path is not None else None
+        if record is None or record[1] <= (now or time.time()):
+            return None
+        return record[0]
+
+    def revoke(self, token):
+        path = self._path(token)
+        if path is not None:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _records(self):
+        for bucket in os.scandir(self.directory):
+            if bucket.is_dir() and bucket.name.isdigit():
+                for entry in os.scandir(bucket.path):
+                    record = self._read(entry.path)
+                    if record is not None:
+                        yield entry.path, record
+
+    def revoke_user(self, user_id):
+        revoked = 0
+        for path, record in self._records():
+            if record[0] == user_id:
+                os.remove(path)
+                revoked += 1
+        return revoked
+
+    def count(self, user_id=None, now=None):
+        now = now or time.time()
+        return sum(1 for _, (uid, expires) in self._records()
+                   if expires > now and (user_id is None or uid == user_id))
+
+    def sweep(self, now=None, limit=1000):
+        """
+        removes whole expired hours, limit counts directories here
+        """
+        current = int(now or time.time()) // BUCKET_SECONDS
+        swept = 0
+        for bucket in os.scandir(self.directory):
+            if swept >= limit:
+                break
+            if bucket.is_dir() and bucket.name.isdigit() and int(bucket.name) <= current:
+                files = sum(1 for _ in os.scandir(bucket.path))
+                shutil.rmtree(bucket.path, ignore_errors=True)
+                swept += files
+        return swept
+
+
+def create_store(url):
+    """
+    builds the backend named by CHAT_SESSION_STORE
+    """
+    if url == "memory":
+        return MemoryStore()
+    if url.startswith("sqlite:///"):
+        return SQLiteStore(url[len("sqlite:///"):])
+    if url.startswith("file:///"):
+        return FileStore(url[len("file://"):])
+    raise ValueError(f"unknown session store: {url}")
+
+
+class Sessions:
+
+    def __init__(self, ttl=86400, remember_ttl=30 * 86400, sweep_interval=600.0):
+        self.ttl = ttl
+        self.remember_ttl = remember_ttl
+        self.sweep_interval = sweep_interval
+        self.store = MemoryStore()
+        self.swept = 0
+        self._task = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.ttl = app.config.get("CHAT_SESSION_TTL", self.ttl)
+        self.remember_ttl = app.config.get("CHAT_SESSION_REMEMBER_TTL", self.remember_ttl)
+        self.sweep_interval = app.config.get("CHAT_SESSION_SWEEP_INTERVAL", self.sweep_interval)
+        url = app.config.get("CHAT_SESSION_STORE") \
+            or "sqlite:///" + os.path.join(app.instance_path, "sessions.db")
+        self.store = create_store(url)
+
+    def login(self, user_id, remember=False):
+        """
+        a new session token for user_id
+        """
+        return run_blocking(self.store.create, user_id, self.remember_ttl if remember else self.ttl)
+
+    def user_id(self, token):
+        """
+        the single lookup behind every request and socket handshake
+        """
+        if not token:
+            return None
+        if isinstance(self.store, MemoryStore):
+            return self.store.get(token)
+        return run_blocking(self.store.get, token)
+
+    def logout(self, token):
+        if token:
+            run_blocking(self.store.revoke, token)
+
+    def revoke_user(self, user_id):
+        return run_blocking(self.store.revoke_user, user_id)
+
+    def count(self, user_id=None):
+        return run_blocking(self.store.count, user_id)
+
+    def sweep(self):
+        """
+        deletes every expired record, in batches
+        """
+        total = 0
+        while True:
+            swept = run_blocking(self.store.sweep)
+            total += swept
+            if swept < 1000:
+                break
+        self.swept += total
+        return total
+
+    def run(self, sleep=time.sleep):
+        while True:
+            sleep(self.sweep_interval)
+            try:
+                swept = self.sweep()
+                if swept:
+                    logger.info("swept %d expired sessions", swept)
+            except Exception:
+                logger.exception("session sweep failed")
+
+    def start(self, socketio):
+        """
+        starts the sweep loop once per process
+        """
+        with self._lock:
+            if self._task is None:
+                self._task = socketio.start_background_task(self.run, socketio.sleep)
+
+
+sessions = Sessions()
@@ -0,0 +1,127 @@
+"""
+Session user cache
+
+Flask-Login calls load_user on every request and every socket event. The
+cache keeps a small detached snapshot of each active user for
+CHAT_USER_CACHE_TTL seconds (LRU bounded to CHAT_USER_CACHE_SIZE entries)
+so that most of those calls never reach the database.
+
+A snapshot is dropped once an ORM update or delete of its user row commits
+(models.py collects the ids at flush and hands them over after the commit,
+a rolled back change drops nothing), on this node and, through on_changed,
+which the chat namespace points at the fan-out, on every other one. A load
+that raced with the change is not cached. Bulk statements, s.update(User)
+or s.delete(User), do not go through the mapper events: whoever runs one
+calls user_cache.changed with the ids, or the old snapshots live on for up
+to CHAT_USER_CACHE_TTL seconds.
+"""
+import threading
+import time
+from collections import OrderedDict
+from flask_login import UserMixin
+
+
+class SessionUser(UserMixin):
+    """
+    read-only copy of the columns the views and templates use, safe to share
+    between requests because it is not attached to any session
+    """
+    __slots__ = ("id", "username", "email", "about_me", "session_token")
+
+    def __init__(self, id, username, email, about_me=None, session_token=None):
+        self.id = id
+        self.username = username
+        self.email = email
+        self.about_me = about_me
+        # only set on the copy handed to login_user, see sessions.py
+        self.session_token = session_token
+
+    @classmethod
+    def from_user(cls, user, session_token=None):
+        return cls(user.id, user.username, user.email, user.about_me, session_token)
+
+    def get_id(self):
+        """
+        what Flask-Login keeps in the cookie, the server-side session token
+        """
+        return self.session_token or self.id
+
+    def __repr__(self):
+        return f'<User %r> {self.username}'
+
+
+class UserCache:
+
+    def __init__(self, ttl=60.0, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.on_changed = None  # called with the user ids changed on this node
+        self._entries = OrderedDict()  # user_id -> (expires, snapshot)
+        self._epoch = 0  # bumped by every invalidation
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.ttl = app.config.get("CHAT_USER_CACHE_TTL", self.ttl)
+        self.max_size = app.config.get("CHAT_USER_CACHE_SIZE", self.max_size)
+
+    def get(self, user_id, loader):
+        """
+        returns the cached snapshot, or calls loader(user_id) and caches what
+        it returns. Unknown users (loader returns None) are not cached
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            epoch = self._epoch
+        snapshot = loader(user_id)
+        if snapshot is not None:
+            with self._lock:
+                if self._epoch != epoch:
+                    # something was invalidated meanwhile, maybe this row
+                    return snapshot
+                self._entries[user_id] = (now + self.ttl, snapshot)
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return snapshot
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._epoch += 1
+            if self._entries.pop(user_id, None) is not None:
+                self.invalidations += 1
+
+    def changed(self, user_ids):
+        """
+        users whose rows were committed, drops them here and tells the
+        other nodes
+        """
+        for user_id in user_ids:
+            self.invalidate(user_id)
+        if self.on_changed is not None:
+            self.on_changed(sorted(user_ids))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "size": len(self._entries),
+            "hit_ratio": round(self.hits / total, 4) if total else None,
+        }
+
+
+user_cache = UserCache()
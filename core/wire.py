@@ -0,0 +1,149 @@
+"""
+Wire formats and emit batching
+
+Clients pick a wire format when they connect, with the Socket.IO auth
+payload {"wire": ...}:
+
+    (none)     every room event is its own Socket.IO event, as before
+    "json"     room events arrive in "batch" events, a JSON text of
+               [[event, payload], ...]
+    "msgpack"  the same list as one binary msgpack frame, with the payload
+               keys in SHORT_KEYS shortened. Needs the msgpack package on
+               the server, without it the connection gets "json"
+
+Batched connections are in a per-format Socket.IO room next to the room
+itself (see channel). Events for a room that arrive within
+CHAT_EMIT_BATCH_MS milliseconds of each other are sent as one frame, and
+each frame is encoded once per room and format, whatever the number of
+recipients.
+"""
+import json
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+try:
+    import msgpack  # optional dependency, only needed for the msgpack wire
+except ImportError:
+    msgpack = None
+
+WIRES = ("json", "msgpack")
+
+SHORT_KEYS = {
+    "id": "i", "room_id": "r", "sender_id": "s", "body": "b", "date": "d",
+    "attachment": "a", "version": "v", "edited_at": "e", "deleted": "x", "seq": "q",
+    "number": "n",
+}
+
+
+def negotiate(requested):
+    """
+    the wire a connection gets for the one it asked for, None for none
+    """
+    if requested == "msgpack" and msgpack is None:
+        return "json"
+    return requested if requested in WIRES else None
+
+
+def channel(room_id, wire):
+    """
+    the Socket.IO room the connections of one wire format join
+    """
+    return room_id if wire is None else f"{room_id}|{wire}"
+
+
+def shorten(payload):
+    if not isinstance(payload, dict):
+        return payload
+    return {SHORT_KEYS.get(key, key): value for key, value in payload.items()}
+
+
+def encode(events, wire):
+    """
+    one frame for a list of (event, payload)
+    """
+    if wire == "msgpack":
+        return msgpack.packb([[event, shorten(payload)] for event, payload in events], use_bin_type=True)
+    return json.dumps(events, separators=(",", ":"))
+
+
+class EmitBatcher:
+    """
+    collects room events for a few milliseconds and sends them as one frame
+    per room and wire format
+    """
+
+    def __init__(self, interval=0.005, namespace="/chat"):
+        self.interval = interval
+        self.namespace = namespace
+        self.socketio = None
+        self.frames = 0
+        self._pending = {}  # room_id -> [(event, payload)]
+        self._lock = threading.Lock()
+        self._wake = None
+        self._task = None
+
+    def init_app(self, app, socketio=None):
+        self.socketio = socketio
+        self.interval = app.config.get("CHAT_EMIT_BATCH_MS", self.interval * 1000) / 1000
+
+    def add(self, room_id, event, payload):
+        with self._lock:
+            events = self._pending.setdefault(room_id, [])
+            events.append((event, payload))
+        if self._wake is not None and len(events) == 1:
+            self._wake.set()
+
+    def _listening(self, room):
+        manager = self.socketio.server.manager
+        return any(True for _ in manager.get_participants(self.namespace, room))
+
+    def flush(self):
+        """
+        sends everything pending, returns the number of frames
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        frames = 0
+        for room_id, events in pending.items():
+            for wire in WIRES:
+                room = channel(room_id, wire)
+                if wire == "msgpack" and msgpack is None or not self._listening(room):
+                    continue
+                try:
+                    frame = encode(events, wire)
+                except (TypeError, ValueError):
+                    logger.exception("encoding a %s batch for room %s failed", wire, room_id)
+                    continue
+                self.socketio.emit("batch", frame, to=room, namespace=self.namespace)
+                frames += 1
+        self.frames += frames
+        return frames
+
+    def run(self, sleep=time.sleep):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            # let the rest of the burst arrive
+            sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("emit batch flush failed")
+
+    def start(self, socketio):
+        """
+        starts the flush loop once per process
+        """
+        with self._lock:
+            if self._task is None:
+                self._wake = socketio.server.eio.create_event()
+                if self._pending:
+                    self._wake.set()
+                self._task = socketio.start_background_task(self.run, socketio.sleep)
+
+
+emit_batcher = EmitBatcher()
@@ -0,0 +1,235 @@
+"""
+Write-behind buffer for chat messages
+
+Sending a message should not cost a commit. Messages are queued here and
+written with one bulk INSERT when the buffer reaches CHAT_FLUSH_SIZE rows or
+when the oldest queued row is older than CHAT_FLUSH_INTERVAL seconds,
+whichever comes first. Messages are handed to `on_flush` once they have an
+id, which is when they get published to the room.
+
+The buffer holds at most CHAT_FLUSH_MAX_PENDING rows, past that `add`
+raises BufferFull and the sender is told to retry: the database is not
+keeping up and queueing more would only grow memory. A failed flush puts
+its rows back in front and is retried, after a growing pause, up to
+CHAT_FLUSH_RETRIES times. After that every failed flush writes one row of
+the batch on its own, a different one each time: when that fails too the
+database is most likely down and the batch is kept, two writes per attempt
+whatever its size. When it goes in, the rest is split in halves until the
+rows that fail on their own are found; those are parked (logged and
+dropped) so that one bad row can not hold up every message behind it.
+
+Publishing stored messages is separate from storing them: a publish that
+fails is logged, the rows stay written and the flush loop keeps running.
+"""
+import atexit
+import logging
+import threading
+import time
+from datetime import datetime
+import sqlalchemy as s
+from models import db, Message, message_payload
+from offload import run_blocking
+import room_list
+import room_events
+
+
+logger = logging.getLogger(__name__)
+
+MAX_BACKOFF = 5.0
+# parked rows kept for inspection
+MAX_PARKED = 100
+
+
+class BufferFull(Exception):
+    """
+    raised by add when the buffer is at CHAT_FLUSH_MAX_PENDING rows
+    """
+
+
+class MessageWriteBuffer:
+    """
+    collects message rows in memory and flushes them to the database in bulk
+    """
+
+    def __init__(self, app=None, max_size=200, max_delay=0.1, max_pending=10000, max_retries=3):
+        self.app = None
+        self.on_flush = None
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self.failures = 0  # flushes failed in a row
+        self.parked = []  # the last MAX_PARKED rows given up on
+        self.dropped = 0
+        self._pending = []  # (row, payload) pairs waiting for the next flush
+        self._oldest = None  # monotonic time of the first pending row
+        self._retry_at = 0.0  # no flush before this monotonic time after a failure
+        self._probes = 0  # picks the row written alone after the retries
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._task = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.max_size = app.config.get("CHAT_FLUSH_SIZE", self.max_size)
+        self.max_delay = app.config.get("CHAT_FLUSH_INTERVAL", self.max_delay)
+        self.max_pending = app.config.get("CHAT_FLUSH_MAX_PENDING", self.max_pending)
+        self.max_retries = app.config.get("CHAT_FLUSH_RETRIES", self.max_retries)
+        atexit.register(self.flush)
+
+    def add(self, room_id, sender_id, body, attachment=None):
+        """
+        queues a message and returns its payload, the payload's "id" is filled
+        in once the row has been inserted. attachment is Attachment.payload().
+        Raises BufferFull when the database is not keeping up
+        """
+        date = datetime.now()
+        row = {"sent_to_room_id": room_id, "sent_id": sender_id, "message_body": body,
+               "date": date, "attachment_id": attachment["id"] if attachment else None}
+        payload = message_payload(None, room_id, sender_id, body, date, attachment)
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                raise BufferFull(len(self._pending))
+            if not self._pending:
+                self._oldest = time.monotonic()
+            self._pending.append((row, payload))
+            full = len(self._pending) >= self.max_size and time.monotonic() >= self._retry_at
+        if full:
+            self.flush()
+        return payload
+
+    def __len__(self):
+        return len(self._pending)
+
+    def due(self):
+        """
+        true when the oldest pending row has waited longer than max_delay
+        """
+        oldest = self._oldest
+        now = time.monotonic()
+        return bool(self._pending) and oldest is not None \
+            and now - oldest >= self.max_delay and now >= self._retry_at
+
+    def flush(self):
+        """
+        writes every pending row in a single INSERT and commit
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+                self._oldest = None
+            if not batch:
+                return 0
+            try:
+                written = list(zip(batch, run_blocking(self._write, [row for row, _ in batch])))
+            except Exception as error:
+                self.failures += 1
+                if self.failures <= self.max_retries:
+                    logger.warning("message flush failed (%s), retry %d of %d for %d rows",
+                                   error, self.failures, self.max_retries, len(batch))
+                    self._requeue(batch)
+                    return 0
+                probe = batch[self._probes % len(batch)]
+                self._probes += 1
+                try:
+                    written = list(zip([probe], run_blocking(self._write, [probe[0]])))
+                except Exception:
+                    # even one row does not go in, the database is down
+                    logger.error("message flush failed (%s), keeping %d rows", error, len(batch))
+                    self._requeue(batch)
+                    return 0
+                more_written, bad = self._write_split([pair for pair in batch if pair is not probe])
+                # published in id order, the probe went in first
+                written = sorted(written + more_written, key=lambda pair: pair[1][0])
+                self._park(bad)
+            self.failures = 0
+            self._retry_at = 0.0
+            try:
+                self._publish(written)
+            except Exception:
+                logger.exception("publishing %d stored messages failed", len(written))
+            return len(written)
+
+    def _requeue(self, batch):
+        with self._lock:
+            self._pending[:0] = batch
+            self._oldest = time.monotonic()
+            self._retry_at = self._oldest + min(MAX_BACKOFF, self.max_delay * 2 ** self.failures)
+
+    def _write_split(self, batch):
+        """
+        writes the batch in halves down to single rows, returns the
+        ((row, payload), (id, seq)) pairs written and the (row, payload)
+        pairs that failed on their own
+        """
+        try:
+            return list(zip(batch, run_blocking(self._write, [row for row, _ in batch]))), []
+        except Exception:
+            if len(batch) == 1:
+                return [], batch
+        middle = len(batch) // 2
+        written, bad = self._write_split(batch[:middle])
+        more_written, more_bad = self._write_split(batch[middle:])
+        return written + more_written, bad + more_bad
+
+    def _park(self, bad):
+        for row, _ in bad:
+            logger.error("dropping a message that can not be stored: room %s sender %s",
+                         row["sent_to_room_id"], row["sent_id"])
+            self.parked.append(row)
+        del self.parked[:-MAX_PARKED]
+        self.dropped += len(bad)
+
+    def _publish(self, written):
+        for (row, payload), (message_id, seq) in written:
+            payload["id"] = message_id
+            payload["seq"] = seq
+            payload["number"] = row["number"]
+        if self.on_flush is not None:
+            self.on_flush([payload for (_, payload), _ in written])
+
+    def _write(self, rows):
+        with self.app.app_context():
+            try:
+                room_list.number_messages(rows)
+                ids = db.session.scalars(
+                    s.insert(Message).returning(Message.message_id,
+                                                sort_by_parameter_order=True),
+                    rows,
+                ).all()
+                last_ids = {}
+                for row, message_id in zip(rows, ids):
+                    room_id = row["sent_to_room_id"]
+                    last_ids[room_id] = max(message_id, last_ids.get(room_id, 0))
+                room_list.advance_last_message(last_ids)
+                seqs = room_events.record_created(rows, ids)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+            return list(zip(ids, seqs))
+
+    def run(self, sleep=time.sleep):
+        """
+        background loop that enforces the time threshold
+        """
+        while True:
+            sleep(self.max_delay / 2)
+            try:
+                if self.due():
+                    self.flush()
+            except Exception:
+                logger.exception("message flush loop failed")
+
+    def start(self, socketio):
+        """
+        starts the flush loop once per process, using the server's async mode
+        """
+        with self._lock:
+            if self._task is None:
+                self._task = socketio.start_background_task(self.run, socketio.sleep)
+
+
+message_buffer = MessageWriteBuffer()
@@ -0,0 +1,45 @@
+import json
+import zlib
+from datetime import datetime, timedelta
+from archive import encode, decode, take_older, sort_key, tombstone
+
+
+START = datetime(2026, 1, 1)
+
+
+def message(message_id, minutes):
+    return {"id": message_id, "room_id": "r", "sender_id": "u", "body": f"m{message_id}",
+            "date": (START + timedelta(minutes=minutes)).isoformat(), "attachment": None,
+            "version": 1, "edited_at": None, "deleted": False, "number": message_id}
+
+
+class TestArchive:
+    def test_segment_round_trip(self):
+        payloads = [message(n, n) for n in range(1, 200)]
+        data = encode(payloads)
+        assert len(data) < len(repr(payloads)) // 4
+        assert decode(data, "r") == payloads
+
+    def test_purge_tombstones_archived_messages(self):
+        payloads = [message(n, n) for n in range(1, 5)]
+        payloads[1]["sender_id"] = "spammer"
+        payloads[3]["sender_id"] = "spammer"
+        assert tombstone(payloads, {"spammer"}) == 2
+        purged = decode(encode(payloads), "r")
+        assert [p["deleted"] for p in purged] == [False, True, False, True]
+        assert purged[1]["body"] == "" and purged[1]["version"] == 2
+        assert tombstone(purged, {"spammer"}) == 0
+
+    def test_rows_of_older_segments_decode(self):
+        old = zlib.compress(json.dumps([[1, "u", "m1", START.isoformat(), None, 1, None, False]]).encode())
+        assert decode(old, "r")[0]["number"] is None
+
+    def test_take_older_is_newest_first_below_cursor(self):
+        payloads = [message(n, n) for n in range(1, 6)]
+        taken = take_older(payloads, sort_key(payloads[3]), 2)
+        assert [p["id"] for p in taken] == [3, 2]
+        assert [p["id"] for p in take_older(payloads, None, 10)] == [5, 4, 3, 2, 1]
+
+    def test_same_date_orders_by_id(self):
+        payloads = [message(1, 0), message(2, 0)]
+        assert take_older(payloads, (START, 2), 5) == [payloads[0]]
@@ -0,0 +1,46 @@
+import io
+import os
+import pytest
+import attachments
+from attachments import AttachmentStore, AttachmentTooLarge, allowed_type, make_thumbnail
+
+
+class TestAttachmentStore:
+    def test_same_content_is_stored_once(self, tmp_path):
+        store = AttachmentStore(str(tmp_path), chunk_size=7)
+        first = store.save(io.BytesIO(b"x" * 100))
+        second = store.save(io.BytesIO(b"x" * 100))
+        assert first == second and first[1] == 100
+        with open(store.path(first[0]), "rb") as f:
+            assert f.read() == b"x" * 100
+        assert os.listdir(tmp_path / "tmp") == []
+
+    def test_too_large_leaves_nothing_behind(self, tmp_path):
+        store = AttachmentStore(str(tmp_path), max_size=10, chunk_size=4)
+        with pytest.raises(AttachmentTooLarge):
+            store.save(io.BytesIO(b"x" * 11))
+        assert os.listdir(tmp_path / "tmp") == []
+        assert not (tmp_path / "blobs").exists()
+
+    def test_remove_spares_recently_stored_blobs(self, tmp_path):
+        store = AttachmentStore(str(tmp_path))
+        digest, _ = store.save(io.BytesIO(b"gif"))
+        assert not store.remove(digest)
+        assert os.path.exists(store.path(digest))
+        assert store.remove(digest, grace=0)
+        assert not os.path.exists(store.path(digest))
+        assert not store.remove(digest, grace=0)
+
+    def test_no_thumbnail_for_a_decompression_bomb(self, tmp_path, monkeypatch):
+        Image = pytest.importorskip("PIL.Image")
+        # make_thumbnail sets Pillow's limit, put it back afterwards
+        monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", Image.MAX_IMAGE_PIXELS)
+        monkeypatch.setattr(attachments, "MAX_IMAGE_PIXELS", 100)
+        src, dst = tmp_path / "big.png", tmp_path / "big.jpg"
+        Image.new("1", (1000, 1000)).save(src)
+        assert make_thumbnail(str(src), str(dst), 32) is False
+        assert os.listdir(tmp_path) == ["big.png"]
+
+    def test_allowed_types(self):
+        assert allowed_type("image/gif") and allowed_type("audio/ogg") and allowed_type("video/mp4")
+        assert not allowed_type("image/svg+xml") and not allowed_type("text/html") and not allowed_type(None)
@@ -0,0 +1,82 @@
+import os
+import sys
+from datetime import datetime
+import pytest
+
+# the app modules import each other as top level modules (import models, ...)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "core"))
+
+
+@pytest.fixture
+def app(monkeypatch):
+    """
+    the app on an empty in-memory SQLite database, used inside its app context
+    """
+    from app import create_app
+    from models import db
+    import archive
+    # segment ids start over with every database
+    monkeypatch.setattr(archive, "segment_cache", archive.SegmentCache())
+    app = create_app({
+        "TESTING": True,
+        "SQLALCHEMY_DATABASE_URI": "sqlite://",
+        "CHAT_SESSION_STORE": "memory",
+        "CHAT_HASH_METHOD": "pbkdf2:sha256:1000",
+    })
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+
+
+@pytest.fixture
+def make_user(app):
+    from models import db, User
+
+    def make_user(name):
+        user = User(name, "secret", f"{name}@example.com")
+        db.session.add(user)
+        db.session.commit()
+        return user
+    return make_user
+
+
+@pytest.fixture
+def make_room(app):
+    """
+    a room made by its creator, its first admin, with the other members joined
+    """
+    from models import db, Room
+    import room_list
+    import moderation
+
+    def make_room(name, creator, *members):
+        room = Room(name, None, f"http://localhost/join/{name}", creator, invite_code=name)
+        db.session.add(room)
+        db.session.flush()
+        room_list.add_member(creator.id, room.room_id, role=moderation.ROLE_ADMIN)
+        for member in members:
+            room_list.add_member(member.id, room.room_id)
+        db.session.commit()
+        return room
+    return make_room
+
+
+@pytest.fixture
+def send(app):
+    """
+    stores (room, sender, body) or (room, sender, body, date) messages as one
+    write buffer flush, returns their ids
+    """
+    from models import db
+    from write_buffer import MessageWriteBuffer
+
+    buffer = MessageWriteBuffer(app)
+
+    def send(*messages):
+        rows = [{"sent_to_room_id": room.room_id, "sent_id": sender.id, "message_body": body,
+                 "date": rest[0] if rest else datetime.now(), "attachment_id": None}
+                for room, sender, body, *rest in messages]
+        db.session.commit()
+        return [message_id for message_id, _ in buffer._write(rows)]
+    return send
@@ -0,0 +1,69 @@
+"""
+Multi-process harness for the fan-out backends, every worker process runs
+its own SQLiteFanout on a shared log file, the way separate server workers do
+"""
+import multiprocessing
+import time
+from fanout import LocalFanout, SQLiteFanout, create_fanout
+
+
+ROOMS = ["room-a", "room-b", "room-c"]
+PER_ROOM = 50
+
+
+def worker(path, ready, results, expected):
+    received = []
+    fanout = SQLiteFanout(path, lambda room_id, event, payload: received.append((room_id, payload["n"])),
+                          poll_interval=0.005)
+    ready.set()
+    deadline = time.monotonic() + 20
+    while len(received) < expected and time.monotonic() < deadline:
+        if fanout.poll() == 0:
+            time.sleep(0.005)
+    results.put(received)
+
+
+def publisher(path, offset):
+    fanout = SQLiteFanout(path)
+    for n in range(PER_ROOM):
+        fanout.publish_many([(room_id, "message", {"n": offset + n}) for room_id in ROOMS])
+
+
+class TestFanout:
+    def test_local_delivers_in_place(self):
+        seen = []
+        fanout = create_fanout("local", lambda *event: seen.append(event))
+        assert isinstance(fanout, LocalFanout)
+        fanout.publish("r", "message", {"n": 1})
+        assert seen == [("r", "message", {"n": 1})]
+
+    def test_sqlite_delivers_to_every_worker_in_order(self, tmp_path):
+        path = str(tmp_path / "fanout.db")
+        SQLiteFanout(path)  # creates the log before the workers read last_seq
+        ctx = multiprocessing.get_context("spawn")
+        results = ctx.Queue()
+        expected = 2 * PER_ROOM * len(ROOMS)
+        workers = []
+        for _ in range(3):
+            ready = ctx.Event()
+            process = ctx.Process(target=worker, args=(path, ready, results, expected))
+            process.start()
+            assert ready.wait(20)
+            workers.append(process)
+        publishers = [ctx.Process(target=publisher, args=(path, offset)) for offset in (0, 1000)]
+        for process in publishers:
+            process.start()
+        received = [results.get(timeout=30) for _ in workers]
+        for process in publishers + workers:
+            process.join(10)
+
+        for events in received:
+            assert len(events) == expected
+        for room_id in ROOMS:
+            orders = [[n for r, n in events if r == room_id] for events in received]
+            # every worker saw the room's events in the same order
+            assert all(order == orders[0] for order in orders)
+            # and each publisher's events kept their publish order
+            for offset in (0, 1000):
+                mine = [n for n in orders[0] if offset <= n < offset + PER_ROOM]
+                assert mine == list(range(offset, offset + PER_ROOM))
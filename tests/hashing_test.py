@@ -0,0 +1,39 @@
+import pytest
+from hashing import PasswordHasher, HashingBusy, parameters
+
+
+class TestHashing:
+    def test_hash_and_verify(self):
+        hasher = PasswordHasher(method="pbkdf2:sha256:1000")
+        pwhash = hasher.hash("secret")
+        assert hasher.verify(pwhash, "secret")
+        assert not hasher.verify(pwhash, "wrong")
+        assert not hasher.needs_rehash(pwhash)
+
+    def test_changed_cost_needs_rehash(self):
+        old = PasswordHasher(method="pbkdf2:sha256:1000").hash("secret")
+        assert PasswordHasher(method="pbkdf2:sha256:2000").needs_rehash(old)
+
+    def test_defaults_are_filled_in(self):
+        assert parameters("scrypt") == parameters("scrypt:32768:8:1")
+        assert parameters("pbkdf2:sha256") == parameters("pbkdf2")
+        assert not PasswordHasher(method="scrypt").needs_rehash("scrypt:32768:8:1$salt$hash")
+        assert PasswordHasher(method="scrypt").needs_rehash("scrypt:16384:8:1$salt$hash")
+
+    def test_busy_when_no_slot_frees_up(self):
+        hasher = PasswordHasher(method="pbkdf2:sha256:1000", cpu_share=0, wait=0.01)
+        hasher._admission.acquire()
+        with pytest.raises(HashingBusy):
+            hasher.hash("secret")
+
+    def test_settings_come_from_the_app_config(self):
+        class App:
+            config = {"CHAT_HASH_METHOD": "pbkdf2:sha256:1000", "CHAT_HASH_CPU_SHARE": 0, "CHAT_HASH_WAIT": 0.01}
+
+        hasher = PasswordHasher()
+        hasher.init_app(App)
+        assert hasher.method == "pbkdf2:sha256:1000"
+        assert hasher.slots == 1
+        hasher._admission.acquire()
+        with pytest.raises(HashingBusy):
+            hasher.hash("secret")
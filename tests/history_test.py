@@ -0,0 +1,58 @@
+from datetime import datetime, timedelta
+import pytest
+
+
+START = datetime(2026, 1, 1)
+
+
+def all_pages(room_id, limit):
+    """
+    every page from the newest back, as one chronological list of ids
+    """
+    from history import fetch_page
+    pages, before = [], None
+    while True:
+        messages, before = fetch_page(room_id, before=before, limit=limit)
+        pages.insert(0, [message["id"] for message in messages])
+        if before is None:
+            return [message_id for page in pages for message_id in page]
+
+
+@pytest.fixture
+def room(make_user, make_room, send):
+    """
+    12 messages, three to a timestamp and stored out of date order, the
+    oldest five archived so the archive boundary splits a timestamp
+    """
+    import archive
+    ann = make_user("ann")
+    room = make_room("lobby", ann)
+    minutes = [3, 0, 0, 1, 2, 1, 3, 0, 2, 1, 3, 2]
+    sent = send(*[(room, ann, f"m{n}", START + timedelta(minutes=m)) for n, m in enumerate(minutes)])
+    expected = [message_id for _, message_id in sorted(zip(minutes, sent))]
+    # archiving expunges the session, keep the id
+    room_id = room.room_id
+    assert archive.archive_batch(room_id, START + timedelta(minutes=2), 5) == 5
+    return room_id, expected
+
+
+class TestFetchPage:
+    @pytest.mark.parametrize("limit", [1, 2, 4, 5, 7, 12, 50])
+    def test_pages_have_no_gaps_or_duplicates(self, room, limit):
+        room_id, expected = room
+        assert all_pages(room_id, limit) == expected
+
+    def test_page_from_an_archived_message(self, room):
+        from history import fetch_page
+        room_id, expected = room
+        messages, before = fetch_page(room_id, before=expected[3], limit=2)
+        assert [message["id"] for message in messages] == expected[1:3]
+        assert before == expected[1]
+        messages, before = fetch_page(room_id, before=before, limit=2)
+        assert [message["id"] for message in messages] == expected[:1]
+        assert before is None
+
+    def test_unknown_cursor(self, room):
+        from history import fetch_page
+        room_id, _ = room
+        assert fetch_page(room_id, before=10_000) == ([], None)
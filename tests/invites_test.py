@@ -0,0 +1,69 @@
+import pytest
+import invites
+from invites import InviteCache, new_invite_code, code_from_url, MAX_ATTEMPTS
+
+
+class TestInviteCode:
+    def test_taken_codes_are_retried(self, make_user, make_room, monkeypatch):
+        make_room("taken", make_user("ann"))
+        codes = iter(["taken", "taken", "fresh"])
+        monkeypatch.setattr(invites, "gen_link", lambda: next(codes))
+        assert new_invite_code() == "fresh"
+
+    def test_gives_up_after_max_attempts(self, make_user, make_room, monkeypatch):
+        make_room("taken", make_user("ann"))
+        calls = []
+        monkeypatch.setattr(invites, "gen_link", lambda: calls.append(1) or "taken")
+        with pytest.raises(RuntimeError):
+            new_invite_code()
+        assert len(calls) == MAX_ATTEMPTS
+
+    @pytest.mark.parametrize("url", [
+        "AbC123xyz9",
+        " AbC123xyz9\n",
+        "http://localhost:5000/join/AbC123xyz9",
+        "https://chat.example.com/join/AbC123xyz9/",
+        # joining_url as rooms were created before invite codes
+        "http://127.0.0.1/AbC123xyz9",
+    ])
+    def test_code_from_url(self, url):
+        assert code_from_url(url) == "AbC123xyz9"
+
+
+class TestInviteCache:
+    def test_only_hits_are_cached(self, make_user, make_room):
+        room = make_room("lobby", make_user("ann"))
+        cache = InviteCache()
+        assert cache.resolve("nope") is None
+        assert cache.resolve("lobby") == (room.room_id, "lobby")
+        assert list(cache._entries) == ["lobby"]
+
+    def test_bounded(self, make_user, make_room):
+        ann = make_user("ann")
+        for name in ("a", "b", "c"):
+            make_room(name, ann)
+        cache = InviteCache(max_size=2)
+        for code in ("a", "b", "a", "c"):
+            cache.resolve(code)
+        assert list(cache._entries) == ["a", "c"]
+
+    def test_kick_leaves_nothing_stale(self, make_user, make_room):
+        """
+        the cache holds the code's room, never membership, so a kick has
+        nothing to invalidate: joining again is checked against the table
+        """
+        import moderation
+        import room_list
+        from chat_namespace import is_member
+        from models import db
+        bob = make_user("bob")
+        room = make_room("lobby", make_user("ann"), bob)
+        cache = InviteCache()
+        room_id, _ = cache.resolve("lobby")
+        moderation.kick(room_id, [bob.id])
+        db.session.commit()
+        assert cache.resolve("lobby") == (room_id, "lobby")
+        assert not is_member(bob.id, room_id)
+        room_list.add_member(bob.id, room_id)
+        db.session.commit()
+        assert is_member(bob.id, room_id) and room.member_count == 2
@@ -0,0 +1,54 @@
+import pytest
+from limits import RateLimiter, RateLimited, SlowConsumerGuard
+
+
+class TestRateLimiter:
+    def test_burst_then_refill(self):
+        limiter = RateLimiter({"user": (2.0, 3.0)})
+        assert all(limiter.allow(("user", "u"), now=0) for _ in range(3))
+        with pytest.raises(RateLimited) as error:
+            limiter.check(("user", "u"), now=0)
+        assert error.value.retry_after == pytest.approx(0.5)
+        assert limiter.allow(("user", "u"), now=0.5)
+
+    def test_all_or_nothing(self):
+        limiter = RateLimiter({"user": (1.0, 5.0), "room": (1.0, 1.0)})
+        assert limiter.allow(("user", "u"), ("room", "r"), now=0)
+        assert not limiter.allow(("user", "u"), ("room", "r"), now=0)
+        # the user bucket was not charged for the rejected send
+        assert all(limiter.allow(("user", "u"), now=0) for _ in range(4))
+
+    def test_keys_are_bounded(self):
+        limiter = RateLimiter(max_keys=2)
+        for key in "abc":
+            limiter.allow(("http", key), now=0)
+        assert len(limiter._buckets) == 2
+
+
+class FakeQueue:
+    def __init__(self, size):
+        self.size = size
+
+    def qsize(self):
+        return self.size
+
+
+class FakeSocket:
+    def __init__(self, size):
+        self.queue = FakeQueue(size)
+
+
+class FakeEngineIO:
+    def __init__(self, sizes):
+        self.sockets = {sid: FakeSocket(size) for sid, size in sizes.items()}
+        self.closed = []
+
+    def disconnect(self, sid):
+        self.closed.append(sid)
+
+
+class TestSlowConsumerGuard:
+    def test_only_backed_up_sockets_are_cut(self):
+        eio = FakeEngineIO({"fast": 3, "slow": 11})
+        assert SlowConsumerGuard(max_queued=10).sweep(eio) == 1
+        assert eio.closed == ["slow"]
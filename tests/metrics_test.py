@@ -0,0 +1,58 @@
+import sqlalchemy as s
+from metrics import Metrics, Histogram, collapse
+import sys
+
+
+class TestHistogram:
+    def test_renders_cumulative_buckets(self):
+        histogram = Histogram("latency", "help", ("endpoint",), buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 0.5, 5):
+            histogram.observe(value, "chat.login")
+        lines = histogram.render()
+        assert 'latency_bucket{endpoint="chat.login",le="0.1"} 1' in lines
+        assert 'latency_bucket{endpoint="chat.login",le="1.0"} 3' in lines
+        assert 'latency_bucket{endpoint="chat.login",le="+Inf"} 4' in lines
+        assert 'latency_count{endpoint="chat.login"} 4' in lines
+
+    def test_label_values_are_escaped(self):
+        histogram = Histogram("latency", "help", ("event",), buckets=(1.0,))
+        histogram.observe(0.5, 'a"b')
+        assert 'latency_sum{event="a\\"b"} 0.5' in histogram.render()
+
+
+class TestMetrics:
+    def test_counts_statements_of_the_unit(self):
+        metrics = Metrics()
+        metrics.warn_statements = 2
+        engine = s.create_engine("sqlite://")
+        metrics.instrument_engine(engine)
+        with engine.connect() as conn:
+            conn.execute(s.text("SELECT 1"))
+            with metrics.track("socket", "send") as unit:
+                for _ in range(3):
+                    conn.execute(s.text("SELECT 1"))
+        assert unit.statements == 3
+        text = metrics.render()
+        assert "chat_sql_statements_total 4" in text
+        assert 'chat_unit_sql_statements_count{kind="socket",name="send"} 1' in text
+        assert 'chat_sql_statement_warnings_total{kind="socket",name="send"} 1' in text
+        assert 'chat_socket_event_seconds_count{event="send"} 1' in text
+
+    def test_gauges_are_read_on_render(self):
+        metrics = Metrics()
+        value = [1]
+        metrics.gauge("pending", "help", lambda: value[0])
+        value[0] = 7
+        assert "pending 7" in metrics.render()
+
+    def test_read_counters_are_typed_counter(self):
+        metrics = Metrics()
+        metrics.counter("chat_frames_total", "help", lambda: 3)
+        text = metrics.render()
+        assert "# TYPE chat_frames_total counter" in text
+        assert "chat_frames_total 3" in text
+
+
+def test_collapse_is_outermost_first():
+    stack = collapse(sys._getframe())
+    assert stack.endswith("metrics_test.py:test_collapse_is_outermost_first")
@@ -0,0 +1,63 @@
+from datetime import datetime, timedelta
+import pytest
+import sqlalchemy as s
+import moderation
+
+
+@pytest.fixture
+def lobby(make_user, make_room, send):
+    """
+    a room where bob has two archived and two hot messages, ann one of each
+    """
+    import archive
+    ann, bob, eve = make_user("ann"), make_user("bob"), make_user("eve")
+    room = make_room("lobby", ann, bob, eve)
+    old = datetime.now() - timedelta(days=30)
+    send((room, bob, "old spam", old), (room, ann, "old hello", old), (room, bob, "more old spam", old))
+    hot = send((room, bob, "spam"), (room, ann, "hello"), (room, bob, "more spam"))
+    ids = room.room_id, ann.id, bob.id, eve.id
+    assert archive.archive_batch(room.room_id, old + timedelta(seconds=1), 10) == 3
+    return ids, hot
+
+
+class TestModeration:
+    def test_purge_tombstones_hot_and_archived_messages(self, lobby):
+        from models import db, Message, RoomEvent
+        from history import fetch_page
+        from room_events import delta, latest_seq
+        (room_id, ann, bob, _), hot = lobby
+        seen = latest_seq(room_id)
+
+        event = moderation.purge_messages(room_id, [bob])
+        db.session.commit()
+        assert event == {"room_id": room_id, "user_ids": [bob], "messages": 4, "seq": seen + 2}
+        messages, _ = fetch_page(room_id)
+        assert [(m["body"], m["deleted"]) for m in messages] == [
+            ("", True), ("old hello", False), ("", True), ("", True), ("hello", False), ("", True),
+        ]
+        purged = db.session.scalars(s.select(Message).where(Message.sent_id == bob)).all()
+        assert all(m.deleted_at is not None and m.version == 2 for m in purged)
+        events = db.session.execute(
+            s.select(RoomEvent.message_id, RoomEvent.kind, RoomEvent.version).where(RoomEvent.seq > seen)
+        ).all()
+        assert sorted(events) == [(hot[0], "delete", 2), (hot[2], "delete", 2)]
+        assert delta(room_id, seen) == {"seq": seen + 2, "messages": [], "deleted": [hot[0], hot[2]]}
+
+        # nothing left to purge
+        assert moderation.purge_messages(room_id, [bob])["messages"] == 0
+        assert latest_seq(room_id) == seen + 2
+
+    def test_kick_spares_the_creator(self, lobby):
+        from models import db, Room
+        (room_id, ann, bob, eve), _ = lobby
+        assert moderation.kick(room_id, [ann, bob, "nobody"]) == {"room_id": room_id, "user_ids": [bob]}
+        db.session.commit()
+        assert db.session.scalar(s.select(Room.member_count).where(Room.room_id == room_id)) == 2
+        assert moderation.kick(room_id, [bob])["user_ids"] == []
+        assert db.session.scalar(s.select(Room.member_count).where(Room.room_id == room_id)) == 2
+
+    def test_roles(self, lobby):
+        (room_id, ann, bob, eve), _ = lobby
+        assert moderation.is_admin(ann, room_id)
+        assert moderation.set_role(room_id, [ann, eve], moderation.ROLE_ADMIN)["user_ids"] == [eve]
+        assert moderation.is_admin(eve, room_id) and not moderation.is_admin(bob, room_id)
@@ -0,0 +1,67 @@
+from notifications import Notifications, NOTIFY_ALL, NOTIFY_DIGEST, NOTIFY_MUTE
+from presence import presence
+
+
+LEVELS = {"alice": NOTIFY_ALL, "bob": NOTIFY_ALL, "carol": NOTIFY_DIGEST, "dave": NOTIFY_MUTE}
+
+
+def message(sender_id, body="hi", room_id="r"):
+    return {"id": 1, "room_id": room_id, "sender_id": sender_id, "body": body}
+
+
+class FakeSocketIO:
+    def __init__(self):
+        self.emitted = []
+
+    def emit(self, event, payload, to=None, namespace=None):
+        self.emitted.append((event, to))
+
+
+def service(loads=None):
+    notifications = Notifications()
+    notifications.socketio = FakeSocketIO()
+
+    def loader(room_id):
+        if loads is not None:
+            loads.append(room_id)
+        return LEVELS
+    notifications.loader = loader
+    return notifications
+
+
+class TestNotifications:
+    def test_audience_is_cached_until_invalidated(self):
+        loads = []
+        notifications = service(loads)
+        audience = notifications.audience("r")
+        assert audience.live == {"alice", "bob"}
+        assert audience.digest == {"alice", "bob", "carol"}
+        notifications.audience("r")
+        notifications.invalidate("r")
+        notifications.audience("r")
+        assert loads == ["r", "r"]
+
+    def test_live_skips_sender_viewers_and_muted(self):
+        notifications = service()
+        for sid, user_id in (("n-a", "alice"), ("n-b", "bob"), ("n-d", "dave")):
+            presence.connect(sid, user_id)
+        presence.join("n-b", "r")  # bob has the room open
+        try:
+            assert notifications.recipients("r", "carol") == {"alice"}
+            notifications.notify("r", message("alice"))
+            assert notifications.socketio.emitted == []
+        finally:
+            for sid in ("n-a", "n-b", "n-d"):
+                presence.disconnect(sid)
+
+    def test_one_digest_per_user_for_many_messages(self):
+        notifications = service()
+        presence.connect("n-a", "alice")
+        try:
+            notifications.queue([message("bob", f"m{n}") for n in range(5)])
+            digests = notifications.collect()
+        finally:
+            presence.disconnect("n-a")
+        assert set(digests) == {"bob", "carol"}
+        assert digests["carol"] == [{"room_id": "r", "messages": 5, "last_sender_id": "bob", "preview": "m4"}]
+        assert notifications.collect() == {}
@@ -0,0 +1,106 @@
+import pytest
+from presence import Presence
+
+
+def diffs(presence, now):
+    return dict(presence.tick(now=now))
+
+
+class TestPresence:
+    def test_changes_within_a_tick_are_coalesced(self):
+        presence = Presence()
+        presence.connect("a", "alice", now=0)
+        presence.join("a", "room")
+        presence.connect("b", "bob", now=0)
+        presence.join("b", "room")
+        presence.leave("b", "room")
+        diff = diffs(presence, 1)["room"]
+        assert diff["online"] == ["alice"] and diff["offline"] == []
+        assert presence.is_online("room", "alice") and not presence.is_online("room", "bob")
+        assert diffs(presence, 2) == {}
+
+    def test_second_connection_keeps_user_online(self):
+        presence = Presence()
+        for sid in ("a1", "a2"):
+            presence.connect(sid, "alice", now=0)
+            presence.join(sid, "room")
+        presence.tick(now=1)
+        presence.disconnect("a1")
+        assert diffs(presence, 2) == {}
+        presence.disconnect("a2")
+        assert diffs(presence, 3)["room"]["offline"] == ["alice"]
+
+    def test_sids_of_a_user(self):
+        presence = Presence()
+        for sid, user_id in (("a1", "alice"), ("b1", "bob"), ("a2", "alice")):
+            presence.connect(sid, user_id, now=0)
+        assert sorted(presence.sids_of("alice")) == ["a1", "a2"]
+        presence.disconnect("a1")
+        assert presence.sids_of("alice") == ["a2"] and presence.sids_of("carol") == []
+
+    def test_heartbeat_expiry_and_return(self):
+        presence = Presence(timeout=10)
+        presence.connect("a", "alice", now=0)
+        presence.join("a", "room")
+        presence.tick(now=1)
+        assert diffs(presence, 11)["room"]["offline"] == ["alice"]
+        presence.heartbeat("a", now=12)
+        assert diffs(presence, 13)["room"]["online"] == ["alice"]
+
+    def test_typing_lapses(self):
+        presence = Presence(typing_ttl=5)
+        presence.connect("a", "alice", now=0)
+        presence.join("a", "room")
+        presence.typing("a", "room", now=0)
+        assert diffs(presence, 1)["room"]["typing"] == ["alice"]
+        presence.typing("a", "room", now=2)
+        assert diffs(presence, 3) == {}
+        assert diffs(presence, 8)["room"]["stopped_typing"] == ["alice"]
+
+    def test_rooms_per_connection_are_capped(self):
+        presence = Presence(max_rooms=2)
+        presence.connect("a", "alice", now=0)
+        assert presence.join("a", "r1") and presence.join("a", "r2")
+        assert not presence.join("a", "r3")
+
+    def test_connected_counts_every_connection(self):
+        presence = Presence()
+        presence.connect("a1", "alice", now=0)
+        presence.connect("a2", "alice", now=0)
+        presence.connect("b", "bob", now=0)
+        assert presence.connected({"alice", "carol"}) == {"alice"}
+        presence.disconnect("a1")
+        assert presence.connected(frozenset(["alice", "bob"])) == {"alice", "bob"}
+        presence.disconnect("a2")
+        assert presence.connected(["alice", "bob", "carol", "dave"]) == {"bob"}
+
+    def test_sids_in_room(self):
+        presence = Presence()
+        for sid, user_id in (("a1", "alice"), ("a2", "alice"), ("b", "bob")):
+            presence.connect(sid, user_id, now=0)
+            presence.join(sid, "room")
+        presence.leave("a2", "room")
+        assert presence.sids_in("room", {"alice"}) == ["a1"]
+
+    def test_loop_survives_a_failed_publish(self):
+        class Stop(BaseException):
+            pass
+
+        presence = Presence()
+        published = []
+
+        def on_diffs(diffs):
+            published.append(diffs)
+            if len(published) == 1:
+                raise ConnectionError("fan-out is down")
+        presence.on_diffs = on_diffs
+        ticks = iter(range(3))
+
+        def sleep(seconds):
+            if next(ticks, None) is None:
+                raise Stop()
+            presence.connect(f"s{len(published)}", f"user{len(published)}")
+            presence.join(f"s{len(published)}", "room")
+        with pytest.raises(Stop):
+            presence.run(sleep)
+        assert len(published) == 3
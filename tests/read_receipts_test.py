@@ -0,0 +1,48 @@
+from read_receipts import ReadReceipts
+
+
+def receipts(written=None, fail=False):
+    read_receipts = ReadReceipts()
+
+    def write(marks):
+        if fail:
+            raise RuntimeError("database is locked")
+        written.extend(marks)
+    read_receipts._write = write
+    return read_receipts
+
+
+class TestReadReceipts:
+    def test_scrolling_coalesces_to_the_furthest(self):
+        written = []
+        read_receipts = receipts(written)
+        for number in (3, 7, 5):
+            read_receipts.mark("alice", "r", number)
+        read_receipts.mark("bob", "r", 2)
+        assert len(read_receipts) == 2
+        assert read_receipts.flush() == 2
+        assert sorted(written) == [("alice", "r", 7), ("bob", "r", 2)]
+        assert read_receipts.flush() == 0
+
+    def test_everything_beats_any_number(self):
+        written = []
+        read_receipts = receipts(written)
+        read_receipts.mark("alice", "r")
+        read_receipts.mark("alice", "r", 900)
+        read_receipts.flush()
+        assert written == [("alice", "r", None)]
+
+    def test_unread_applies_pending_receipts(self):
+        read_receipts = receipts([])
+        counts = {"a": (10, 4), "b": (10, 4), "c": (10, 4), "d": (3, 5)}
+        read_receipts.mark("alice", "a", 8)
+        read_receipts.mark("alice", "b")
+        read_receipts.mark("bob", "c")
+        assert read_receipts.unread("alice", counts) == {"a": 2, "b": 0, "c": 6, "d": 0}
+
+    def test_failed_flush_keeps_the_receipts(self):
+        read_receipts = receipts(fail=True)
+        read_receipts.mark("alice", "r", 3)
+        assert read_receipts.flush() == 0
+        read_receipts.mark("alice", "r", 2)
+        assert read_receipts.pending("alice") == {"r": 3}
@@ -0,0 +1,82 @@
+from recent_messages import RecentMessageCache, RoomRing, payload_size
+
+
+def message(message_id, body="hi"):
+    return {"id": message_id, "room_id": "r", "sender_id": "u", "body": body, "date": None}
+
+
+class TestRecentMessages:
+    def test_ring_keeps_last_n(self):
+        ring = RoomRing(3, [message(i) for i in range(5)])
+        messages, next_before = ring.snapshot()
+        assert [m["id"] for m in messages] == [2, 3, 4]
+        assert next_before == 2
+        assert ring.size == sum(payload_size(m) for m in messages)
+
+    def test_cold_room_uses_loader_once(self):
+        calls = []
+
+        def loader(room_id, limit):
+            calls.append((room_id, limit))
+            return [message(1)], None
+
+        cache = RecentMessageCache(per_room=10)
+        assert cache.get("r", loader) == ([message(1)], None)
+        cache.append("r", message(2))
+        messages, next_before = cache.get("r", loader)
+        assert [m["id"] for m in messages] == [1, 2]
+        assert next_before is None
+        assert calls == [("r", 10)]
+
+    def test_append_to_cold_room_is_ignored(self):
+        cache = RecentMessageCache()
+        cache.append("r", message(1))
+        assert "r" not in cache
+        assert cache.get("r") is None
+
+    def test_evicts_least_recently_used_room(self):
+        one_room = payload_size(message(1)) * 2
+        cache = RecentMessageCache(per_room=2, budget=one_room * 2)
+        loader = lambda room_id, limit: ([message(1), message(2)], None)
+        cache.get("a", loader)
+        cache.get("b", loader)
+        cache.get("a", loader)  # a is now the most recently used
+        cache.get("c", loader)
+        assert "a" in cache and "c" in cache
+        assert "b" not in cache
+        assert cache.size <= cache.budget
+
+    def test_replace_keeps_newest_version(self):
+        cache = RecentMessageCache(per_room=10)
+        cache.get("r", lambda room_id, limit: ([message(1), message(2)], None))
+        edited = dict(message(1, "hello there"), version=2)
+        cache.replace("r", edited)
+        cache.replace("r", dict(message(1, "stale"), version=1))
+        cache.replace("r", dict(message(3), version=2))  # not in the ring
+        messages, _ = cache.get("r")
+        assert messages == [edited, message(2)]
+        assert cache.size == payload_size(edited) + payload_size(message(2))
+
+    def test_message_delivered_during_cold_load_is_kept(self):
+        cache = RecentMessageCache(per_room=10)
+
+        def loader(room_id, limit):
+            # sent while the query runs, one the query saw and one it did not
+            cache.append("r", message(2))
+            cache.append("r", message(3))
+            cache.replace("r", dict(message(1, "edited"), version=2))
+            return [message(1), message(2)], None
+
+        messages, _ = cache.get("r", loader)
+        assert [m["id"] for m in messages] == [1, 2, 3]
+        assert messages[0]["body"] == "edited"
+
+    def test_room_discarded_during_load_is_not_cached(self):
+        cache = RecentMessageCache(per_room=10)
+
+        def loader(room_id, limit):
+            cache.discard("r")
+            return [message(1)], None
+
+        assert cache.get("r", loader) == ([message(1)], None)
+        assert "r" not in cache
@@ -0,0 +1,49 @@
+import retention
+from retention import Pruner
+
+
+def pruner(lock_budget=0.05, max_batch=400):
+    pruner = Pruner(max_batch=max_batch, lock_budget=lock_budget, pause=0)
+    pruner._in_app = lambda fn, *args: fn(*args)
+    return pruner
+
+
+class TestPruner:
+    def test_batch_shrinks_over_budget_and_grows_back(self):
+        p = pruner()
+        assert p.adapt(0.2) == 200
+        assert p.adapt(0.2) == 100
+        assert p.adapt(0.03) == 100  # within budget, kept
+        assert p.adapt(0.001) == 200
+        assert p.adapt(0.001) == 400
+        assert p.adapt(0.001) == 400
+        assert p.longest_batch == 0.2
+
+    def test_batch_never_below_minimum(self):
+        p = pruner()
+        for _ in range(20):
+            p.adapt(1.0)
+        assert p.batch == retention.MIN_BATCH
+
+    def test_pass_deletes_in_batches_until_done(self, monkeypatch):
+        left = {"a": 950, "b": 0}
+        sizes = []
+
+        def prune_batch(room_id, condition, size):
+            sizes.append(size)
+            deleted = min(size, left[room_id])
+            left[room_id] -= deleted
+            return deleted
+        monkeypatch.setattr(retention, "policy_rooms", lambda: [("a", 30, None, 950), ("b", 30, None, 0)])
+        monkeypatch.setattr(retention, "expired", lambda *policy: ["older than 30 days"])
+        monkeypatch.setattr(retention, "prune_batch", prune_batch)
+        monkeypatch.setattr(retention, "prune_segments", lambda *args: 0)
+        monkeypatch.setattr(retention, "incremental_vacuum", lambda pages: None)
+        p = pruner()
+        sleeps = []
+        assert p.run_once(sleeps.append) == ["a"]
+        assert left["a"] == 0 and p.pruned == 950
+        assert all(size <= 400 for size in sizes)
+        # a pause after every batch that deleted something
+        assert len(sleeps) == 3
+        assert p.rate > 0
@@ -0,0 +1,65 @@
+from datetime import datetime, timedelta
+import pytest
+import room_events
+from room_events import delta, latest_seq, MAX_DELTA_EVENTS
+
+
+@pytest.fixture
+def lobby(make_user, make_room):
+    ann, bob = make_user("ann"), make_user("bob")
+    return make_room("lobby", ann, bob), ann, bob
+
+
+class TestRoomEvents:
+    def test_edits_and_deletes_bump_the_version(self, lobby, send):
+        from models import db, Message
+        room, ann, bob = lobby
+        first, second = send((room, ann, "one"), (room, ann, "two"))
+        seen = latest_seq(room.room_id)
+
+        edited = room_events.edit_message(first, ann.id, "one, edited")
+        assert edited["version"] == 2 and edited["seq"] == seen + 1
+        assert room_events.edit_message(first, bob.id, "not yours") is None
+        deleted = room_events.delete_message(first, ann.id)
+        assert deleted["version"] == 3 and deleted["deleted"] and deleted["body"] == ""
+        assert room_events.edit_message(first, ann.id, "too late") is None
+        assert db.session.get(Message, first).version == 3
+
+        assert delta(room.room_id, seen) == {"seq": seen + 2, "messages": [], "deleted": [first]}
+        room_events.edit_message(second, ann.id, "two, edited")
+        changes = delta(room.room_id, seen)
+        assert [(m["id"], m["version"], m["body"]) for m in changes["messages"]] == [(second, 2, "two, edited")]
+        assert changes["deleted"] == [first]
+
+    def test_created_and_deleted_in_between_is_left_out(self, lobby, send):
+        room, ann, _ = lobby
+        message_id, = send((room, ann, "oops"))
+        room_events.delete_message(message_id, ann.id)
+        assert delta(room.room_id, 0) == {"seq": latest_seq(room.room_id), "messages": [], "deleted": []}
+
+    def test_too_many_events_is_a_reset(self, lobby, send):
+        room, ann, _ = lobby
+        send(*[(room, ann, f"m{n}") for n in range(MAX_DELTA_EVENTS + 1)])
+        assert delta(room.room_id, 0) == {"seq": latest_seq(room.room_id), "reset": True}
+        assert len(delta(room.room_id, 1)["messages"]) == MAX_DELTA_EVENTS
+
+    @pytest.mark.parametrize("drop", ["archive", "prune"])
+    def test_delta_from_before_dropped_events_is_a_reset(self, lobby, send, drop):
+        import sqlalchemy as s
+        import archive
+        import retention
+        from models import db, Room, Message
+        room, ann, _ = lobby
+        old = datetime.now() - timedelta(days=30)
+        send(*[(room, ann, f"old {n}", old) for n in range(3)])
+        seen = latest_seq(room.room_id)
+        send((room, ann, "new"))
+        # both expunge the session
+        room_id = room.room_id
+        if drop == "archive":
+            assert archive.archive_batch(room_id, old + timedelta(seconds=1), 10) == 3
+        else:
+            assert retention.prune_batch(room_id, Message.date < old + timedelta(seconds=1), 10) == 3
+        assert db.session.scalar(s.select(Room.archived_event_seq).where(Room.room_id == room_id)) == seen
+        assert delta(room_id, seen - 1) == {"seq": latest_seq(room_id), "reset": True}
+        assert [m["body"] for m in delta(room_id, seen)["messages"]] == ["new"]
@@ -0,0 +1,53 @@
+import pytest
+from room_list import user_rooms, unread_counts, mark_read, add_member, RoomFull
+
+
+@pytest.fixture
+def rooms(make_user, make_room):
+    ann, bob = make_user("ann"), make_user("bob")
+    return make_room("lobby", ann, bob), make_room("side", ann, bob), ann, bob
+
+
+class TestRoomList:
+    def test_one_batch_numbers_each_room_from_one(self, rooms, send):
+        from models import db, Message
+        lobby, side, ann, bob = rooms
+        sent = send((lobby, ann, "a"), (side, ann, "b"), (lobby, bob, "c"), (side, bob, "d"), (lobby, ann, "e"))
+        numbers = [db.session.get(Message, message_id).number for message_id in sent]
+        assert numbers == [1, 1, 2, 2, 3]
+        sent = send((side, ann, "f"), (lobby, ann, "g"))
+        assert [db.session.get(Message, message_id).number for message_id in sent] == [3, 4]
+        assert unread_counts(bob.id) == {lobby.room_id: (4, 0), side.room_id: (3, 0)}
+
+    def test_dashboard_counts_and_previews(self, rooms, send):
+        lobby, side, ann, bob = rooms
+        send((lobby, ann, "first"), (side, ann, "second"), (lobby, ann, "third"))
+        summaries = {summary.room_name: summary for summary in user_rooms(bob.id)}
+        assert summaries["lobby"].unread == 2 and summaries["lobby"].last_message == "third"
+        assert summaries["side"].unread == 1 and summaries["side"].member_count == 2
+        # receipts not flushed yet count as read
+        pending = {lobby.room_id: 1, side.room_id: None}
+        assert {s.room_name: s.unread for s in user_rooms(bob.id, pending)} == {"lobby": 1, "side": 0}
+
+    def test_read_pointer_only_moves_forward_and_is_clamped(self, rooms, send):
+        from models import db
+        lobby, side, ann, bob = rooms
+        send((lobby, ann, "a"), (lobby, ann, "b"), (lobby, ann, "c"), (side, ann, "d"))
+        mark_read([(bob.id, lobby.room_id, 2)])
+        db.session.commit()
+        assert unread_counts(bob.id)[lobby.room_id] == (3, 2)
+        mark_read([(bob.id, lobby.room_id, 1), (bob.id, side.room_id, 99)])
+        db.session.commit()
+        assert unread_counts(bob.id) == {lobby.room_id: (3, 2), side.room_id: (1, 1)}
+        mark_read([(bob.id, lobby.room_id, None)])
+        db.session.commit()
+        assert {s.room_name: s.unread for s in user_rooms(bob.id)} == {"lobby": 0, "side": 0}
+
+    def test_member_cap(self, rooms, make_user):
+        from models import db
+        lobby, _, _, _ = rooms
+        with pytest.raises(RoomFull):
+            add_member(make_user("eve").id, lobby.room_id, default_cap=2)
+        add_member(make_user("zoe").id, lobby.room_id, default_cap=3)
+        db.session.commit()
+        assert lobby.member_count == 3
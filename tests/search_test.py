@@ -0,0 +1,77 @@
+from search import fts5_query
+
+
+class TestFts5Query:
+    def test_words_are_anded_with_prefix_on_last(self):
+        assert fts5_query("hello wor") == '"hello" "wor"*'
+
+    def test_syntax_in_input_is_literal(self):
+        assert fts5_query('say "hi" OR NEAR(') == '"say" """hi""" "OR" "NEAR("*'
+
+    def test_blank_input(self):
+        assert fts5_query("   ") is None
+
+
+def ids(results):
+    return [message["id"] for message in results]
+
+
+class TestSearch:
+    def test_index_follows_sends_edits_and_deletes(self, make_user, make_room, send):
+        import room_events
+        from search import search
+        ann, bob = make_user("ann"), make_user("bob")
+        room = make_room("lobby", ann, bob)
+        first, second = send((room, ann, "meet at the harbour"), (room, bob, "see you there"))
+        assert ids(search(bob.id, "harb")[0]) == [first]
+
+        room_events.edit_message(first, ann.id, "meet at the station")
+        assert search(bob.id, "harbour") == ([], False)
+        assert ids(search(bob.id, "station")[0]) == [first]
+
+        room_events.delete_message(second, bob.id)
+        assert search(ann.id, "there") == ([], False)
+
+    def test_only_rooms_of_the_user_and_filters(self, make_user, make_room, send):
+        from search import search
+        ann, bob, eve = make_user("ann"), make_user("bob"), make_user("eve")
+        lobby, other = make_room("lobby", ann, bob), make_room("other", eve, ann)
+        in_lobby, by_ann, by_eve = send((lobby, bob, "lunch?"), (other, ann, "lunch!"), (other, eve, "lunch"))
+        assert sorted(ids(search(bob.id, "lunch")[0])) == [in_lobby]
+        assert sorted(ids(search(ann.id, "lunch")[0])) == [in_lobby, by_ann, by_eve]
+        assert sorted(ids(search(ann.id, "lunch", room_id=other.room_id)[0])) == [by_ann, by_eve]
+        assert ids(search(ann.id, "lunch", sender_id=eve.id)[0]) == [by_eve]
+
+    def test_best_match_first(self, make_user, make_room, send):
+        from search import search
+        ann = make_user("ann")
+        room = make_room("lobby", ann)
+        weak, strong = send((room, ann, "kiwi and a few other words about the weather today"),
+                            (room, ann, "kiwi kiwi kiwi"))
+        assert ids(search(ann.id, "kiwi")[0]) == [strong, weak]
+
+    def test_pages_cover_every_match_once(self, make_user, make_room, send):
+        from search import search
+        ann = make_user("ann")
+        room = make_room("lobby", ann)
+        sent = send(*[(room, ann, f"note {n}") for n in range(5)])
+        pages = [search(ann.id, "note", page=page, limit=2) for page in (1, 2, 3)]
+        assert [has_more for _, has_more in pages] == [True, True, False]
+        found = [message_id for results, _ in pages for message_id in ids(results)]
+        assert sorted(found) == sent
+
+    def test_reindex_in_batches(self, app, make_user, make_room, send):
+        import sqlalchemy as s
+        from models import db
+        from search import search, reindex
+        ann = make_user("ann")
+        room = make_room("lobby", ann)
+        sent = send(*[(room, ann, f"entry {n}") for n in range(5)])
+        db.session.execute(s.text("INSERT INTO message_fts(message_fts) VALUES ('delete-all')"))
+        db.session.commit()
+        assert search(ann.id, "entry") == ([], False)
+
+        progress = []
+        assert reindex(batch_size=2, echo=progress.append) == 5
+        assert progress == ["indexed 2 messages", "indexed 4 messages", "indexed 5 messages"]
+        assert sorted(ids(search(ann.id, "entry", limit=10)[0])) == sent
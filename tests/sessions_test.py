@@ -0,0 +1,62 @@
+import pytest
+from sessions import MemoryStore, SQLiteStore, FileStore, create_store
+
+
+NOW = 1_800_000_000
+
+
+@pytest.fixture(params=["memory", "sqlite", "file"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return MemoryStore()
+    if request.param == "sqlite":
+        return SQLiteStore(str(tmp_path / "sessions.db"))
+    return FileStore(str(tmp_path / "sessions"))
+
+
+class TestSessionStores:
+    def test_lookup_until_expiry(self, store):
+        token = store.create("alice", 60, now=NOW)
+        assert store.get(token, now=NOW + 59) == "alice"
+        assert store.get(token, now=NOW + 60) is None
+        assert store.get("no-such-token", now=NOW) is None
+
+    def test_revoke_one_and_all(self, store):
+        first = store.create("alice", 60, now=NOW)
+        second = store.create("alice", 60, now=NOW)
+        other = store.create("bob", 60, now=NOW)
+        assert store.count("alice", now=NOW) == 2
+        store.revoke(first)
+        assert store.get(first, now=NOW) is None
+        assert store.get(second, now=NOW) == "alice"
+        assert store.revoke_user("alice") == 1
+        assert store.get(second, now=NOW) is None
+        assert store.count(now=NOW) == 1
+        assert store.get(other, now=NOW) == "bob"
+
+    def test_sweep_removes_expired_only(self, store):
+        old = store.create("alice", 60, now=NOW)
+        live = store.create("bob", 7 * 86400, now=NOW)
+        assert store.sweep(now=NOW + 86400) == 1
+        assert store.get(live, now=NOW + 86400) == "bob"
+        assert store.count(now=NOW) == 1
+        assert store.get(old, now=NOW) is None
+
+    def test_sweep_skips_revoked(self):
+        store = MemoryStore()
+        token = store.create("alice", 60, now=NOW)
+        store.revoke(token)
+        assert store.sweep(now=NOW + 120) == 0
+
+
+def test_file_tokens_can_not_leave_the_directory(tmp_path):
+    store = FileStore(str(tmp_path / "sessions"))
+    (tmp_path / "secret").write_text("alice 9999999999")
+    assert store.get("0/../../secret", now=NOW) is None
+    assert store.get("..", now=NOW) is None
+
+
+def test_create_store():
+    assert isinstance(create_store("memory"), MemoryStore)
+    with pytest.raises(ValueError):
+        create_store("memcached://localhost")
@@ -0,0 +1,60 @@
+from user_cache import UserCache, SessionUser
+
+
+def snapshot(user_id):
+    return SessionUser(user_id, f"user {user_id}", "user@email.com")
+
+
+class TestUserCache:
+    def test_hit_after_first_load(self):
+        loads = []
+        cache = UserCache()
+        loader = lambda user_id: loads.append(user_id) or snapshot(user_id)
+        assert cache.get("1", loader).username == "user 1"
+        assert cache.get("1", loader).get_id() == "1"
+        assert loads == ["1"]
+        assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+    def test_invalidate_and_expiry_reload(self):
+        loads = []
+        cache = UserCache(ttl=0)
+        loader = lambda user_id: loads.append(user_id) or snapshot(user_id)
+        cache.get("1", loader)
+        cache.get("1", loader)
+        assert loads == ["1", "1"]
+        cache = UserCache()
+        cache.get("1", loader)
+        cache.invalidate("1")
+        cache.get("1", loader)
+        assert loads == ["1", "1", "1", "1"]
+
+    def test_unknown_user_is_not_cached(self):
+        cache = UserCache()
+        assert cache.get("missing", lambda user_id: None) is None
+        assert cache.stats()["size"] == 0
+
+    def test_lru_bound(self):
+        cache = UserCache(max_size=2)
+        for user_id in ("1", "2", "1", "3"):
+            cache.get(user_id, snapshot)
+        assert set(cache._entries) == {"1", "3"}
+
+    def test_load_racing_an_invalidation_is_not_cached(self):
+        cache = UserCache()
+
+        def loader(user_id):
+            # the row changed and committed while it was being read
+            cache.invalidate(user_id)
+            return snapshot(user_id)
+
+        cache.get("1", loader)
+        assert cache.stats()["size"] == 0
+
+    def test_changed_tells_the_other_nodes(self):
+        published = []
+        cache = UserCache()
+        cache.on_changed = published.append
+        cache.get("1", snapshot)
+        cache.changed({"2", "1"})
+        assert published == [["1", "2"]]
+        assert cache.stats()["size"] == 0
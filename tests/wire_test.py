@@ -0,0 +1,95 @@
+import json
+import pytest
+import wire
+from wire import EmitBatcher, negotiate, channel, shorten, encode
+
+
+class FakeManager:
+    def __init__(self, rooms):
+        self.rooms = rooms
+
+    def get_participants(self, namespace, room):
+        return iter(self.rooms.get(room, ()))
+
+
+class FakeSocketIO:
+    def __init__(self, rooms):
+        self.server = type("Server", (), {"manager": FakeManager(rooms)})()
+        self.emitted = []
+
+    def emit(self, event, data, to=None, namespace=None):
+        self.emitted.append((event, data, to))
+
+
+def batcher(rooms):
+    emit_batcher = EmitBatcher()
+    emit_batcher.socketio = FakeSocketIO(rooms)
+    return emit_batcher
+
+
+class TestWire:
+    def test_negotiate(self, monkeypatch):
+        assert negotiate(None) is None
+        assert negotiate("xml") is None
+        assert negotiate("json") == "json"
+        monkeypatch.setattr(wire, "msgpack", None)
+        assert negotiate("msgpack") == "json"
+
+    def test_channel(self):
+        assert channel("r", None) == "r"
+        assert channel("r", "json") == "r|json"
+
+    def test_shorten_keeps_unknown_keys(self):
+        assert shorten({"id": 1, "body": "hi", "user_ids": ["a"]}) == {"i": 1, "b": "hi", "user_ids": ["a"]}
+        assert shorten(None) is None
+
+    def test_json_frame(self):
+        frame = encode([("message", {"id": 1}), ("message_deleted", {"id": 2})], "json")
+        assert json.loads(frame) == [["message", {"id": 1}], ["message_deleted", {"id": 2}]]
+
+    def test_msgpack_frame(self):
+        msgpack = pytest.importorskip("msgpack")
+        frame = encode([("message", {"id": 1, "body": "hi"})], "msgpack")
+        assert msgpack.unpackb(frame) == [["message", {"i": 1, "b": "hi"}]]
+
+
+class TestEmitBatcher:
+    def test_one_frame_per_room_and_wire(self):
+        emit_batcher = batcher({"r|json": ["sid1", "sid2"]})
+        for n in range(3):
+            emit_batcher.add("r", "message", {"id": n})
+        assert emit_batcher.flush() == 1
+        [(event, frame, to)] = emit_batcher.socketio.emitted
+        assert (event, to) == ("batch", "r|json")
+        assert [payload["id"] for _, payload in json.loads(frame)] == [0, 1, 2]
+
+    def test_rooms_without_listeners_are_skipped(self):
+        emit_batcher = batcher({})
+        emit_batcher.add("r", "message", {"id": 1})
+        assert emit_batcher.flush() == 0
+        assert emit_batcher.socketio.emitted == []
+        # and not kept for later
+        assert emit_batcher.flush() == 0
+
+    def test_unencodable_batch_is_dropped(self):
+        emit_batcher = batcher({"r|json": ["sid1"], "s|json": ["sid2"]})
+        emit_batcher.add("r", "message", {"id": object()})
+        emit_batcher.add("s", "message", {"id": 1})
+        assert emit_batcher.flush() == 1
+        assert emit_batcher.socketio.emitted[0][2] == "s|json"
+
+    def test_presence_reaches_batched_clients(self):
+        # deliver hands presence diffs to the batcher like any room event,
+        # a wire-negotiated client only listens on its channel
+        emit_batcher = batcher({"r|json": ["sid1"]})
+        diff = {"online": ["alice"], "offline": [], "typing": ["alice"], "stopped_typing": []}
+        emit_batcher.add("r", "presence", diff)
+        emit_batcher.flush()
+        [(event, frame, to)] = emit_batcher.socketio.emitted
+        assert to == channel("r", negotiate("json"))
+        assert json.loads(frame) == [["presence", diff]]
+
+    def test_presence_keys_are_not_shortened(self):
+        msgpack = pytest.importorskip("msgpack")
+        diff = {"online": ["alice"], "offline": [], "typing": [], "stopped_typing": ["bob"]}
+        assert msgpack.unpackb(encode([("presence", diff)], "msgpack")) == [["presence", diff]]
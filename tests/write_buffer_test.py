@@ -0,0 +1,77 @@
+import time
+import pytest
+from write_buffer import MessageWriteBuffer, BufferFull
+
+
+def buffer(fail=lambda rows: False, **options):
+    published = []
+    message_buffer = MessageWriteBuffer(max_size=1000, max_delay=0.1, **options)
+    message_buffer.on_flush = published.extend
+
+    ids = iter(range(1, 1000000))
+
+    def write(rows):
+        message_buffer.writes += 1
+        if fail(rows):
+            raise RuntimeError("constraint failed")
+        for row in rows:
+            row["number"] = 1
+        return [(message_id, message_id) for message_id, _ in zip(ids, rows)]
+    message_buffer.writes = 0
+    message_buffer._write = write
+    return message_buffer, published
+
+
+class TestWriteBuffer:
+    def test_full_buffer_pushes_back(self):
+        message_buffer, _ = buffer(max_pending=2)
+        message_buffer.add("r", "u", "one")
+        message_buffer.add("r", "u", "two")
+        with pytest.raises(BufferFull):
+            message_buffer.add("r", "u", "three")
+        assert message_buffer.flush() == 2
+        message_buffer.add("r", "u", "three")
+
+    def test_failed_flush_is_retried_then_bad_row_parked(self):
+        message_buffer, published = buffer(lambda rows: any(row["message_body"] == "bad" for row in rows),
+                                           max_retries=2)
+        for body in ("a", "bad", "c", "d"):
+            message_buffer.add("r", "u", body)
+        assert message_buffer.flush() == 0
+        message_buffer._retry_at = 0.0
+        assert message_buffer.flush() == 0
+        assert len(message_buffer) == 4
+        message_buffer._retry_at = 0.0
+        assert message_buffer.flush() == 3
+        assert [payload["body"] for payload in published] == ["a", "c", "d"]
+        assert [row["message_body"] for row in message_buffer.parked] == ["bad"]
+        assert message_buffer.failures == 0 and len(message_buffer) == 0
+
+    def test_nothing_parked_when_the_database_is_down(self):
+        message_buffer, published = buffer(lambda rows: True, max_retries=0)
+        message_buffer.add("r", "u", "a")
+        message_buffer.add("r", "u", "b")
+        assert message_buffer.flush() == 0
+        assert len(message_buffer) == 2 and message_buffer.parked == []
+        assert message_buffer._retry_at > time.monotonic()  # backing off
+
+    def test_outage_costs_two_writes_per_attempt(self):
+        message_buffer, _ = buffer(lambda rows: True, max_retries=2)
+        for n in range(64):
+            message_buffer.add("r", "u", str(n))
+        for _ in range(6):
+            message_buffer._retry_at = 0.0
+            assert message_buffer.flush() == 0
+        # two plain retries, then the batch and one row alone per attempt
+        assert message_buffer.writes == 2 + 4 * 2
+        assert len(message_buffer) == 64 and message_buffer.parked == []
+
+    def test_failed_publish_keeps_the_rows_written(self):
+        message_buffer, _ = buffer()
+
+        def on_flush(payloads):
+            raise ConnectionError("fan-out is down")
+        message_buffer.on_flush = on_flush
+        message_buffer.add("r", "u", "a")
+        assert message_buffer.flush() == 1
+        assert len(message_buffer) == 0 and message_buffer.failures == 0